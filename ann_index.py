@@ -0,0 +1,210 @@
+# ann_index.py
+# Scelta del tipo di indice FAISS in base al numero di chunk.
+#
+# L'indice flat float32 è esatto ma occupa d*4 byte per vettore e costa una
+# scansione completa per query. Per raccolte grandi si passa all'indice
+# quantizzato SQ8 (4x meno memoria, recall quasi esatta, nessun
+# addestramento costoso sul percorso di ingestione). HNSW, SQ fp16 e IVF-PQ
+# sono disponibili impostando il tipo esplicitamente; IVF-PQ riordina i
+# candidati con le distanze esatte (RFlat): ricerca sub-lineare con recall
+# alta, ma i vettori float32 restano in memoria accanto ai codici PQ.
+#
+#   python ann_index.py --n 100000 --types flat,hnsw,sq8,sq16,ivfpq
+
+import os
+import sys
+import time
+import argparse
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+# "auto" sceglie per numero di chunk; altrimenti uno tra INDEX_TYPES
+DEFAULT_INDEX_TYPE = os.environ.get("STUDY_MASTER_INDEX_TYPE", "auto")
+INDEX_TYPES = ("flat", "hnsw", "sq8", "sq16", "ivfpq")
+
+# Soglia della scelta automatica (numero di chunk): sotto flat, sopra SQ8
+FLAT_MAX_VECTORS = 10_000
+
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = int(os.environ.get("STUDY_MASTER_HNSW_EF_SEARCH", "64"))
+IVF_NPROBE = int(os.environ.get("STUDY_MASTER_IVF_NPROBE", "16"))
+# Candidati IVF-PQ riordinati con la distanza esatta: k * REFINE_K_FACTOR
+REFINE_K_FACTOR = 8
+# Il k-means del PQ (256 centroidi per sottoquantizzatore) vuole ~39 punti per centroide
+IVFPQ_MIN_VECTORS = 256 * 39
+# Limiti al costo dell'addestramento (k-means di IVF e PQ): campione, numero di liste,
+# punti per centroide e iterazioni del PQ (la parte lenta: un k-means per sottoquantizzatore)
+_TRAIN_SAMPLE = 50_000
+_MAX_NLIST = 1024
+_PQ_POINTS_PER_CENTROID = 39
+_PQ_TRAIN_ITERATIONS = 10
+
+
+def choose_index_type(n_vectors, requested=DEFAULT_INDEX_TYPE):
+    """Tipo di indice per `n_vectors` chunk: quello richiesto, o la scelta automatica."""
+    if requested != "auto":
+        if requested not in INDEX_TYPES:
+            raise ValueError(f"Tipo di indice sconosciuto: {requested}")
+        if requested == "ivfpq" and n_vectors < IVFPQ_MIN_VECTORS:
+            # Troppo pochi vettori per addestrare il PQ: SQ8 dà un risparmio simile
+            return "sq8"
+        return requested
+    if n_vectors < FLAT_MAX_VECTORS:
+        return "flat"
+    return "sq8"
+
+
+def _pq_subquantizers(d):
+    # Circa 8 dimensioni per sottoquantizzatore, e m deve dividere d
+    for m in (64, 48, 32, 24, 16, 12, 8, 4, 2):
+        if d % m == 0 and d // m >= 4:
+            return m
+    return 1
+
+
+def index_factory_string(index_type, n_vectors, d):
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "hnsw":
+        return f"HNSW{HNSW_M}"
+    if index_type == "sq8":
+        return "SQ8"
+    if index_type == "sq16":
+        return "SQfp16"
+    if index_type == "ivfpq":
+        nlist = max(1, min(int(4 * n_vectors ** 0.5), n_vectors // 39, _MAX_NLIST))
+        # np: niente addestramento polisemico (lento, serve solo a ricerche in distanza di Hamming)
+        return f"IVF{nlist},PQ{_pq_subquantizers(d)}x8np,RFlat"
+    raise ValueError(f"Tipo di indice sconosciuto: {index_type}")
+
+
+def build_index(vectors, index_type):
+    """Indice FAISS (metrica L2, come FAISS.from_embeddings) addestrato su `vectors`, ancora vuoto."""
+    n, d = vectors.shape
+    index = faiss.index_factory(d, index_factory_string(index_type, n, d), faiss.METRIC_L2)
+    if index_type == "hnsw":
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    if index_type == "ivfpq":
+        # nprobe, k_factor ed efSearch sono salvati con l'indice su disco
+        index.k_factor = REFINE_K_FACTOR
+        ivf = faiss.downcast_index(faiss.extract_index_ivf(index))
+        ivf.nprobe = IVF_NPROBE
+        ivf.pq.cp.max_points_per_centroid = _PQ_POINTS_PER_CENTROID
+        ivf.pq.cp.niter = _PQ_TRAIN_ITERATIONS
+    if not index.is_trained:
+        sample = vectors
+        if n > _TRAIN_SAMPLE:
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(n, _TRAIN_SAMPLE, replace=False)]
+        index.train(sample)
+    return index
+
+
+def create_vectorstore(text_embeddings, embeddings, metadatas=None, index_type=DEFAULT_INDEX_TYPE):
+    """Come FAISS.from_embeddings, ma con il tipo di indice scelto da choose_index_type."""
+    vectors = np.asarray([v for _, v in text_embeddings], dtype=np.float32)
+    chosen = choose_index_type(len(vectors), index_type)
+    index = build_index(vectors, chosen)
+    vectorstore = FAISS(embeddings, index, InMemoryDocstore(), {})
+    vectorstore.add_embeddings(text_embeddings, metadatas=metadatas)
+    vectorstore.index_type = chosen
+    return vectorstore
+
+
+def index_kind(index):
+    """Nome della classe FAISS concreta (IndexFlatL2, IndexHNSWFlat, IndexIVFPQ, ...)."""
+    return type(faiss.downcast_index(index)).__name__
+
+
+def memory_bytes(index):
+    """Stima della memoria occupata dall'indice: codici, grafo HNSW, centroidi IVF/PQ."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexRefine):
+        return memory_bytes(index.base_index) + memory_bytes(index.refine_index)
+    if isinstance(index, faiss.IndexHNSW):
+        hnsw = index.hnsw
+        graph = hnsw.neighbors.size() * 4 + hnsw.levels.size() * 4 + hnsw.offsets.size() * 8
+        return memory_bytes(index.storage) + graph
+    if isinstance(index, faiss.IndexIVF):
+        # Codici + id a 64 bit nelle liste invertite, più i centroidi del quantizzatore grossolano
+        total = index.ntotal * (index.code_size + 8) + memory_bytes(index.quantizer)
+        if isinstance(index, faiss.IndexIVFPQ):
+            total += index.pq.centroids.size() * 4
+        return total
+    return index.ntotal * getattr(index, "code_size", index.d * 4)
+
+
+# --- BENCHMARK ---
+
+def _synthetic_vectors(n, d, seed=0):
+    # Vettori a cluster: più realistici del rumore uniforme per IVF e PQ
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, n // 500), d)).astype(np.float32)
+    labels = rng.integers(0, len(centers), size=n)
+    return centers[labels] + 0.3 * rng.normal(size=(n, d)).astype(np.float32)
+
+
+def benchmark(vectors, index_types=INDEX_TYPES, queries=200, k=10):
+    """Per ogni tipo: tempo di build, memoria, latenza per query e recall@k rispetto al flat."""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    rng = np.random.default_rng(1)
+    picks = rng.choice(len(vectors), min(queries, len(vectors)), replace=False)
+    query_vectors = vectors[picks] + 0.05 * rng.normal(size=(len(picks), vectors.shape[1])).astype(np.float32)
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(query_vectors, k)
+
+    results = []
+    for index_type in index_types:
+        chosen = choose_index_type(len(vectors), index_type)
+        start = time.perf_counter()
+        index = build_index(vectors, chosen)
+        index.add(vectors)
+        build_s = time.perf_counter() - start
+
+        latencies = []
+        found = 0
+        for i, q in enumerate(query_vectors):
+            start = time.perf_counter()
+            _, ids = index.search(q[None, :], k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found += len(set(ids[0]) & set(truth[i]))
+        latencies.sort()
+        results.append({
+            "type": chosen,
+            "build_s": round(build_s, 3),
+            "memory_mb": round(memory_bytes(index) / 1e6, 2),
+            "disk_mb": round(faiss.serialize_index(index).nbytes / 1e6, 2),
+            "p50_ms": round(latencies[len(latencies) // 2], 3),
+            "p95_ms": round(latencies[int(len(latencies) * 0.95)], 3),
+            "recall": round(found / (len(query_vectors) * k), 3),
+        })
+    return results
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark tipi di indice FAISS (build, memoria, latenza, recall)")
+    parser.add_argument("--vectors", help="file .npy (n x d) di embedding reali; altrimenti sintetici")
+    parser.add_argument("--n", type=int, default=50_000)
+    parser.add_argument("--d", type=int, default=384)
+    parser.add_argument("--types", default=",".join(INDEX_TYPES))
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    vectors = np.load(args.vectors) if args.vectors else _synthetic_vectors(args.n, args.d)
+    print(f"{len(vectors)} vettori, d={vectors.shape[1]}, scelta automatica: {choose_index_type(len(vectors), 'auto')}")
+    print(f"{'tipo':>6} {'build s':>8} {'RAM MB':>8} {'disco MB':>9} {'p50 ms':>8} {'p95 ms':>8} {'recall':>7}")
+    for r in benchmark(vectors, args.types.split(","), args.queries, args.k):
+        print(f"{r['type']:>6} {r['build_s']:>8} {r['memory_mb']:>8} {r['disk_mb']:>9} "
+              f"{r['p50_ms']:>8} {r['p95_ms']:>8} {r['recall']:>7}")
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
@@ -0,0 +1,125 @@
+# answer_cache.py
+# Cache semantica delle risposte.
+#
+# Le risposte sono raggruppate per (documenti, stile); una nuova domanda è
+# un hit se il suo embedding è abbastanza simile a quello di una domanda già
+# risposta nello stesso gruppo. Solo le risposte della chat: quiz e flashcard
+# devono cambiare a ogni richiesta. Le chiavi dei documenti dipendono dal
+# contenuto, quindi una risposta non diventa mai obsoleta: le voci escono solo
+# per TTL o per i budget di spazio.
+
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+
+DEFAULT_THRESHOLD = float(os.environ.get("STUDY_MASTER_ANSWER_CACHE_THRESHOLD", "0.92"))
+DEFAULT_TTL_SECONDS = int(os.environ.get("STUDY_MASTER_ANSWER_CACHE_TTL", str(24 * 3600)))
+DEFAULT_MAX_ENTRIES = 2000
+# Budget di spazio: somma dei caratteri di domande e risposte in cache
+DEFAULT_MAX_CHARS = 20_000_000
+
+
+def _normalize(vector):
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def _dot(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+
+class _Entry:
+    __slots__ = ("group", "question", "vector", "answer", "created", "size")
+
+    def __init__(self, group, question, vector, answer):
+        self.group = group
+        self.question = question
+        self.vector = vector
+        self.answer = answer
+        self.created = time.time()
+        self.size = len(question) + len(answer)
+
+
+class SemanticAnswerCache:
+    """Cache LRU + TTL con budget di voci e di caratteri, thread-safe."""
+
+    def __init__(self, embeddings, threshold=DEFAULT_THRESHOLD, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 max_entries=DEFAULT_MAX_ENTRIES, max_chars=DEFAULT_MAX_CHARS):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # id -> _Entry, in ordine di uso (LRU in testa)
+        self._groups = {}               # group -> set di id
+        self._chars = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def group_key(index_keys, response_style):
+        return (index_keys, response_style)
+
+    def embed(self, question):
+        return _normalize(self.embeddings.embed_query(question))
+
+    def lookup(self, group, question, vector=None):
+        """Restituisce (risposta, vettore) se c'è un hit, altrimenti (None, vettore).
+
+        Il vettore si può ripassare a store() per non ricalcolare l'embedding.
+        """
+        vector = vector or self.embed(question)
+        now = time.time()
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._groups.get(group, ())):
+                entry = self._entries[entry_id]
+                if now - entry.created > self.ttl_seconds:
+                    self._remove(entry_id)
+                    continue
+                score = _dot(vector, entry.vector)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                return None, vector
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id].answer, vector
+
+    def store(self, group, question, answer, vector=None):
+        vector = vector or self.embed(question)
+        entry = _Entry(group, question, vector, answer)
+        if entry.size > self.max_chars:
+            return
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = entry
+            self._groups.setdefault(group, set()).add(entry_id)
+            self._chars += entry.size
+            while len(self._entries) > self.max_entries or self._chars > self.max_chars:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        self._chars -= entry.size
+        ids = self._groups[entry.group]
+        ids.discard(entry_id)
+        if not ids:
+            del self._groups[entry.group]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "chars": self._chars,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
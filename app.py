@@ -2,26 +2,61 @@ import streamlit as st
 import os
 import warnings
 import time
-import sqlite3
+import hmac
 import hashlib
-from datetime import datetime
+import importlib.util
+
+import storage
+import write_queue
+import metrics
+import warmup
+import bm25
+import llm_scheduler
+import pipeline
+from pipeline import (
+    LLM_MODEL, INDEX_TYPE, split_pages, get_document_key, get_system_instruction, build_local_embeddings,
+)
+
+def has_module(name):
+    """Verifica che un modulo sia installato senza importarlo."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
 
 # --- IMPORT LOGICA AI ---
-try:
-    from pypdf import PdfReader
-    from langchain_text_splitters import RecursiveCharacterTextSplitter
-    from langchain_community.embeddings import HuggingFaceEmbeddings
-    from langchain_community.vectorstores import FAISS
-    from langchain_google_genai import ChatGoogleGenerativeAI
-    from langchain_core.prompts import ChatPromptTemplate
-    from langchain.chains import create_retrieval_chain
-    from langchain.chains.combine_documents import create_stuff_documents_chain
-    from langchain_core.documents import Document
-    from langchain_core.messages import SystemMessage, HumanMessage
-except ImportError as e:
-    st.error(f"⚠️ Errore critico librerie: {e}. Controlla requirements.txt.")
+# Solo un controllo di presenza: i moduli pesanti (langchain, FAISS, pypdf,
+# sentence-transformers) si caricano al primo uso o nel riscaldamento dopo
+# il login, così la pagina di accesso compare subito.
+_missing = [name for name in ("langchain", "langchain_community", "langchain_text_splitters",
+                              "langchain_google_genai", "faiss", "pypdf", "sentence_transformers")
+            if not has_module(name)]
+if _missing:
+    st.error(f"⚠️ Errore critico librerie: {', '.join(_missing)} non installate. Controlla requirements.txt.")
     st.stop()
 
+index_cache = warmup.lazy_module("index_cache")
+pdf_extract = warmup.lazy_module("pdf_extract")
+embedding_cache = warmup.lazy_module("embedding_cache")
+llm_clients = warmup.lazy_module("llm_clients")
+answer_cache = warmup.lazy_module("answer_cache")
+library = warmup.lazy_module("library")
+index_registry = warmup.lazy_module("index_registry")
+ann_index = warmup.lazy_module("ann_index")
+context_packing = warmup.lazy_module("context_packing")
+study_material = warmup.lazy_module("study_material")
+progressive_index = warmup.lazy_module("progressive_index")
+conversation_memory = warmup.lazy_module("conversation_memory")
+
+# Importati dal thread di riscaldamento dopo il login
+WARMUP_MODULES = (
+    "pdf_extract", "index_cache", "ann_index", "index_registry", "embedding_cache",
+    "answer_cache", "library", "context_packing", "llm_clients", "study_material", "progressive_index",
+    "conversation_memory",
+    "langchain_text_splitters", "langchain.chains", "langchain.chains.combine_documents",
+    "langchain_community.embeddings.huggingface",
+)
+
 # --- IMPORT GRAFICA (Gestione Errore) ---
 try:
     import styles
@@ -30,12 +65,8 @@ except ImportError:
     HAS_STYLES = False
 
 # --- SETUP FIREBASE (OPZIONALE) ---
-try:
-    from google.oauth2 import service_account
-    from google.cloud import firestore
-    FIREBASE_AVAILABLE = True
-except ImportError:
-    FIREBASE_AVAILABLE = False
+# google-cloud-firestore è importato solo se il backend cloud è configurato
+FIREBASE_AVAILABLE = has_module("google.cloud.firestore") and has_module("google.oauth2")
 
 # --- 1. SETUP INIZIALE ---
 warnings.filterwarnings("ignore")
@@ -46,206 +77,457 @@ if HAS_STYLES:
 
 # --- 2. GESTIONE DATABASE IBRIDO (SQLITE + FIRESTORE) ---
 
+# Cronologia: messaggi letti dal DB per pagina e messaggi mostrati uno per uno
+HISTORY_PAGE_SIZE = 50
+CHAT_WINDOW = 20
+# I messaggi più vecchi della finestra sono raggruppati in blocchi memoizzati
+HISTORY_BLOCK_SIZE = 25
+
+# Utenti che vedono il pannello metriche (lista separata da virgole)
+ADMIN_USERS = {u.strip() for u in os.environ.get("STUDY_MASTER_ADMINS", "").split(",") if u.strip()}
+# Credenziale separata per il pannello: un nome libero può registrarlo chiunque
+ADMIN_TOKEN = os.environ.get("STUDY_MASTER_ADMIN_TOKEN", "")
+# Porta dell'endpoint /metrics (Prometheus) e /metrics.jsonl; vuota = disattivato
+METRICS_PORT = os.environ.get("STUDY_MASTER_METRICS_PORT")
+
 def get_db_mode():
     """Rileva se usare Firebase (Cloud) o SQLite (Locale)"""
     if FIREBASE_AVAILABLE and "FIREBASE_CONFIG" in st.secrets:
         return "firestore"
     return "sqlite"
 
+@st.cache_resource(show_spinner=False)
 def get_firestore_client():
+    # Credenziali lette e client costruito una volta per processo
+    from google.oauth2 import service_account
+    from google.cloud import firestore
     key_dict = dict(st.secrets["FIREBASE_CONFIG"])
     creds = service_account.Credentials.from_service_account_info(key_dict)
     return firestore.Client(credentials=creds)
 
+@st.cache_resource(show_spinner=False)
+def get_sqlite_store():
+    # Pool di connessioni condiviso da tutte le sessioni (schema migrato all'avvio)
+    return storage.SQLiteStore(storage.DEFAULT_DB_PATH)
+
+@st.cache_resource(show_spinner=False)
+def get_firestore_store():
+    return storage.FirestoreStore(get_firestore_client())
+
+def get_store():
+    """Backend attivo: stessa interfaccia per SQLite e Firestore."""
+    if get_db_mode() == "firestore":
+        return get_firestore_store()
+    return get_sqlite_store()
+
+@st.cache_resource(show_spinner=False)
+def get_write_queue():
+    # Un solo writer di background per processo e per backend
+    return write_queue.WriteBehindQueue(get_store())
+
+@st.cache_resource(show_spinner=False)
+def start_metrics_server():
+    # Un solo endpoint per processo; Prometheus legge /metrics
+    if METRICS_PORT and metrics.ENABLED:
+        return metrics.start_http_server(int(METRICS_PORT))
+    return None
+
+def flush_pending_writes():
+    """Attende che i messaggi accodati siano sul DB (logout, reset, ricarica cronologia)."""
+    if not get_write_queue().flush():
+        st.warning("Salvataggio dei messaggi in ritardo: verranno scritti appena il database risponde.")
+
 def init_db():
-    mode = get_db_mode()
-    if mode == "sqlite":
-        conn = sqlite3.connect('study_master.db')
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS chat_history 
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, role TEXT, content TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-        conn.commit()
-        conn.close()
+    get_store()
 
 def hash_password(password):
     return hashlib.sha256(str.encode(password)).hexdigest()
 
 def register_user(username, password):
-    mode = get_db_mode()
-    pwd_hash = hash_password(password)
-    
-    if mode == "firestore":
-        db = get_firestore_client()
-        doc_ref = db.collection('users').document(username)
-        if doc_ref.get().exists:
-            return False
-        doc_ref.set({'password': pwd_hash})
-        return True
-    else:
-        conn = sqlite3.connect('study_master.db')
-        c = conn.cursor()
-        try:
-            c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, pwd_hash))
-            conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
-        finally:
-            conn.close()
+    return get_store().register_user(username, hash_password(password))
 
 def login_user(username, password):
-    mode = get_db_mode()
-    pwd_hash = hash_password(password)
-    
-    if mode == "firestore":
-        db = get_firestore_client()
-        doc = db.collection('users').document(username).get()
-        if doc.exists:
-            return doc.to_dict().get('password') == pwd_hash
-        return False
-    else:
-        conn = sqlite3.connect('study_master.db')
-        c = conn.cursor()
-        c.execute("SELECT * FROM users WHERE username = ? AND password = ?", (username, pwd_hash))
-        return c.fetchone() is not None
+    return get_store().check_user(username, hash_password(password))
 
 def save_message_to_db(username, role, content):
-    mode = get_db_mode()
-    
-    if mode == "firestore":
-        db = get_firestore_client()
-        db.collection('chat_history').add({
-            'username': username,
-            'role': role,
-            'content': content,
-            'timestamp': firestore.SERVER_TIMESTAMP
-        })
-    else:
-        conn = sqlite3.connect('study_master.db')
-        c = conn.cursor()
-        c.execute("INSERT INTO chat_history (username, role, content) VALUES (?, ?, ?)", (username, role, content))
-        conn.commit()
-        conn.close()
-
-def load_chat_history(username):
-    mode = get_db_mode()
-    messages = []
-    
-    if mode == "firestore":
-        db = get_firestore_client()
-        docs = db.collection('chat_history').where('username', '==', username).stream()
-        temp_msgs = []
-        for doc in docs:
-            d = doc.to_dict()
-            if d.get('timestamp'):
-                temp_msgs.append(d)
-        
-        # Ordina per data
-        temp_msgs.sort(key=lambda x: x['timestamp'] if x['timestamp'] else datetime.now())
-        
-        for msg in temp_msgs:
-            messages.append({"role": msg['role'], "content": msg['content']})
-    else:
-        conn = sqlite3.connect('study_master.db')
-        c = conn.cursor()
-        c.execute("SELECT role, content FROM chat_history WHERE username = ? ORDER BY timestamp ASC", (username,))
-        rows = c.fetchall()
-        conn.close()
-        messages = [{"role": row[0], "content": row[1]} for row in rows]
-        
-    return messages
+    # Write-behind: il salvataggio non sta sul percorso critico della risposta
+    with metrics.span("db_enqueue"):
+        get_write_queue().enqueue(username, role, content)
+
+def load_chat_history(username, limit=None, before=None):
+    """Pagina di cronologia (keyset): gli ultimi `limit` messaggi più vecchi del cursore `before`.
+
+    Ritorna (messaggi, cursore) con i messaggi in ordine cronologico; il cursore
+    serve a caricare la pagina precedente ed è None se non ce ne sono altre.
+    """
+    if before is None:
+        # La pagina più recente deve includere i messaggi ancora in coda
+        flush_pending_writes()
+    with metrics.span("history_load"):
+        return get_store().load_history_page(username, limit or HISTORY_PAGE_SIZE, before)
+
+def load_older_messages():
+    """Antepone alla sessione la pagina di cronologia precedente."""
+    older, cursor = load_chat_history(st.session_state.user_id, before=st.session_state.history_cursor)
+    st.session_state.messages = older + st.session_state.messages
+    st.session_state.history_cursor = cursor
+
+def reset_chat_state():
+    """Svuota la cronologia in sessione: verrà ricaricata dal DB alla prossima esecuzione."""
+    st.session_state.messages = []
+    for name in ("history_cursor", "history_loaded"):
+        if name in st.session_state:
+            del st.session_state[name]
 
 def clear_user_history(username):
-    mode = get_db_mode()
-    if mode == "firestore":
-        db = get_firestore_client()
-        docs = db.collection('chat_history').where('username', '==', username).stream()
-        for doc in docs:
-            doc.reference.delete()
-    else:
-        conn = sqlite3.connect('study_master.db')
-        c = conn.cursor()
-        c.execute("DELETE FROM chat_history WHERE username = ?", (username,))
-        conn.commit()
-        conn.close()
+    # Prima i messaggi in coda, altrimenti verrebbero scritti dopo la cancellazione
+    flush_pending_writes()
+    get_store().clear_history(username)
+    get_conversation_memory().forget(username)
 
 # --- 3. LOGICA AI ---
+# Parametri di indicizzazione, catena RAG e prompt stanno in pipeline.py (condivisi con batch.py)
+
+# Quiz e flashcard pre-generati per documento (STUDY_MASTER_PREGENERATE=0 per disattivarli)
+PREGENERATE = os.environ.get("STUDY_MASTER_PREGENERATE", "1") != "0"
+FLASHCARDS_PER_ANSWER = 10
+
+# Ogni quanti secondi la barra laterale aggiorna l'avanzamento delle indicizzazioni
+INDEX_POLL_SECONDS = 2
 
-@st.cache_resource(show_spinner=False)
 def get_local_embeddings():
-    # Usa un modello di embedding leggero per CPU
-    return HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+    # Una sola istanza per processo: se il riscaldamento la sta costruendo, si attende quella
+    return warmup.shared("embeddings", build_local_embeddings)
+
+def start_warmup(api_key=None):
+    """Dopo il login: import pesanti, modello di embedding e client LLM in background."""
+    warmup.start("models", [
+        ("imports", lambda: [warmup.import_module(name) for name in WARMUP_MODULES]),
+        # embed_query non passa dalla cache: esegue davvero il modello una volta
+        ("embeddings", lambda: get_local_embeddings().embed_query("riscaldamento")),
+    ])
+    if api_key:
+        key_id = hashlib.sha256(api_key.encode()).hexdigest()[:12]
+        warmup.start(f"llm-{key_id}", [
+            ("llm", lambda: [llm_clients.get_client(LLM_MODEL, t, api_key) for t in (0.1, 0.4, 0.5)]),
+        ])
+
+@st.cache_resource(show_spinner=False)
+def get_index_cache():
+    # Condivisa tra tutte le sessioni del processo (e tra processi via disco)
+    return index_cache.IndexCache()
+
+@st.cache_resource(show_spinner=False)
+def get_index_registry():
+    # Indici in sola lettura condivisi da tutte le sessioni, con budget di memoria;
+    # il modello di embedding serve solo al primo caricamento da disco
+    return index_registry.IndexRegistry(get_index_cache(), get_local_embeddings)
+
+@st.cache_resource(show_spinner=False)
+def get_indexer():
+    # Indicizzazione in background, a lotti (STUDY_MASTER_INDEX_BATCH chunk per lotto)
+    return progressive_index.ProgressiveIndexer(get_index_registry(), index_type=INDEX_TYPE)
+
+@st.cache_resource(show_spinner=False)
+def get_conversation_memory():
+    # Ultimi turni + riassunto progressivo salvato accanto alla cronologia
+    return conversation_memory.ConversationMemory(get_store())
+
+def get_memory(api_key=None):
+    """Memoria per la domanda appena aggiunta a st.session_state.messages (esclusa)."""
+    # Il riassunto dei turni usciti dalla finestra passa dallo scheduler come richiesta dell'utente
+    llm = llm_clients.get_llm(LLM_MODEL, 0.1, api_key, user=st.session_state.user_id) if api_key else None
+    with metrics.span("memory_build"):
+        return get_conversation_memory().build(st.session_state.user_id, st.session_state.messages[:-1], llm)
 
-def get_pdf_text(uploaded_file):
-    text = ""
+@st.cache_resource(show_spinner=False)
+def get_answer_cache():
+    # Condivisa tra le sessioni: studenti dello stesso corso fanno domande simili
+    return answer_cache.SemanticAnswerCache(get_local_embeddings())
+
+@st.cache_resource(show_spinner=False)
+def get_pregenerator():
+    # Quiz e flashcard per documento, generati in background dopo l'indicizzazione
+    return study_material.Pregenerator(study_material.MaterialStore())
+
+@st.cache_resource(show_spinner=False)
+def get_pdf_store():
+    # PDF della libreria, salvati una volta sola per contenuto
+    return library.PdfStore()
+
+def start_indexing(pdf_bytes, filename):
+    """Avvia (o riusa) l'indicizzazione del PDF in background; ritorna la chiave dell'indice.
+
+    Se l'indice è già in memoria o nella cache su disco è subito interrogabile,
+    altrimenti get_indexer().current(key) restituisce l'istantanea parziale.
+    """
+    key = get_document_key(pdf_bytes)
+    with metrics.span("index_load"):
+        job = get_indexer().ensure(key, filename, lambda: pdf_bytes, split_pages)
+    metrics.incr("index_cache_hits" if job is None else "index_cache_misses")
+    return key
+
+def get_pdf_pages(pdf_bytes, on_progress=None):
+    """Estrae le pagine in parallelo: lista di PageText (pagina, offset, testo)."""
     try:
-        pdf_reader = PdfReader(uploaded_file)
-        for page in pdf_reader.pages:
-            t = page.extract_text()
-            if t: text += t
+        return list(pdf_extract.iter_pages(pdf_bytes, on_progress=on_progress))
     except Exception as e:
         st.error(f"Errore lettura PDF: {e}")
         return None
-    return text
 
-def build_rag_chain(vectorstore):
-    # Aumentiamo k=6 per avere più contesto
-    retriever = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 6})
-    
-    # --- CONFIGURAZIONE MODELLO ---
-    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0.1) # Temperature bassa per fedeltà
-    
-    # Prompt STRICT MODE per vincolare al PDF
-    prompt_template = ChatPromptTemplate.from_messages([
-        ("system", """{system_instruction}
-        
-        SEI IN MODALITÀ "DOCUMENTO ATTIVO".
-        
-        REGOLE TASSATIVE (STRICT MODE):
-        1. DEVI rispondere alla domanda dell'utente BASANDOTI ESCLUSIVAMENTE sui seguenti estratti dal documento PDF fornito.
-        2. NON usare la tua conoscenza interna per rispondere a domande che non trovano riscontro nel testo.
-        3. Se l'informazione richiesta non è presente nel documento, DEVI RISPONDERE: "Mi dispiace, ma questa informazione non è presente nel documento PDF caricato." (Puoi suggerire di cercare online se rilevante, ma non inventare la risposta).
-        4. Cita il documento quando possibile per confermare le tue affermazioni.
-        
-        CONTESTO ESTRATTO DAL PDF:
-        {context}"""),
-        ("human", "{input}"),
-    ])
-    
-    qa_chain = create_stuff_documents_chain(llm, prompt_template)
-    return create_retrieval_chain(retriever, qa_chain)
+def get_pdf_text(pdf_bytes):
+    pages = get_pdf_pages(pdf_bytes)
+    if pages is None:
+        return None
+    return "".join(p.text for p in pages)
 
-def get_general_response(user_input, system_instruction):
+def build_rag_chain(documents, api_key=None):
+    """Catena RAG sui documenti attivi: lista di (doc_id, nome file, vectorstore)."""
     # --- CONFIGURAZIONE MODELLO ---
-    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0.5)
-    
-    messages = [
-        SystemMessage(content=system_instruction),
-        HumanMessage(content=user_input)
-    ]
-    response = llm.invoke(messages)
-    return response.content
-
-def get_system_instruction(mode, style, num_questions):
-    style_map = {
-        "Sintetico": "Sii estremamente conciso. Usa elenchi puntati.",
-        "Bilanciato": "Fornisci una risposta chiara e completa.",
-        "Esaustivo": "Spiega ogni dettaglio, includi contesto ed esempi."
-    }
-    style_text = style_map.get(style, "Rispondi normalmente.")
-
-    if mode == "💬 Chat / Spiegazione":
-        role = f"Sei un tutor universitario esperto. {style_text}"
-    elif mode == "❓ Simulazione Quiz":
-        role = (f"Sei un professore d'esame. Genera ORA {num_questions} domande difficili basate SOLO sul materiale fornito. "
-                "Numera le domande. NON dare le soluzioni.")
-    elif mode == "🃏 Flashcards":
-        role = f"Crea materiale di studio schematico basato SOLO sul testo. {style_text}. Formatta: **Termine** -> _Definizione_."
-    else:
-        role = "Sei un assistente utile."
-
-    return f"RUOLO: {role}"
+    llm = llm_clients.get_llm(LLM_MODEL, 0.1, api_key, user=st.session_state.user_id) # Temperature bassa per fedeltà
+    return pipeline.build_rag_chain(documents, llm)
+
+def get_rag_chain(documents, api_key=None):
+    """Catena RAG compilata una volta per selezione di documenti, non a ogni domanda."""
+    key = (tuple((doc_id, id(vs)) for doc_id, _, vs in documents), api_key)
+    if st.session_state.get("rag_chain_key") != key:
+        with metrics.span("rag_chain_build"):
+            st.session_state.rag_chain = build_rag_chain(documents, api_key)
+        st.session_state.rag_chain_key = key
+    return st.session_state.rag_chain
+
+# --- LIBRERIA DOCUMENTI ---
+
+def get_library():
+    """Documenti dell'utente (doc_id, filename), letti dal DB una volta per sessione."""
+    if "library_docs" not in st.session_state:
+        st.session_state.library_docs = get_store().list_documents(st.session_state.user_id)
+    return st.session_state.library_docs
+
+def add_to_library(pdf_bytes, filename):
+    """Salva il PDF (una copia per contenuto), lo aggiunge alla libreria e ne avvia l'indicizzazione.
+
+    I PDF senza testo vengono tolti dalla libreria a indicizzazione finita
+    (vedi close_failed_documents).
+    """
+    doc_id = library.document_id(pdf_bytes)
+    key = start_indexing(pdf_bytes, filename)
+    # Prima il riferimento, poi il blob: release() non cancella un PDF appena aggiunto
+    get_store().add_document(st.session_state.user_id, doc_id, filename)
+    get_pdf_store().put(pdf_bytes)
+    st.session_state.setdefault("open_stores", {})[doc_id] = key
+    st.session_state.pop("library_docs", None)
+    return doc_id
+
+def open_document(doc_id, filename):
+    """Apre un documento della libreria: indice dal registro o dalla cache, ricostruito solo se evitto.
+
+    Ritorna la chiave dell'indice (None se il PDF non è più disponibile).
+    """
+    pdf_bytes = get_pdf_store().get(doc_id)
+    if pdf_bytes is None:
+        return None
+    return start_indexing(pdf_bytes, filename)
+
+def get_active_documents():
+    """Documenti selezionati e aperti: lista di (doc_id, nome file, vectorstore).
+
+    La sessione tiene solo le chiavi: i vectorstore arrivano dal registro condiviso
+    (e vengono ricaricati se il registro li ha rilasciati per il budget di memoria).
+    Durante l'indicizzazione il vectorstore è l'ultima istantanea parziale
+    (attributo `partial`); i documenti senza ancora un lotto pronto mancano.
+    """
+    names = {d["doc_id"]: d["filename"] for d in get_library()}
+    open_stores = st.session_state.get("open_stores", {})
+    indexer = get_indexer()
+    documents = []
+    for doc_id in st.session_state.get("active_docs", []):
+        if doc_id not in open_stores:
+            continue
+        key = open_stores[doc_id]
+        vectorstore = indexer.current(key)
+        # Nessun job: l'indice è uscito da registro e cache, si ricostruisce
+        if vectorstore is None and indexer.job(key) is None and open_document(doc_id, names.get(doc_id, "Doc")) is not None:
+            vectorstore = indexer.current(key)
+        if vectorstore is not None:
+            documents.append((doc_id, names.get(doc_id, "Doc"), vectorstore))
+    return documents
+
+def get_indexing_jobs():
+    """Indicizzazioni in corso dei documenti attivi: (nome file, job, già interrogabile)."""
+    open_stores = st.session_state.get("open_stores", {})
+    indexer = get_indexer()
+    jobs = []
+    for doc_id in st.session_state.get("active_docs", []):
+        job = indexer.job(open_stores.get(doc_id))
+        if job is not None and job.active():
+            jobs.append((job.filename, job, job.vectorstore is not None))
+    return jobs
+
+def close_failed_documents():
+    """Chiude i documenti la cui indicizzazione è fallita; quelli senza testo escono dalla libreria.
+
+    Va chiamata prima del widget di selezione. Ritorna [(nome file, job)] da
+    segnalare; riselezionare un documento fallito ne riavvia l'indicizzazione.
+    """
+    open_stores = st.session_state.get("open_stores", {})
+    indexer = get_indexer()
+    failed = []
+    for doc_id, key in list(open_stores.items()):
+        job = indexer.job(key)
+        if job is None or job.state not in ("empty", "error"):
+            continue
+        del open_stores[doc_id]
+        st.session_state.active_docs = [d for d in st.session_state.get("active_docs", []) if d != doc_id]
+        if job.state == "empty":
+            get_store().remove_document(st.session_state.user_id, doc_id)
+            release_pdf(doc_id)
+            st.session_state.pop("library_docs", None)
+        failed.append((job.filename, job))
+    return failed
+
+def get_active_index_keys():
+    open_stores = st.session_state.get("open_stores", {})
+    return tuple(sorted(open_stores[doc_id] for doc_id in st.session_state.get("active_docs", [])
+                        if doc_id in open_stores))
+
+def close_document():
+    """Chiude i documenti attivi (restano in libreria) e invalida la catena compilata."""
+    st.session_state.active_docs = []
+    for name in ("open_stores", "rag_chain", "rag_chain_key"):
+        if name in st.session_state:
+            del st.session_state[name]
+
+def ensure_study_material(documents, api_key):
+    """Avvia la pre-generazione di quiz e flashcard per i documenti che non li hanno ancora."""
+    if not PREGENERATE or not api_key:
+        return
+    pregenerator = get_pregenerator()
+    pdf_store = get_pdf_store()
+    # Un solo "utente" per i job di background: nella coda equa non superano gli studenti
+    llm = llm_clients.get_llm(LLM_MODEL, 0.4, api_key, user="pregen")
+    for doc_id, filename, vectorstore in documents:
+        if getattr(vectorstore, "partial", False):
+            continue
+        # Le pagine si estraggono sul thread del job, non durante il rerun
+        load_pages = lambda doc_id=doc_id: list(pdf_extract.iter_pages(pdf_store.get(doc_id) or b""))
+        pregenerator.ensure(doc_id, filename, load_pages, llm)
+
+def get_study_material(documents):
+    """Materiale pre-generato dei documenti attivi, oppure None se non è pronto per tutti."""
+    store = get_pregenerator().store
+    materials = [store.get(doc_id) for doc_id, _, _ in documents]
+    if not materials or any(m is None for m in materials):
+        return None
+    return materials
+
+def pregenerated_answer(materials, mode, num_questions, user_input, style):
+    """Risposta immediata campionata dal materiale pre-generato (None se non basta).
+
+    Le richieste su pagine o argomenti precisi usano solo gli elementi che
+    corrispondono; le flashcard pre-generate hanno lo stile "Bilanciato".
+    """
+    keep = study_material.request_matcher(user_input)
+    if mode == "❓ Simulazione Quiz":
+        items = study_material.sample(materials, "quiz", num_questions, keep=keep)
+        if len(items) < num_questions:
+            return None
+        return study_material.format_quiz(items)
+    if mode == "🃏 Flashcards" and style == "Bilanciato":
+        items = study_material.sample(materials, "flashcards", FLASHCARDS_PER_ANSWER, keep=keep)
+        return study_material.format_flashcards(items) if items else None
+    return None
+
+def release_pdf(doc_id):
+    """Cancella il PDF condiviso se nessun utente lo ha più in libreria."""
+    get_pdf_store().release(doc_id, get_store().document_in_use)
+
+def remove_from_library(doc_id):
+    get_store().remove_document(st.session_state.user_id, doc_id)
+    release_pdf(doc_id)
+    st.session_state.active_docs = [d for d in st.session_state.get("active_docs", []) if d != doc_id]
+    st.session_state.get("open_stores", {}).pop(doc_id, None)
+    st.session_state.pop("library_docs", None)
+
+def stream_general_response(user_input, system_instruction, api_key=None, memory=None):
+    """Risposta in modalità generale, generata a pezzi man mano che arriva."""
+    llm = llm_clients.get_llm(LLM_MODEL, 0.5, api_key, user=st.session_state.user_id)
+    yield from pipeline.stream_general(llm, pipeline.general_messages(user_input, system_instruction, memory))
+
+def stream_rag_response(documents, user_input, system_instruction, api_key=None, packing=None, memory=None):
+    """Risposta RAG in streaming: genera solo i pezzi della chiave 'answer'.
+
+    Se `packing` è un dizionario, viene riempito con le statistiche di
+    assemblaggio del contesto (token prima/dopo, token risparmiati).
+    """
+    rag_chain = get_rag_chain(documents, api_key)
+    yield from pipeline.stream_rag(rag_chain, pipeline.rag_inputs(user_input, system_instruction, memory), packing)
+
+def render_stream(chunks, placeholder, result):
+    """Scrive i pezzi nel placeholder man mano che arrivano.
+
+    `result` viene aggiornato durante lo stream (answer, ttft, total), così
+    il testo parziale resta disponibile anche se lo stream si interrompe.
+    """
+    start = time.perf_counter()
+    result.update(answer="", ttft=None, total=None)
+    try:
+        for chunk in chunks:
+            if result["ttft"] is None:
+                result["ttft"] = time.perf_counter() - start
+            result["answer"] += chunk
+            placeholder.markdown(result["answer"] + "▌")
+    finally:
+        result["total"] = time.perf_counter() - start
+        placeholder.markdown(result["answer"])
+
+def record_latency(result, pdf_mode):
+    """Tiene le latenze delle ultime risposte della sessione."""
+    log = st.session_state.setdefault("latency_log", [])
+    log.append({
+        "pdf_mode": pdf_mode,
+        "cached": result.get("cached", False),
+        "ttft": result["ttft"],
+        "total": result["total"],
+        "chars": len(result["answer"]),
+        "context_tokens": result.get("packing", {}).get("tokens_out"),
+        "tokens_saved": result.get("packing", {}).get("tokens_saved"),
+        "memory_tokens": result.get("memory_tokens"),
+    })
+    del log[:-50]
+
+@st.cache_data(show_spinner=False, max_entries=512)
+def render_history_block(messages):
+    """Markdown di un blocco di messaggi vecchi, calcolato una volta e riusato a ogni rerun."""
+    parts = []
+    for role, content in messages:
+        avatar = "🧑‍🎓" if role == "user" else "🤖"
+        parts.append(f"{avatar} {content}")
+    return "\n\n---\n\n".join(parts)
+
+def describe_job(job):
+    if job.state in ("queued", "extracting"):
+        total = job.pages_total or "?"
+        return f"estrazione pagine {job.pages_done}/{total}" if job.state == "extracting" else "in coda"
+    if job.state == "indexing":
+        covered = f" · interrogabile fino a pag. {job.last_page}" if job.last_page else ""
+        return f"{job.chunks_done}/{job.chunks_total} chunk{covered}"
+    return "costruzione indice finale"
+
+@st.fragment(run_every=INDEX_POLL_SECONDS)
+def render_indexing_progress(jobs):
+    """Avanzamento delle indicizzazioni (nome file, job, interrogabile al rerun completo).
+
+    Ricarica la pagina quando un documento diventa interrogabile o finisce,
+    così la chat passa alla prima istantanea o all'indice completo.
+    """
+    for filename, job, _ in jobs:
+        st.progress(job.progress(), text=f"⏳ {filename}: {describe_job(job)}")
+    changed = any(not job.active() or (job.vectorstore is not None and not queryable)
+                  for _, job, queryable in jobs)
+    # Con una risposta in corso si aspetta il rerun di fine risposta
+    if changed and not st.session_state.processing:
+        st.rerun()
 
 # --- HELPER PER BLOCCARE LA UI ---
 def lock_ui():
@@ -256,6 +538,7 @@ def lock_ui():
 
 def main():
     init_db()
+    start_metrics_server()
     
     # Inizializza stato elaborazione
     if "processing" not in st.session_state:
@@ -306,6 +589,9 @@ def main():
         return
 
     # --- APP DOPO LOGIN ---
+
+    # Modello di embedding e import pesanti in background, mentre la sidebar si disegna
+    start_warmup()
     
     # Variabile di stato per disabilitare i controlli durante l'elaborazione AI
     is_locked = st.session_state.processing
@@ -314,9 +600,12 @@ def main():
     with st.sidebar:
         st.write(f"👤 Utente: **{st.session_state.user_id}**")
         if st.button("Logout", disabled=is_locked, use_container_width=True):
+            flush_pending_writes()
             st.session_state.user_id = None
-            st.session_state.messages = []
-            if "vectorstore" in st.session_state: del st.session_state.vectorstore
+            st.session_state.pop("admin_verified", None)
+            reset_chat_state()
+            close_document()
+            st.session_state.pop("library_docs", None)
             st.rerun()
         
         st.markdown("---")
@@ -324,41 +613,137 @@ def main():
         # === SEZIONE DOCUMENTI (Ancorata qui per essere sempre visibile) ===
         st.header("📂 Documenti")
         
-        pdf_mode = False # Default
+        # Documento appena caricato: va attivato prima di creare il widget di selezione
+        if "activate_doc" in st.session_state:
+            st.session_state.active_docs = st.session_state.get("active_docs", []) + [st.session_state.pop("activate_doc")]
+
+        for filename, job in close_failed_documents():
+            if job.state == "empty":
+                st.error(f"**{filename}** sembra vuoto o non leggibile: rimosso dalla libreria.")
+            else:
+                st.error(f"Indicizzazione di **{filename}** non riuscita: {job.error}. Riselezionalo per riprovare.")
+
+        library_docs = get_library()
+        names = {d["doc_id"]: d["filename"] for d in library_docs}
+        st.session_state.active_docs = [d for d in st.session_state.get("active_docs", []) if d in names]
+
+        if library_docs:
+            st.multiselect("📚 La tua libreria", options=list(names), format_func=names.get,
+                           key="active_docs", disabled=is_locked,
+                           help="Seleziona uno o più documenti da interrogare insieme.")
+
+        # Apre gli indici dei documenti selezionati (dalla cache su disco, senza re-upload)
+        open_stores = st.session_state.setdefault("open_stores", {})
+        for doc_id in list(open_stores):
+            if doc_id not in st.session_state.active_docs:
+                del open_stores[doc_id]
+        for doc_id in st.session_state.active_docs:
+            if doc_id not in open_stores:
+                with st.spinner(f"Apertura {names[doc_id]}..."):
+                    opened = open_document(doc_id, names[doc_id])
+                if opened is None:
+                    st.warning(f"**{names[doc_id]}** non è più disponibile: ricaricalo.")
+                else:
+                    open_stores[doc_id] = opened
+
+        active_documents = get_active_documents()
+        pdf_mode = bool(active_documents)
+
+        if pdf_mode:
+            st.success("Attivi: " + ", ".join(
+                f"**{name}**" + (" (in indicizzazione)" if getattr(vs, "partial", False) else "")
+                for _, name, vs in active_documents))
+            st.button("❌ Chiudi File", on_click=close_document, disabled=is_locked, use_container_width=True)
+
+        # La chat resta utilizzabile: le domande usano le pagine già indicizzate
+        indexing_jobs = get_indexing_jobs()
+        if indexing_jobs:
+            render_indexing_progress(indexing_jobs)
+
+        if library_docs:
+            with st.expander("Gestisci libreria"):
+                to_remove = st.selectbox("Documento", options=list(names), format_func=names.get, disabled=is_locked)
+                st.button("🗑️ Rimuovi dalla libreria", on_click=remove_from_library, args=(to_remove,),
+                          disabled=is_locked or to_remove is None, use_container_width=True)
+
+        with st.expander("🧠 Indici in memoria"):
+            registry = get_index_registry()
+            rows = registry.stats()
+            if rows:
+                st.caption(f"Totale stimato: {registry.total_bytes() / 2**20:.1f} MB "
+                           f"su {registry.max_bytes / 2**20:.0f} MB di budget")
+                st.dataframe(rows, hide_index=True, use_container_width=True)
+            else:
+                st.caption("Nessun indice caricato in questo processo.")
+            jobs = get_indexer().stats()
+            if jobs:
+                st.caption(f"Indicizzazioni (lotti da {get_indexer().batch_size} chunk)")
+                st.dataframe(jobs, hide_index=True, use_container_width=True)
+
+        if st.session_state.user_id in ADMIN_USERS:
+            with st.expander("📈 Metriche (admin)"):
+                if not ADMIN_TOKEN:
+                    st.caption("Pannello disattivato: imposta STUDY_MASTER_ADMIN_TOKEN.")
+                elif not st.session_state.get("admin_verified"):
+                    token = st.text_input("Token admin", type="password", key="admin_token")
+                    if token:
+                        if hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+                            st.session_state.admin_verified = True
+                            st.rerun()
+                        else:
+                            st.error("Token non valido.")
+                elif not metrics.ENABLED:
+                    st.caption("Strumentazione disattivata (STUDY_MASTER_METRICS=0).")
+                else:
+                    rows = metrics.REGISTRY.summary()
+                    if rows:
+                        st.dataframe(rows, hide_index=True, use_container_width=True)
+                    else:
+                        st.caption("Nessuna misura ancora registrata.")
+                    counters = {**metrics.REGISTRY.counters(), **metrics.REGISTRY.gauges()}
+                    if counters:
+                        st.dataframe([{"contatore": k, "valore": v} for k, v in counters.items()],
+                                     hide_index=True, use_container_width=True)
+                    st.download_button("Esporta Prometheus", metrics.REGISTRY.prometheus_text(),
+                                       file_name="metrics.prom", use_container_width=True)
+                    scheduler = llm_scheduler.SCHEDULER.stats()
+                    st.caption(f"Scheduler LLM: {scheduler['in_flight']} richieste in volo, "
+                               f"{scheduler['coalesced']} unite, {scheduler['retried']} ritentate")
+                    if scheduler["keys"]:
+                        st.dataframe(scheduler["keys"], hide_index=True, use_container_width=True)
+                    st.caption("Riscaldamento in background")
+                    st.json(warmup.status(), expanded=False)
+                    st.download_button("Esporta JSONL", metrics.REGISTRY.jsonl_snapshot(),
+                                       file_name="metrics.jsonl", use_container_width=True)
+
+        # Token risparmiati dall'assemblaggio del contesto nell'ultima risposta sui documenti
+        packed = [e for e in st.session_state.get("latency_log", []) if e.get("context_tokens") is not None]
+        if packed:
+            last = packed[-1]
+            st.caption(f"✂️ Contesto: {last['context_tokens']} token inviati, "
+                       f"{last['tokens_saved']} risparmiati "
+                       f"({sum(e['tokens_saved'] for e in packed)} nella sessione)")
+        remembered = [e for e in st.session_state.get("latency_log", []) if e.get("memory_tokens") is not None]
+        if remembered:
+            st.caption(f"🧠 Memoria: {remembered[-1]['memory_tokens']} token di conversazione "
+                       f"(max {get_conversation_memory().max_tokens})")
+
+        # Uploader sempre visibile: aggiunge un documento alla libreria
+        uploader_key = f"uploader_{st.session_state.get('uploader_version', 0)}"
+        uploaded_file = st.file_uploader("Carica PDF", type="pdf", disabled=is_locked, label_visibility="visible", key=uploader_key)
         
-        # Logica: Mostra File Attivo O Uploader
-        if "vectorstore" in st.session_state and st.session_state.vectorstore is not None:
-            pdf_mode = True
-            st.success(f"Attivo: **{st.session_state.get('current_filename', 'Doc')}**")
-            
-            if st.button("❌ Chiudi File", disabled=is_locked, use_container_width=True):
-                del st.session_state.vectorstore
-                if "current_filename" in st.session_state: del st.session_state.current_filename
+        if uploaded_file and not is_locked:
+            try:
+                # Solo salvataggio e avvio del job: estrazione ed embedding proseguono in background
+                with metrics.span("upload"):
+                    doc_id = add_to_library(uploaded_file.getvalue(), uploaded_file.name)
+                if doc_id not in st.session_state.active_docs:
+                    st.session_state.activate_doc = doc_id
+                # Nuova chiave: svuota l'uploader, così il file non viene rielaborato al prossimo rerun
+                st.session_state.uploader_version = st.session_state.get("uploader_version", 0) + 1
                 st.rerun()
-        else:
-            # Uploader sempre visibile se nessun file è caricato
-            uploaded_file = st.file_uploader("Carica PDF", type="pdf", disabled=is_locked, label_visibility="visible")
-            
-            if uploaded_file and not is_locked:
-                with st.status("⚙️ Indicizzazione PDF...", expanded=True) as status:
-                    try:
-                        raw_text = get_pdf_text(uploaded_file)
-                        if raw_text:
-                            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-                            chunks = text_splitter.split_text(raw_text)
-                            docs = [Document(page_content=t) for t in chunks]
-                            embeddings = get_local_embeddings()
-                            st.session_state.vectorstore = FAISS.from_documents(docs, embeddings)
-                            st.session_state.current_filename = uploaded_file.name
-                            status.update(label="✅ Completato!", state="complete")
-                            time.sleep(1)
-                            st.rerun()
-                        else: 
-                            status.update(label="❌ PDF Vuoto", state="error")
-                            st.error("Il PDF sembra vuoto o non leggibile.")
-                    except Exception as e:
-                        status.update(label="❌ Errore", state="error")
-                        st.error(f"Errore: {e}")
+            except Exception as e:
+                st.error(f"Errore: {e}")
 
         st.markdown("---")
         st.header("⚙️ Studio")
@@ -369,6 +754,8 @@ def main():
             # st.success("✅ API Key Cloud Attiva") # Meno rumore visivo
         else:
             api_key = st.text_input("🔑 Google API Key", type="password", disabled=is_locked)
+        # Client LLM pronto prima della prima domanda
+        start_warmup(api_key)
 
         if "study_mode" not in st.session_state: st.session_state.study_mode = "💬 Chat / Spiegazione"
         if "response_style" not in st.session_state: st.session_state.response_style = "Bilanciato"
@@ -392,35 +779,67 @@ def main():
             st.session_state.num_questions = st.slider(
                 "N. Domande:", 5, 20, st.session_state.num_questions, disabled=is_locked
             )
+
+        if pdf_mode and PREGENERATE and api_key:
+            ensure_study_material(active_documents, api_key)
+            if st.session_state.study_mode != "💬 Chat / Spiegazione":
+                st.checkbox("⚡ Usa quiz e flashcard pre-generati", value=True, key="use_pregenerated",
+                            disabled=is_locked,
+                            help="Risposta immediata con domande da tutto il documento, preparate in background.")
+                pending = [get_pregenerator().status(doc_id) for doc_id, _, _ in active_documents]
+                running = [job for job in pending if job is not None and job != "complete" and job.state == "running"]
+                if running:
+                    done = sum(job.done for job in running)
+                    total = sum(job.total for job in running)
+                    st.caption(f"⏳ Preparazione quiz: {done}/{total or '?'} sezioni")
+                elif all(job == "complete" for job in pending):
+                    st.caption("⚡ Quiz e flashcard pronti")
         
         st.markdown("---")
         if st.button("🗑️ Reset Chat", disabled=is_locked, use_container_width=True):
             clear_user_history(st.session_state.user_id)
-            st.session_state.messages = []
+            reset_chat_state()
             st.rerun()
 
     if not api_key:
         st.info("👈 Configura la chiave API nel menu laterale per iniziare.")
         return
     
-    os.environ["GOOGLE_API_KEY"] = api_key
+    # La chiave viene passata esplicitamente ai client (niente os.environ condiviso tra sessioni)
 
     # --- CHAT UI ---
     
     system_instr = get_system_instruction(st.session_state.study_mode, st.session_state.response_style, st.session_state.num_questions)
     
-    if "messages" not in st.session_state or len(st.session_state.messages) == 0:
-         st.session_state.messages = load_chat_history(st.session_state.user_id)
+    # Solo l'ultima pagina di cronologia: le precedenti si caricano su richiesta
+    if not st.session_state.get("history_loaded"):
+        st.session_state.messages, st.session_state.history_cursor = load_chat_history(st.session_state.user_id)
+        st.session_state.history_loaded = True
 
     chat_container = st.container()
     with chat_container:
         if not st.session_state.messages:
             if pdf_mode:
-                st.info(f"📂 **{st.session_state.get('current_filename')}** attivo.\n\nFai una domanda specifica sul contenuto del documento.")
+                active_names = ", ".join(f"**{name}**" for _, name, _ in active_documents)
+                st.info(f"📂 {active_names} attivo.\n\nFai una domanda specifica sul contenuto del documento.")
             else:
                 st.info("👋 Ciao! Sono il tuo Tutor. Carica un PDF dalla barra laterale per domande specifiche, o chiedimi qualsiasi cosa per iniziare.")
 
-        for message in st.session_state.messages:
+        messages = st.session_state.messages
+        older = messages[:-CHAT_WINDOW] if len(messages) > CHAT_WINDOW else []
+        recent = messages[len(older):]
+
+        if st.session_state.history_cursor is not None:
+            st.button("⬆️ Carica messaggi precedenti", on_click=load_older_messages,
+                      disabled=is_locked, use_container_width=True)
+
+        if older:
+            with st.expander(f"🕘 {len(older)} messaggi precedenti"):
+                for i in range(0, len(older), HISTORY_BLOCK_SIZE):
+                    block = older[i:i + HISTORY_BLOCK_SIZE]
+                    st.markdown(render_history_block(tuple((m["role"], m["content"]) for m in block)))
+
+        for message in recent:
             avatar = "🧑‍🎓" if message["role"] == "user" else "🤖"
             with st.chat_message(message["role"], avatar=avatar):
                 st.markdown(message["content"])
@@ -436,31 +855,81 @@ def main():
         with chat_container.chat_message("user", avatar="🧑‍🎓"):
             st.markdown(user_input)
 
-        # 2. Genera risposta AI
+        # 2. Genera risposta AI (in streaming)
         with chat_container.chat_message("assistant", avatar="🤖"):
-            with st.spinner("Sto elaborando..."):
-                try:
+            answer_placeholder = st.empty()
+            answer_placeholder.markdown("⏳ _Sto elaborando..._")
+            result = {"answer": ""}
+            try:
+                cache = get_answer_cache()
+                cache_group = cache.group_key(get_active_index_keys() if pdf_mode else None,
+                                              st.session_state.response_style)
+                # Quiz e flashcard devono cambiare a ogni richiesta: in cache solo la chat
+                cacheable = st.session_state.study_mode == "💬 Chat / Spiegazione"
+                pooled = None
+                if (pdf_mode and st.session_state.get("use_pregenerated", True)
+                        and st.session_state.study_mode != "💬 Chat / Spiegazione"):
+                    materials = get_study_material(active_documents)
+                    if materials:
+                        pooled = pregenerated_answer(materials, st.session_state.study_mode,
+                                                     st.session_state.num_questions, user_input,
+                                                     st.session_state.response_style)
+                if pooled is not None:
+                    # Campione dal materiale del documento (o delle pagine/argomento chiesti): niente LLM
+                    metrics.incr("pregenerated_answers")
+                    cached_answer, question_vector = pooled, None
+                else:
+                    memory = get_memory(api_key)
+                    # Solo una domanda di seguito dipende dai turni precedenti: le altre
+                    # restano autonome e usano la cache semantica condivisa
+                    cacheable = cacheable and not (conversation_memory.is_followup(user_input)
+                                                   and (memory.summary or memory.messages))
+                    if cacheable:
+                        with metrics.span("answer_cache_lookup"):
+                            cached_answer, question_vector = cache.lookup(cache_group, user_input)
+                    else:
+                        cached_answer, question_vector = None, None
+                metrics.incr("answer_cache_hits" if cached_answer is not None else "answer_cache_misses")
+                if cached_answer is not None:
+                    # Domanda quasi identica già risposta su questo documento
+                    result.update(answer=cached_answer, ttft=0.0, total=0.0, cached=True)
+                    answer_placeholder.markdown(cached_answer)
+                else:
+                    result["memory_tokens"] = memory.tokens
                     if pdf_mode:
-                        rag_chain = build_rag_chain(st.session_state.vectorstore)
-                        response = rag_chain.invoke({
-                            "input": user_input,
-                            "system_instruction": system_instr
-                        })
-                        answer = response['answer']
+                        result["packing"] = {}
+                        chunks = stream_rag_response(active_documents, user_input, system_instr, api_key,
+                                                     packing=result["packing"], memory=memory)
                     else:
-                        answer = get_general_response(user_input, system_instr)
-                    
-                    st.markdown(answer)
-                    save_message_to_db(st.session_state.user_id, "assistant", answer)
-                    st.session_state.messages.append({"role": "assistant", "content": answer})
-                
-                except Exception as e:
-                    st.error(f"Errore: {e}")
-                
-                finally:
-                    # Al termine (successo o errore), sblocca e ricarica
-                    st.session_state.processing = False
-                    st.rerun()
+                        chunks = stream_general_response(user_input, system_instr, api_key, memory=memory)
+                    stage = "llm_rag" if pdf_mode else "llm_general"
+                    try:
+                        render_stream(chunks, answer_placeholder, result)
+                    finally:
+                        metrics.observe(f"{stage}_ttft", result.get("ttft"))
+                        metrics.observe(stage, result.get("total"))
+                        metrics.incr("answer_tokens", context_packing.estimate_tokens(result["answer"]))
+                        metrics.incr("memory_tokens", memory.tokens)
+                    # Le risposte su un indice ancora parziale non valgono per quello completo
+                    partial = any(getattr(vs, "partial", False) for _, _, vs in active_documents)
+                    if result["answer"] and cacheable and not partial:
+                        cache.store(cache_group, user_input, result["answer"], question_vector)
+
+            except Exception as e:
+                metrics.incr("errors", stage="chat")
+                st.error(f"Errore: {e}")
+                if result["answer"]:
+                    result["answer"] += "\n\n_⚠️ Risposta interrotta._"
+
+            finally:
+                # Salva anche la risposta parziale: quanto già mostrato non va perso
+                if result["answer"]:
+                    save_message_to_db(st.session_state.user_id, "assistant", result["answer"])
+                    st.session_state.messages.append({"role": "assistant", "content": result["answer"]})
+                    record_latency(result, pdf_mode)
+                # Al termine (successo o errore), sblocca e ricarica
+                st.session_state.processing = False
+                st.rerun()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,345 @@
+# batch.py
+# Modalità batch, senza Streamlit.
+#
+# Indicizza in parallelo una cartella di PDF nella stessa cache di indici
+# dell'app (di notte si possono preparare gli indici di un corso), poi fa
+# rispondere un file JSONL di domande su un pool limitato di thread e scrive
+# i risultati in JSONL man mano che arrivano. Alla fine stampa throughput e
+# latenze. Con --fake-llm e --fake-embeddings gira senza rete né modelli
+# (test di carico della pipeline); con --fake-embeddings indici, PDF e
+# materiale vanno in una cache temporanea, non in quella dell'app.
+#
+#   python batch.py --pdf-dir dispense/ --index-only
+#   python batch.py --pdf-dir dispense/ --questions domande.jsonl --out risposte.jsonl
+#   python batch.py --pdf-dir dispense/ --questions domande.jsonl --fake-llm --fake-embeddings
+#   python batch.py --pdf-dir dispense/ --index-only --cache-dir /tmp/cache-corso
+#
+# Una riga di domande:
+#   {"id": "q1", "question": "...", "mode": "chat|quiz|flashcards", "style": "Sintetico",
+#    "num_questions": 5, "docs": ["capitolo1.pdf"]}
+# Senza "docs" si interrogano tutti i PDF indicizzati; con "docs": [] si risponde senza documenti.
+# Ogni riga produce una riga di risultati: quelle non valide con il campo "error".
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import pipeline
+import warmup
+
+index_cache = warmup.lazy_module("index_cache")
+index_registry = warmup.lazy_module("index_registry")
+progressive_index = warmup.lazy_module("progressive_index")
+embedding_cache = warmup.lazy_module("embedding_cache")
+library = warmup.lazy_module("library")
+pdf_extract = warmup.lazy_module("pdf_extract")
+llm_clients = warmup.lazy_module("llm_clients")
+study_material = warmup.lazy_module("study_material")
+
+FAKE_EMBEDDING_MODEL = "fake-hash"
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _percentiles(samples):
+    """p50/p95/max in millisecondi (None se non ci sono campioni)."""
+    samples = sorted(s for s in samples if s is not None)
+    if not samples:
+        return None
+    return {
+        "p50_ms": round(samples[len(samples) // 2] * 1000, 1),
+        "p95_ms": round(samples[int(len(samples) * 0.95)] * 1000, 1),
+        "max_ms": round(samples[-1] * 1000, 1),
+    }
+
+
+def _cache_path(root, name, default):
+    """`name` sotto la radice di cache scelta, altrimenti il percorso predefinito dell'app."""
+    return os.path.join(root, name) if root else default
+
+
+def load_embeddings(fake=False, root=None):
+    """(embeddings con cache, nome del modello per la chiave degli indici)."""
+    db_path = _cache_path(root, "embeddings.sqlite", embedding_cache.DEFAULT_DB_PATH)
+    if fake:
+        import benchmarks
+        embeddings = embedding_cache.CachedEmbeddings(benchmarks.FakeEmbeddings(), FAKE_EMBEDDING_MODEL,
+                                                      db_path=db_path)
+        return embeddings, FAKE_EMBEDDING_MODEL
+    return pipeline.build_local_embeddings(db_path), pipeline.EMBEDDING_MODEL
+
+
+def make_llm_factory(fake=False, api_key=None, ttft=0.05, token_delay=0.002):
+    """Funzione temperatura -> modello di chat: Gemini tramite lo scheduler, oppure il modello finto."""
+    if fake:
+        import benchmarks
+        model = benchmarks.FakeChatModel(ttft=ttft, token_delay=token_delay)
+        return lambda temperature: model
+    if not api_key:
+        raise SystemExit("GOOGLE_API_KEY non impostata: usa --fake-llm o esporta la chiave.")
+    return lambda temperature: llm_clients.get_llm(pipeline.LLM_MODEL, temperature, api_key, user="batch")
+
+
+# --- INGESTIONE ---
+
+def ingest(paths, registry, embedding_model, workers, user=None, root=None):
+    """Indicizza i PDF in parallelo (o li trova già in cache).
+
+    Ritorna una riga per file: nome, doc_id, chiave dell'indice, stato, chunk, secondi.
+    """
+    indexer = progressive_index.ProgressiveIndexer(
+        # Nessuna istantanea parziale: in batch conta solo l'indice finale
+        registry, batch_size=sys.maxsize, index_type=pipeline.INDEX_TYPE, workers=workers)
+    pdf_store = store = None
+    if user:
+        import storage
+        store = storage.SQLiteStore(_cache_path(root, "study_master.db", storage.DEFAULT_DB_PATH))
+        pdf_store = library.PdfStore(_cache_path(root, "pdfs", library.DEFAULT_PDF_DIR))
+
+    pending = []
+    for path in paths:
+        pdf_bytes = _read(path)
+        filename = os.path.basename(path)
+        doc_id = library.document_id(pdf_bytes)
+        key = pipeline.get_document_key(pdf_bytes, embedding_model=embedding_model)
+        # I byte vengono riletti dal worker: in memoria resta un PDF per worker, non la cartella intera
+        job = indexer.ensure(key, filename, lambda path=path: _read(path), pipeline.split_pages)
+        pending.append((path, filename, doc_id, key, job))
+
+    rows = []
+    for path, filename, doc_id, key, job in pending:
+        row = {"file": filename, "doc_id": doc_id, "key": key}
+        if job is None:
+            row.update(state="cached", chunks=None, seconds=0.0)
+        else:
+            job.wait()
+            row.update(state=job.state, chunks=job.chunks_total, seconds=round(job.finished - job.started, 3),
+                       embedded=job.embed_stats.embedded, error=job.error)
+        if store is not None and row["state"] in ("cached", "complete"):
+            # Il PDF resta nella cartella condivisa solo se entra in una libreria
+            store.add_document(user, doc_id, filename)
+            pdf_store.put(_read(path))
+        row["path"] = path
+        rows.append(row)
+    return rows
+
+
+def pregenerate(rows, llm, workers, root=None):
+    """Quiz e flashcard per ogni documento indicizzato (stessa cartella di materiale dell'app)."""
+    material = study_material.MaterialStore(_cache_path(root, "study_material", study_material.DEFAULT_DIR))
+    pregenerator = study_material.Pregenerator(material, workers=workers)
+    jobs = {}
+    for row in rows:
+        if row["state"] in ("cached", "complete"):
+            load_pages = lambda path=row["path"]: list(pdf_extract.iter_pages(_read(path)))
+            jobs[row["doc_id"]] = pregenerator.ensure(row["doc_id"], row["file"], load_pages, llm)
+    while any(job is not None and job.state == "running" for job in jobs.values()):
+        time.sleep(0.2)
+    return {doc_id: (job.state if job is not None else "cached") for doc_id, job in jobs.items()}
+
+
+# --- DOMANDE ---
+
+class QuestionRunner:
+    """Risponde alle domande su un pool di `concurrency` thread; le catene RAG sono condivise."""
+
+    def __init__(self, documents, llm_factory, concurrency):
+        self.documents = documents          # nome file -> (doc_id, nome file, vectorstore)
+        self.llm_factory = llm_factory
+        self.concurrency = concurrency
+        self._chains = {}
+        self._lock = threading.Lock()
+
+    def _chain(self, names):
+        with self._lock:
+            chain = self._chains.get(names)
+            if chain is None:
+                stores = [self.documents[name] for name in names]
+                chain = self._chains[names] = pipeline.build_rag_chain(stores, self.llm_factory(0.1))
+            return chain
+
+    def answer(self, item, line_id=None):
+        """Risultato per una riga del file; `item` è il JSON letto (None se la riga non è JSON valido).
+
+        Non solleva mai: ogni problema della riga finisce nel campo "error".
+        """
+        result = {"id": line_id, "question": None, "mode": None, "style": None, "docs": [],
+                  "answer": "", "ttft_s": None, "total_s": None, "error": None}
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("riga non valida: serve un oggetto JSON")
+            result["id"] = item.get("id", line_id)
+            result["question"] = item.get("question")
+            mode = result["mode"] = pipeline.MODES.get(item.get("mode", "chat"), item.get("mode"))
+            style = result["style"] = item.get("style", "Bilanciato")
+            if "docs" not in item:
+                names = tuple(sorted(self.documents))
+            elif isinstance(item["docs"], list) and all(isinstance(name, str) for name in item["docs"]):
+                names = tuple(item["docs"])
+            else:
+                # Una stringa diventerebbe una tupla di caratteri
+                raise ValueError('"docs" deve essere una lista di nomi di file')
+            result["docs"] = list(names)
+            try:
+                num_questions = int(item.get("num_questions", 5))
+            except (TypeError, ValueError):
+                raise ValueError(f"num_questions non valido: {item.get('num_questions')!r}") from None
+            if not isinstance(result["question"], str) or not result["question"].strip():
+                raise ValueError("domanda mancante")
+            if mode not in pipeline.MODES.values():
+                raise ValueError(f"modalità sconosciuta: {item.get('mode')}")
+            missing = [name for name in names if name not in self.documents]
+            if missing:
+                raise ValueError(f"documenti non indicizzati: {', '.join(missing)}")
+
+            system_instruction = pipeline.get_system_instruction(mode, style, num_questions)
+            packing = {}
+            start = time.perf_counter()
+            if names:
+                chunks = pipeline.stream_rag(self._chain(names),
+                                             pipeline.rag_inputs(item["question"], system_instruction), packing)
+            else:
+                chunks = pipeline.stream_general(self.llm_factory(0.5),
+                                                 pipeline.general_messages(item["question"], system_instruction))
+            parts = []
+            for chunk in chunks:
+                if result["ttft_s"] is None:
+                    result["ttft_s"] = round(time.perf_counter() - start, 4)
+                parts.append(chunk)
+            result["total_s"] = round(time.perf_counter() - start, 4)
+            result["answer"] = "".join(parts)
+            result["context_tokens"] = packing.get("tokens_out")
+        except Exception as e:
+            result["error"] = str(e) or type(e).__name__
+            metrics.incr("errors", stage="batch")
+        return result
+
+    def run(self, lines, out):
+        """Legge le righe JSONL, risponde con al massimo `concurrency` domande in corso, scrive `out`."""
+        # Al massimo il doppio dei worker in attesa: il file di domande non viene letto tutto in memoria
+        slots = threading.Semaphore(2 * self.concurrency)
+        write_lock = threading.Lock()
+        results = []
+
+        def done(future):
+            try:
+                result = future.result()
+                with write_lock:
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    out.flush()
+                    results.append(result)
+            finally:
+                slots.release()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch") as pool:
+            for number, line in enumerate(lines, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # answer() la riporta come errore, con l'id della riga
+                    item = None
+                slots.acquire()
+                pool.submit(self.answer, item, f"line-{number}").add_done_callback(done)
+        wall = time.perf_counter() - start
+
+        answered = [r for r in results if r["error"] is None]
+        return {
+            "questions": len(results),
+            "errors": len(results) - len(answered),
+            "wall_s": round(wall, 3),
+            "throughput_qps": round(len(answered) / wall, 2) if wall else None,
+            "ttft": _percentiles([r["ttft_s"] for r in answered]),
+            "total": _percentiles([r["total_s"] for r in answered]),
+        }
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser(description="AI Study Master in modalità batch (senza interfaccia)")
+    parser.add_argument("--pdf-dir", required=True, help="cartella dei PDF da indicizzare")
+    parser.add_argument("--questions", help="file JSONL di domande ('-' = stdin)")
+    parser.add_argument("--out", default="batch_results.jsonl", help="risultati JSONL ('-' = stdout)")
+    parser.add_argument("--report", help="salva anche il riepilogo JSON in questo file")
+    parser.add_argument("--ingest-workers", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=4, help="domande in parallelo")
+    parser.add_argument("--index-only", action="store_true", help="solo indicizzazione")
+    parser.add_argument("--material", action="store_true", help="pre-genera quiz e flashcard per ogni PDF")
+    parser.add_argument("--user", help="aggiunge i PDF alla libreria di questo utente (SQLite)")
+    parser.add_argument("--fake-llm", action="store_true", help="LLM finto locale (nessuna chiamata di rete)")
+    parser.add_argument("--fake-ttft", type=float, default=0.05)
+    parser.add_argument("--fake-token-delay", type=float, default=0.002)
+    parser.add_argument("--fake-embeddings", action="store_true", help="embedding finti da hash (nessun modello)")
+    parser.add_argument("--cache-dir", help="radice per indici, embedding, PDF e materiale "
+                                            "(default: la cache dell'app; con --fake-embeddings una cartella temporanea)")
+    args = parser.parse_args(argv)
+
+    paths = sorted(os.path.join(args.pdf_dir, name) for name in os.listdir(args.pdf_dir)
+                   if name.lower().endswith(".pdf"))
+    if not paths:
+        raise SystemExit(f"Nessun PDF in {args.pdf_dir}")
+    llm_factory = None
+    if not args.index_only or args.material:
+        llm_factory = make_llm_factory(args.fake_llm, os.environ.get("GOOGLE_API_KEY"),
+                                       args.fake_ttft, args.fake_token_delay)
+
+    root = args.cache_dir
+    if root is None and args.fake_embeddings:
+        # Indici di un modello finto non devono finire nella cache (e nelle librerie) dell'app
+        root = tempfile.mkdtemp(prefix="study-master-batch-")
+        print(f"Cache temporanea: {root}", file=sys.stderr)
+    embeddings, embedding_model = load_embeddings(args.fake_embeddings, root)
+    registry = index_registry.IndexRegistry(
+        index_cache.IndexCache(_cache_path(root, "indexes", index_cache.DEFAULT_CACHE_DIR)), embeddings)
+    started = time.perf_counter()
+    rows = ingest(paths, registry, embedding_model, args.ingest_workers, user=args.user, root=root)
+    ingest_seconds = time.perf_counter() - started
+    report = {"ingestion": {
+        "files": len(rows),
+        "cached": sum(r["state"] == "cached" for r in rows),
+        "failed": [{"file": r["file"], "state": r["state"], "error": r.get("error")}
+                   for r in rows if r["state"] not in ("cached", "complete")],
+        "chunks": sum(r["chunks"] or 0 for r in rows),
+        "wall_s": round(ingest_seconds, 3),
+    }}
+    if args.material:
+        report["material"] = pregenerate(rows, llm_factory(0.4), args.ingest_workers, root=root)
+
+    if args.questions and not args.index_only:
+        documents = {}
+        for r in rows:
+            vectorstore = registry.get(r["key"]) if r["state"] in ("cached", "complete") else None
+            if vectorstore is not None:
+                documents[r["file"]] = (r["doc_id"], r["file"], vectorstore)
+        runner = QuestionRunner(documents, llm_factory, args.concurrency)
+        source = sys.stdin if args.questions == "-" else open(args.questions, encoding="utf-8")
+        out = sys.stdout if args.out == "-" else open(args.out, "w", encoding="utf-8")
+        try:
+            report["answers"] = runner.run(source, out)
+        finally:
+            if source is not sys.stdin:
+                source.close()
+            if out is not sys.stdout:
+                out.close()
+
+    report["stages"] = metrics.REGISTRY.summary()
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    # Con i risultati su stdout il riepilogo va su stderr
+    print(text, file=sys.stderr if args.out == "-" else sys.stdout)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
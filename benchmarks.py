@@ -0,0 +1,516 @@
+# benchmarks.py
+# Suite di benchmark offline: nessuna rete, nessuna chiave Gemini.
+#
+# Ripercorre il percorso di app.py con componenti finti e deterministici
+# (embedding da hash, LLM con latenza e streaming simulati) e misura:
+# avvio (import fino al login e prima domanda, con import differiti e non),
+# estrazione PDF, chunking, embedding, build e query degli indici, latenza
+# end-to-end della risposta RAG, indicizzazione progressiva (tempo alla prima
+# domanda possibile), cronologia su SQLite e sul Firestore finto.
+# I risultati vanno in JSON per confrontare versioni diverse.
+#
+#   python benchmarks.py --out bench.json
+#   python benchmarks.py --out new.json --compare bench.json
+#   python benchmarks.py --startup-only --out startup.json
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import subprocess
+from typing import Iterator
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+from langchain.chains import create_retrieval_chain
+from langchain.chains.combine_documents import create_stuff_documents_chain
+
+import bm25
+import storage
+import library
+import pipeline
+import ann_index
+import pdf_extract
+import index_cache
+import index_registry
+import progressive_index
+import context_packing
+import embedding_cache
+import firestore_fake
+
+_WORDS = ("funzione variabile probabilità distribuzione media varianza teorema limite campione "
+          "ipotesi test intervallo confidenza regressione stimatore errore densità integrale "
+          "derivata matrice vettore autovalore articolo regolamento esame appello voto studente").split()
+
+
+# --- COMPONENTI FINTI ---
+
+class FakeEmbeddings(Embeddings):
+    """Embedding deterministici dall'hash del testo, con latenza simulata per lotto."""
+
+    def __init__(self, size=384, batch_delay=0.0):
+        self.size = size
+        self.batch_delay = batch_delay
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        vector = np.random.default_rng(seed).normal(size=self.size)
+        return (vector / np.linalg.norm(vector)).astype(np.float32).tolist()
+
+    def embed_documents(self, texts):
+        if self.batch_delay:
+            time.sleep(self.batch_delay)
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+
+class FakeChatModel(BaseChatModel):
+    """LLM finto: attende `ttft` secondi, poi emette `answer_tokens` parole a `token_delay` l'una.
+
+    Ai prompt di study_material (che chiedono un JSON di quiz e flashcard)
+    risponde con un JSON valido, costruito dalle parole dell'estratto.
+    """
+
+    ttft: float = 0.05
+    token_delay: float = 0.002
+    answer_tokens: int = 120
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def _tokens(self, messages):
+        prompt = str(messages[-1].content) if messages else ""
+        if '"flashcards"' in prompt:
+            return re.findall(r"\S+\s*", self._material(prompt))
+        return [f"{_WORDS[i % len(_WORDS)]} " for i in range(self.answer_tokens)]
+
+    @staticmethod
+    def _material(prompt):
+        quiz = re.search(r"(\d+) domande", prompt)
+        cards = re.search(r"(\d+) flashcard", prompt)
+        excerpt = prompt.rsplit("ESTRATTO:", 1)[-1]
+        # Parole dell'estratto: sezioni diverse danno elementi diversi (non tolti come doppioni)
+        words = list(dict.fromkeys(re.findall(r"[^\W\d_]{4,}", excerpt.lower()))) or list(_WORDS)
+        data = {
+            "quiz": [{"question": f"Che ruolo ha {words[i % len(words)]} nel testo?",
+                      "answer": f"{words[i % len(words)]} {words[(i + 1) % len(words)]}"}
+                     for i in range(int(quiz.group(1)) if quiz else 3)],
+            "flashcards": [{"term": words[-1 - i % len(words)], "definition": " ".join(words[i:i + 6])}
+                           for i in range(int(cards.group(1)) if cards else 3)],
+        }
+        return json.dumps(data, ensure_ascii=False)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        tokens = self._tokens(messages)
+        time.sleep(self.ttft + self.token_delay * len(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.ttft)
+        for token in self._tokens(messages):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+            time.sleep(self.token_delay)
+
+
+def make_pdf(pages=50, lines_per_page=45, seed=0):
+    """PDF sintetico con testo estraibile (Helvetica), senza dipendenze."""
+    rng = random.Random(seed)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # Pages, scritto quando si conoscono le pagine
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for page in range(pages):
+        lines = [f"Pagina {page + 1}, art. {rng.randint(1, 60)}: " +
+                 " ".join(rng.choice(_WORDS) for _ in range(12)) for _ in range(lines_per_page)]
+        # Solo ASCII nel content stream: niente codifiche di font da gestire
+        text = " T* ".join(f"({line.encode('ascii', 'replace').decode()})" + " Tj" for line in lines)
+        stream = f"BT /F1 9 Tf 40 800 Td 16 TL {text} ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+# --- MISURE ---
+
+def _percentiles(samples):
+    """p50/p95/max in millisecondi da una lista di durate in secondi."""
+    samples = sorted(samples)
+    return {
+        "p50_ms": round(samples[len(samples) // 2] * 1000, 3),
+        "p95_ms": round(samples[int(len(samples) * 0.95)] * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+def _questions(n, seed=1):
+    rng = random.Random(seed)
+    return [f"Cosa dice l'art. {rng.randint(1, 60)} su " + " ".join(rng.choice(_WORDS) for _ in range(4)) + "?"
+            for _ in range(n)]
+
+
+def bench_ingestion(pdf_bytes, workdir, workers=(1, 4)):
+    """Estrazione, chunking ed embedding (cache fredda e calda)."""
+    results = {"extract": pdf_extract.benchmark(pdf_bytes, workers)}
+
+    pages = list(pdf_extract.iter_pages(pdf_bytes))
+    start = time.perf_counter()
+    docs = pipeline.split_pages(pages)
+    elapsed = time.perf_counter() - start
+    chars = sum(len(p.text) for p in pages)
+    results["chunking"] = {
+        "chunks": len(docs),
+        "seconds": round(elapsed, 4),
+        "chars_per_sec": round(chars / elapsed) if elapsed else None,
+    }
+
+    embeddings = embedding_cache.CachedEmbeddings(
+        FakeEmbeddings(batch_delay=0.005), "fake", db_path=os.path.join(workdir, "embeddings.sqlite"))
+    texts = [d.page_content for d in docs]
+    vectors, cold = embeddings.embed_with_stats(texts)
+    _, warm = embeddings.embed_with_stats(texts)
+    results["embedding"] = {"cold": cold.as_dict(), "warm": warm.as_dict()}
+    return results, docs, vectors, embeddings
+
+
+def bench_index(docs, vectors, embeddings, index_types=("flat", "sq8", "hnsw"), queries=200):
+    """Build per tipo di indice e latenza di query (solo vettori e ibrida)."""
+    texts = [d.page_content for d in docs]
+    metadatas = [d.metadata for d in docs]
+    questions = _questions(queries)
+    results = {}
+    for index_type in index_types:
+        start = time.perf_counter()
+        vectorstore = ann_index.create_vectorstore(list(zip(texts, vectors)), embeddings, metadatas, index_type=index_type)
+        vectorstore.lexical_index = bm25.BM25Index.build(texts)
+        build = time.perf_counter() - start
+
+        row = {"type": vectorstore.index_type, "build_s": round(build, 3),
+               "memory_mb": round(ann_index.memory_bytes(vectorstore.index) / 1e6, 2)}
+        for search_type in ("similarity", "hybrid"):
+            retriever = library.MultiDocRetriever(stores=[("bench", "bench.pdf", vectorstore)], k=6,
+                                                  search_type=search_type)
+            latencies = []
+            for q in questions:
+                start = time.perf_counter()
+                retriever.invoke(q)
+                latencies.append(time.perf_counter() - start)
+            row[search_type] = _percentiles(latencies)
+        results[index_type] = row
+    return results
+
+
+def bench_progressive(pdf_bytes, workdir, batch_sizes=(32, 128), batch_delay=0.05):
+    """Indicizzazione in background: secondi alla prima istantanea interrogabile e all'indice completo.
+
+    Ogni lotto del modello finto costa `batch_delay` secondi; la cache degli
+    embedding è nuova per ogni prova, così tutti i chunk passano dal modello.
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        root = os.path.join(workdir, f"progressive-{batch_size}")
+        embeddings = embedding_cache.CachedEmbeddings(
+            FakeEmbeddings(batch_delay=batch_delay), "fake", db_path=os.path.join(root, "embeddings.sqlite"),
+            batch_size=batch_size)
+        registry = index_registry.IndexRegistry(index_cache.IndexCache(os.path.join(root, "indexes")), embeddings)
+        indexer = progressive_index.ProgressiveIndexer(registry, batch_size=batch_size)
+        start = time.perf_counter()
+        job = indexer.ensure("bench", "bench.pdf", lambda: pdf_bytes, pipeline.split_pages)
+        first = None
+        while job.active():
+            if first is None and job.vectorstore is not None:
+                first = time.perf_counter() - start
+            time.sleep(0.005)
+        total = time.perf_counter() - start
+        results[str(batch_size)] = {
+            "state": job.state,
+            "chunks": job.chunks_total,
+            # Documento entro un solo lotto: interrogabile solo a indice completo
+            "first_query_s": round(first if first is not None else total, 3),
+            "complete_s": round(total, 3),
+        }
+    return results
+
+
+def bench_answer(docs, vectors, embeddings, questions=20, llm=None):
+    """Latenza end-to-end della catena RAG con LLM finto: primo token e totale."""
+    llm = llm or FakeChatModel()
+    texts = [d.page_content for d in docs]
+    vectorstore = ann_index.create_vectorstore(list(zip(texts, vectors)), embeddings, [d.metadata for d in docs])
+    vectorstore.lexical_index = bm25.BM25Index.build(texts)
+    retriever = context_packing.PackedRetriever(
+        retriever=library.MultiDocRetriever(stores=[("bench", "bench.pdf", vectorstore)], k=6))
+    prompt = ChatPromptTemplate.from_messages([("system", "Rispondi dal contesto:\n{context}"), ("human", "{input}")])
+    document_prompt = PromptTemplate.from_template("[{source}, pagina {page}]\n{page_content}")
+    chain = create_retrieval_chain(retriever, create_stuff_documents_chain(llm, prompt, document_prompt=document_prompt))
+
+    ttft, total, saved = [], [], []
+    for q in _questions(questions, seed=2):
+        start = time.perf_counter()
+        first = None
+        for chunk in chain.stream({"input": q}):
+            if chunk.get("context"):
+                saved.append(chunk["context"][0].metadata["packing"]["tokens_saved"])
+            if chunk.get("answer") and first is None:
+                first = time.perf_counter() - start
+        total.append(time.perf_counter() - start)
+        ttft.append(first)
+    return {
+        "llm": {"ttft_s": llm.ttft, "token_delay_s": llm.token_delay, "tokens": llm.answer_tokens},
+        "ttft": _percentiles(ttft),
+        "total": _percentiles(total),
+        "context_tokens_saved_avg": round(sum(saved) / len(saved), 1) if saved else 0,
+    }
+
+
+def bench_firestore(rows=50_000, users=500, pages=50):
+    """Cronologia sul Firestore finto: scritture a batch, pagina e round trip per operazione."""
+    client = firestore_fake.FakeClient()
+    store = storage.FirestoreStore(client)
+    content = "x" * 400
+    start = time.perf_counter()
+    store.save_messages([(f"user{i % users}", "user", content) for i in range(rows)])
+    write = time.perf_counter() - start
+    write_trips = client.round_trips
+
+    latencies = []
+    client.round_trips = 0
+    for i in range(0, users, max(1, users // pages)):
+        start = time.perf_counter()
+        store.load_history_page(f"user{i}", 50)
+        latencies.append(time.perf_counter() - start)
+    return {
+        "rows": rows,
+        "writes_per_sec": round(rows / write),
+        "write_round_trips": write_trips,
+        "history_page": _percentiles(latencies),
+        "round_trips_per_page": round(client.round_trips / len(latencies), 2),
+    }
+
+
+# Moduli importati prima che la pagina di login compaia: ora e prima degli import differiti
+LOGIN_IMPORTS = ("streamlit", "storage", "write_queue", "metrics", "warmup", "bm25", "llm_scheduler", "pipeline",
+                 "styles")
+EAGER_IMPORTS = LOGIN_IMPORTS + (
+    "langchain_text_splitters", "langchain_community.embeddings.huggingface", "langchain_core.prompts",
+    "langchain.chains", "langchain.chains.combine_documents", "langchain_core.messages",
+    "index_cache", "pdf_extract", "embedding_cache", "llm_clients", "answer_cache", "library",
+    "index_registry", "ann_index", "context_packing", "google.cloud.firestore", "google.oauth2.service_account",
+)
+
+
+# Processo nuovo per ogni misura: import a freddo, "login" (pagina pronta), poi
+# prima domanda su un PDF appena caricato. Un modulo che non si importa non
+# ferma la misura: finisce in "failed" con il suo errore.
+_STARTUP_CHILD = """
+import sys, json, time, importlib, threading
+config = json.loads(sys.argv[1])
+failed = {}
+def load(names):
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            failed[name] = f"{type(e).__name__}: {e}"
+start = time.perf_counter()
+load(config["login"])
+login = time.perf_counter() - start
+if config["warm"]:
+    threading.Thread(target=load, args=(config["warm"],), daemon=True).start()
+time.sleep(config["think"])
+start = time.perf_counter()
+import benchmarks
+benchmarks.first_request(config["pages"])
+first = time.perf_counter() - start
+print(json.dumps({"login_s": login, "first_request_s": first, "failed": failed}))
+"""
+
+# Scenari di avvio: import di una volta (tutto prima del login), import differiti
+# con la prima domanda subito dopo il login, e con il riscaldamento in background
+# durante qualche secondo di "riflessione" dell'utente
+STARTUP_THINK_SECONDS = 3.0
+STARTUP_SCENARIOS = {
+    "eager": {"login": EAGER_IMPORTS, "warm": (), "think": 0.0},
+    "deferred": {"login": LOGIN_IMPORTS, "warm": (), "think": 0.0},
+    "deferred_warm": {"login": LOGIN_IMPORTS, "warm": tuple(m for m in EAGER_IMPORTS if m not in LOGIN_IMPORTS),
+                      "think": STARTUP_THINK_SECONDS},
+}
+
+
+def first_request(pages=20):
+    """Primo upload e prima domanda con componenti finti: ritorna al primo token della risposta."""
+    pdf_bytes = make_pdf(pages)
+    docs = pipeline.split_pages(list(pdf_extract.iter_pages(pdf_bytes)))
+    embeddings = FakeEmbeddings()
+    texts = [d.page_content for d in docs]
+    vectorstore = ann_index.create_vectorstore(list(zip(texts, embeddings.embed_documents(texts))), embeddings,
+                                               [d.metadata for d in docs])
+    vectorstore.lexical_index = bm25.BM25Index.build(texts)
+    chain = pipeline.build_rag_chain([("bench", "bench.pdf", vectorstore)], FakeChatModel(ttft=0.0, token_delay=0.0))
+    for _ in pipeline.stream_rag(chain, pipeline.rag_inputs(_questions(1)[0], "Rispondi.")):
+        return
+
+
+def _startup_run(scenario, pages):
+    config = {**STARTUP_SCENARIOS[scenario], "pages": pages}
+    proc = subprocess.run([sys.executable, "-c", _STARTUP_CHILD, json.dumps(config)], capture_output=True,
+                          text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit code {proc.returncode}"
+        print(f"benchmark di avvio '{scenario}' fallito:\n{proc.stderr}", file=sys.stderr)
+        return None, error
+    return json.loads(proc.stdout.strip().splitlines()[-1]), None
+
+
+def bench_startup(repeat=3, pages=20):
+    """Per scenario: secondi alla pagina di login e dalla prima domanda al primo token (migliore di `repeat`).
+
+    "eager" riproduce gli import di prima del caricamento differito, così la
+    stessa esecuzione dà i numeri prima/dopo.
+    """
+    results = {}
+    for scenario in STARTUP_SCENARIOS:
+        runs, error = [], None
+        for _ in range(repeat):
+            run, error = _startup_run(scenario, pages)
+            if run is None:
+                break
+            runs.append(run)
+        row = {"error": error} if error else {}
+        if runs:
+            row.update(login_s=round(min(r["login_s"] for r in runs), 3),
+                       first_request_s=round(min(r["first_request_s"] for r in runs), 3))
+            if runs[-1]["failed"]:
+                row["failed_imports"] = runs[-1]["failed"]
+        results[scenario] = row
+    return results
+
+
+def run(pdf_bytes=None, pages=200, sqlite_rows=200_000, firestore_rows=50_000, workdir=None):
+    """Esegue tutta la suite e restituisce il dizionario dei risultati."""
+    own_dir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="study-master-bench-")
+    try:
+        pdf_bytes = pdf_bytes or make_pdf(pages)
+        started = time.perf_counter()
+        ingestion, docs, vectors, embeddings = bench_ingestion(pdf_bytes, workdir)
+        results = {
+            "startup": bench_startup(),
+            "ingestion": ingestion,
+            "index": bench_index(docs, vectors, embeddings),
+            "progressive": bench_progressive(pdf_bytes, workdir),
+            "answer": bench_answer(docs, vectors, embeddings),
+            "sqlite": storage.benchmark(os.path.join(workdir, "bench.db"), rows=sqlite_rows,
+                                        users=max(1, sqlite_rows // 200), writes=2000),
+            "firestore_fake": bench_firestore(firestore_rows),
+        }
+        results["suite_seconds"] = round(time.perf_counter() - started, 1)
+        return results
+    finally:
+        if own_dir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _flatten(data, prefix=""):
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{name}.")
+        elif isinstance(value, list):
+            for i, item in enumerate(value):
+                if isinstance(item, dict):
+                    yield from _flatten(item, f"{name}[{i}].")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def compare(old, new):
+    """Righe (metrica, vecchio, nuovo, variazione %) per le metriche numeriche in comune."""
+    before = dict(_flatten(old.get("results", old)))
+    rows = []
+    for name, value in _flatten(new.get("results", new)):
+        if name in before and before[name]:
+            rows.append((name, before[name], value, round((value - before[name]) / before[name] * 100, 1)))
+    return rows
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline di AI Study Master (output JSON)")
+    parser.add_argument("--pdf", help="PDF da usare; altrimenti uno sintetico di --pages pagine")
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--sqlite-rows", type=int, default=200_000)
+    parser.add_argument("--firestore-rows", type=int, default=50_000)
+    parser.add_argument("--out", default="benchmark_results.json")
+    parser.add_argument("--compare", help="JSON di un'esecuzione precedente da confrontare")
+    parser.add_argument("--startup-only", action="store_true", help="solo la sezione di avvio")
+    args = parser.parse_args(argv)
+
+    pdf_bytes = None
+    if args.pdf:
+        with open(args.pdf, "rb") as f:
+            pdf_bytes = f.read()
+    report = {
+        "revision": _git_revision(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+    if args.startup_only:
+        started = time.perf_counter()
+        report["results"] = {"startup": bench_startup(),
+                             "suite_seconds": round(time.perf_counter() - started, 1)}
+    else:
+        report["results"] = run(pdf_bytes, args.pages, args.sqlite_rows, args.firestore_rows)
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Risultati scritti in {args.out} ({report['results']['suite_seconds']} s)")
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print(f"{'metrica':<56} {'prima':>12} {'dopo':>12} {'Δ%':>8}")
+        for name, before, after, delta in compare(old, report):
+            print(f"{name:<56} {before:>12} {after:>12} {delta:>8}")
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
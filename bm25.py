@@ -0,0 +1,118 @@
+# bm25.py
+# Indice lessicale BM25 compatto, costruito accanto all'indice FAISS.
+#
+# MiniLM è debole su termini tecnici italiani, formule e numeri di articolo:
+# l'indice lessicale recupera i chunk che contengono esattamente quei
+# termini. Le posting list sono array compatti (doc id + frequenza) e la
+# query tocca solo le liste dei termini richiesti.
+
+import re
+import math
+import pickle
+import unicodedata
+from array import array
+
+# Nome del file salvato accanto all'indice FAISS nella cache
+FILE_NAME = "bm25.pkl"
+
+# Parole, numeri e sigle; "art. 12" e "x^2" restano interrogabili come "art", "12", "x", "2"
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+_STOPWORDS = frozenset("""
+a ad al alla alle agli ai all allo anche che chi ci come con cui da dal dalla dalle dai degli dei del
+della delle dello di e ed gli ha hai ho i il in la le lo ma mi ne nei nel nella nelle nello non o per
+piu puo quale quali quando se si sia sono su sua sue sui sul sulla suo tra tu un una uno vi
+the of and to in is for on with
+""".split())
+
+
+def _strip_accents(text):
+    if text.isascii():
+        return text
+    return "".join(c for c in unicodedata.normalize("NFD", text) if unicodedata.category(c) != "Mn")
+
+
+def tokenize(text):
+    tokens = _TOKEN_RE.findall(_strip_accents(text.lower()))
+    return [t for t in tokens if t not in _STOPWORDS]
+
+
+class BM25Index:
+    """Indice BM25 in memoria su una lista di testi (id = posizione nella lista)."""
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_lengths = array("I")
+        self.avg_length = 0.0
+        self.postings = {}      # termine -> (array doc id, array frequenze)
+        self.idf = {}
+
+    @classmethod
+    def build(cls, texts, **params):
+        index = cls(**params)
+        buckets = {}
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            index.doc_lengths.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                ids, tfs = buckets.setdefault(token, (array("I"), array("H")))
+                ids.append(doc_id)
+                tfs.append(min(tf, 65535))
+        index.postings = buckets
+        n = len(index.doc_lengths)
+        index.avg_length = (sum(index.doc_lengths) / n) if n else 0.0
+        index.idf = {t: math.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5)) for t, (ids, _) in buckets.items()}
+        return index
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def search(self, query, k=10, allowed=None):
+        """Restituisce [(doc_id, punteggio)] in ordine decrescente; `allowed` filtra gli id."""
+        if not self.doc_lengths:
+            return []
+        scores = {}
+        k1, b, avg = self.k1, self.b, self.avg_length or 1.0
+        lengths = self.doc_lengths
+        for token in set(tokenize(query)):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            idf = self.idf[token]
+            ids, tfs = posting
+            for doc_id, tf in zip(ids, tfs):
+                norm = tf + k1 * (1 - b + b * lengths[doc_id] / avg)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (k1 + 1) / norm
+        if allowed is not None:
+            scores = {d: s for d, s in scores.items() if d in allowed}
+        return sorted(scores.items(), key=lambda item: -item[1])[:k]
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore):
+        """Costruisce l'indice dai chunk di un vectorstore FAISS, allineato alle sue posizioni."""
+        ids = vectorstore.index_to_docstore_id
+        return cls.build(vectorstore.docstore.search(ids[i]).page_content for i in range(len(ids)))
+
+    def to_bytes(self):
+        return pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def from_bytes(data):
+        return pickle.loads(data)
+
+
+def reciprocal_rank_fusion(rankings, weights=None, k=60):
+    """Unisce più classifiche (liste di chiavi, migliore prima) con RRF pesato.
+
+    Ritorna le chiavi ordinate per punteggio fuso sum(w / (k + rank)).
+    """
+    weights = weights or [1.0] * len(rankings)
+    fused = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, key in enumerate(ranking, start=1):
+            fused[key] = fused.get(key, 0.0) + weight / (k + rank)
+    return sorted(fused, key=lambda key: -fused[key])
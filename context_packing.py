@@ -0,0 +1,168 @@
+# context_packing.py
+# Assemblaggio del contesto RAG entro un budget di token.
+#
+# I chunk recuperati si sovrappongono (chunk_overlap) e spesso sono
+# adiacenti: messi nel prompt così come sono, gli stessi 200 caratteri
+# arrivano al modello due o tre volte. Qui i chunk scelti per rilevanza
+# vengono fusi in intervalli contigui dello stesso documento (usando
+# start_index), senza testo ripetuto, e ordinati per posizione.
+
+import os
+from typing import List
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+import metrics
+
+DEFAULT_MAX_TOKENS = int(os.environ.get("STUDY_MASTER_CONTEXT_TOKENS", "2000"))
+# Stima senza tokenizer: per Gemini circa 4 caratteri per token
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+class PackingStats:
+    """Token del contesto prima e dopo l'assemblaggio."""
+
+    def __init__(self, chunks_in=0, tokens_in=0, spans_out=0, tokens_out=0, dropped=0):
+        self.chunks_in = chunks_in
+        self.tokens_in = tokens_in
+        self.spans_out = spans_out
+        self.tokens_out = tokens_out
+        self.dropped = dropped
+
+    @property
+    def tokens_saved(self):
+        return self.tokens_in - self.tokens_out
+
+    def as_dict(self):
+        return {
+            "chunks_in": self.chunks_in,
+            "tokens_in": self.tokens_in,
+            "spans_out": self.spans_out,
+            "tokens_out": self.tokens_out,
+            "tokens_saved": self.tokens_saved,
+            "dropped": self.dropped,
+        }
+
+
+class _Span:
+    __slots__ = ("doc_id", "start", "text", "metadata", "pages")
+
+    def __init__(self, doc_id, start, text, metadata):
+        self.doc_id = doc_id
+        self.start = start
+        self.text = text
+        self.metadata = metadata
+        self.pages = {metadata["page"]} if "page" in metadata else set()
+
+    @property
+    def end(self):
+        return self.start + len(self.text)
+
+    def absorb(self, other):
+        # `other` inizia dentro o subito dopo questo intervallo: si aggiunge solo la parte nuova
+        overlap = self.end - other.start
+        if overlap >= len(other.text):
+            pass
+        elif overlap <= 0 or self.text[-overlap:] == other.text[:overlap]:
+            self.text += other.text[max(overlap, 0):]
+        else:
+            # Offset incoerenti col testo (non dovrebbe succedere): niente tagli
+            self.text += "\n" + other.text
+        self.pages |= other.pages
+
+
+def _merge(chunks):
+    """Fonde i chunk dello stesso documento che si toccano o si sovrappongono."""
+    spans = []
+    by_doc = {}
+    for doc in chunks:
+        doc_id = doc.metadata.get("doc_id")
+        start = doc.metadata.get("start_index")
+        span = _Span(doc_id, start, doc.page_content, doc.metadata)
+        if start is None:
+            # Chunk senza posizione: resta un frammento a sé
+            spans.append(span)
+            continue
+        by_doc.setdefault(doc_id, []).append(span)
+
+    # Documenti nell'ordine del loro chunk più rilevante, intervalli per posizione
+    for doc_id, items in by_doc.items():
+        items.sort(key=lambda s: s.start)
+        current = items[0]
+        for span in items[1:]:
+            if span.start <= current.end:
+                current.absorb(span)
+            else:
+                spans.append(current)
+                current = span
+        spans.append(current)
+
+    order = {doc_id: i for i, doc_id in enumerate(by_doc)}
+    spans.sort(key=lambda s: (order.get(s.doc_id, len(order)), s.start if s.start is not None else -1))
+    return spans
+
+
+def _to_document(span):
+    metadata = dict(span.metadata)
+    if span.pages:
+        first, last = min(span.pages), max(span.pages)
+        metadata["page"] = first if first == last else f"{first}-{last}"
+    if span.start is not None:
+        metadata["start_index"] = span.start
+    return Document(page_content=span.text, metadata=metadata)
+
+
+def pack_documents(docs, max_tokens=DEFAULT_MAX_TOKENS):
+    """Sceglie i chunk in ordine di rilevanza finché il contesto fuso sta nel budget.
+
+    Ritorna (documenti, PackingStats): un Document per intervallo contiguo,
+    ordinati per documento e posizione. Il primo chunk entra sempre, anche
+    se da solo supera il budget.
+    """
+    stats = PackingStats(chunks_in=len(docs),
+                         tokens_in=sum(estimate_tokens(d.page_content) for d in docs))
+    chosen = []
+    spans = []
+    for doc in docs:
+        candidate = _merge(chosen + [doc])
+        tokens = sum(estimate_tokens(s.text) for s in candidate)
+        if chosen and tokens > max_tokens:
+            stats.dropped += 1
+            continue
+        chosen.append(doc)
+        spans = candidate
+
+    packed = [_to_document(s) for s in spans]
+    stats.spans_out = len(packed)
+    stats.tokens_out = sum(estimate_tokens(d.page_content) for d in packed)
+    return packed, stats
+
+
+class PackedRetriever(BaseRetriever):
+    """Avvolge un retriever e restituisce il contesto già assemblato da pack_documents.
+
+    Le statistiche dell'ultimo assemblaggio sono nei metadati di ogni
+    documento restituito, alla chiave "packing".
+    """
+
+    retriever: BaseRetriever
+    max_tokens: int = DEFAULT_MAX_TOKENS
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query, *, run_manager=None) -> List[Document]:
+        docs = self.retriever.invoke(query)
+        with metrics.span("context_packing"):
+            packed, stats = pack_documents(docs, self.max_tokens)
+        metrics.incr("context_tokens", stats.tokens_out)
+        metrics.incr("context_tokens_saved", stats.tokens_saved)
+        report = stats.as_dict()
+        for doc in packed:
+            doc.metadata["packing"] = report
+        return packed
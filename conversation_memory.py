@@ -0,0 +1,188 @@
+# conversation_memory.py
+# Memoria della conversazione a dimensione limitata.
+#
+# A ogni domanda il modello riceve gli ultimi turni alla lettera più un
+# riassunto dei turni precedenti, entro un budget di token costante. Il
+# riassunto non si rifà a ogni domanda: quando fuori dalla finestra si è
+# accumulata un'intera finestra di messaggi, un thread di background li
+# fonde nel riassunto esistente e lo salva accanto alla cronologia
+# (chat_summaries). Il riassunto ricorda l'hash dell'ultimo messaggio
+# incluso, così alla sessione successiva si sa da dove riprendere.
+
+import os
+import re
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from context_packing import estimate_tokens, CHARS_PER_TOKEN
+
+DEFAULT_TURNS = int(os.environ.get("STUDY_MASTER_MEMORY_TURNS", "3"))
+# Budget complessivo (riassunto + turni recenti) aggiunto al prompt
+DEFAULT_MAX_TOKENS = int(os.environ.get("STUDY_MASTER_MEMORY_TOKENS", "1500"))
+# Quota massima del budget riservata al riassunto
+SUMMARY_SHARE = 0.3
+# Un singolo messaggio (es. un quiz lungo) non può occupare tutta la finestra
+MESSAGE_MAX_TOKENS = 400
+# Segnali di una domanda che rimanda alla precedente: apertura con una
+# congiunzione ("e l'esempio?"), dimostrativi e pronomi ("questo", "esso"),
+# rimandi alla conversazione ("di prima", "sopra") e richieste di
+# riformulare ("spiegamelo", "più semplice"). La lunghezza da sola non
+# basta: "Cos'è la varianza?" è breve ma autonoma.
+FOLLOWUP_PATTERN = re.compile(r"""
+    ^\s*(?:e|ma|quindi|allora|invece|però|oppure|cioè)\b
+  | \b(?:quest[oaie]?|quell[oaie]?|quegli|quei|ciò|ess[oaie])\b
+  | \b(?:di\s+prima|qui\s+sopra|sopra|precedente|appena\s+dett[oaie]|ultima\s+risposta)\b
+  | \b(?:continua|ancora|in\s+altre\s+parole|più\s+semplice|più\s+nel\s+dettaglio|un\s+altro|un'altra)\b
+  | \b\w+(?:mel|tel|cel|gliel)[oaie]\b
+  | \b(?:spiega|rispiega|ripeti|riassumi|chiarisci|approfondisci|semplifica|riformula)(?:l[oaie]|ne)\b
+  | ^\s*(?:perch[éeè]|come\s+mai|in\s+che\s+senso|per\s+esempio|esempi[oi]?)\W*$
+""", re.IGNORECASE | re.VERBOSE)
+
+PROMPT = """Aggiorna il riassunto di una conversazione di studio tra uno studente e il suo tutor.
+Mantieni argomenti, domande, esempi, definizioni e riferimenti a documenti e pagine che potrebbero
+servire per capire le domande successive. Scrivi in italiano, al massimo {words} parole, senza preamboli.
+
+RIASSUNTO ATTUALE:
+{summary}
+
+NUOVI MESSAGGI:
+{messages}
+
+RIASSUNTO AGGIORNATO:"""
+
+
+def message_hash(message):
+    return hashlib.sha256(f"{message['role']}\0{message['content']}".encode()).hexdigest()[:16]
+
+
+def clip(text, max_tokens):
+    """Tronca `text` a circa `max_tokens` token, segnalando il taglio."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    return text[:max(0, max_tokens * CHARS_PER_TOKEN - 2)].rstrip() + " …"
+
+
+def is_followup(text):
+    """True se la domanda rimanda alla conversazione e da sola non ha un soggetto."""
+    return FOLLOWUP_PATTERN.search(text) is not None
+
+
+def search_query(user_input, messages):
+    """Testo da usare per il recupero: una domanda di seguito eredita l'ultima domanda dello studente."""
+    if not is_followup(user_input):
+        return user_input
+    previous = next((m["content"] for m in reversed(messages) if m["role"] == "user"), None)
+    return f"{previous}\n{user_input}" if previous else user_input
+
+
+class Memory:
+    """Cosa entra nel prompt: riassunto, messaggi recenti ({"role", "content"}) e token stimati."""
+    __slots__ = ("summary", "messages", "tokens")
+
+    def __init__(self, summary, messages, tokens):
+        self.summary = summary
+        self.messages = messages
+        self.tokens = tokens
+
+
+class ConversationMemory:
+    """Finestra di `turns` turni + riassunto progressivo per utente, salvato nel backend di storage."""
+
+    def __init__(self, store, turns=DEFAULT_TURNS, max_tokens=DEFAULT_MAX_TOKENS, workers=2):
+        self.store = store
+        self.window = 2 * turns         # messaggi: domanda + risposta per turno
+        self.max_tokens = max_tokens
+        self._records = {}              # utente -> riassunto salvato (dict) o None
+        self._folding = set()           # utenti con un aggiornamento del riassunto in corso
+        self._generation = {}           # cresce a ogni cancellazione della cronologia
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="memory")
+
+    def _record(self, username):
+        with self._lock:
+            if username in self._records:
+                return self._records[username]
+        record = self.store.load_summary(username)
+        with self._lock:
+            return self._records.setdefault(username, record)
+
+    def forget(self, username):
+        """Dopo la cancellazione della cronologia: il riassunto in memoria e quelli in corso non valgono più."""
+        with self._lock:
+            self._records[username] = None
+            self._generation[username] = self._generation.get(username, 0) + 1
+
+    def _unsummarized(self, history, record):
+        if not record or not record.get("last_hash"):
+            return history
+        # L'ultimo messaggio riassunto è quasi sempre nella finestra caricata: si cerca dal fondo
+        for i in range(len(history) - 1, -1, -1):
+            if message_hash(history[i]) == record["last_hash"]:
+                return history[i + 1:]
+        return history
+
+    def build(self, username, history, llm=None):
+        """Memoria per la prossima domanda; `history` sono i messaggi precedenti in ordine cronologico.
+
+        Se fuori dalla finestra c'è un'intera finestra di messaggi non ancora
+        riassunti e `llm` è dato, l'aggiornamento del riassunto parte in background.
+        """
+        record = self._record(username)
+        summary = clip(record["summary"], int(self.max_tokens * SUMMARY_SHARE)) if record else ""
+        budget = self.max_tokens - estimate_tokens(summary)
+
+        pending = self._unsummarized(history, record)
+        recent = []
+        for message in reversed(pending[-self.window:]):
+            content = clip(message["content"], MESSAGE_MAX_TOKENS)
+            tokens = estimate_tokens(content)
+            if tokens > budget:
+                if recent:
+                    break
+                # Il messaggio più recente entra comunque, accorciato al budget rimasto
+                content = clip(content, budget)
+                tokens = estimate_tokens(content)
+            budget -= tokens
+            recent.append({"role": message["role"], "content": content})
+        recent.reverse()
+
+        older = pending[:len(pending) - len(recent)]
+        if llm is not None and len(older) >= self.window:
+            self._schedule(username, record, older, llm)
+        return Memory(summary, recent, self.max_tokens - budget)
+
+    def _schedule(self, username, record, older, llm):
+        with self._lock:
+            if username in self._folding:
+                return
+            self._folding.add(username)
+            generation = self._generation.get(username, 0)
+        self._pool.submit(self._fold, username, generation, record, list(older), llm)
+
+    def _fold(self, username, generation, record, older, llm):
+        try:
+            text = "\n".join(f"{'Studente' if m['role'] == 'user' else 'Tutor'}: "
+                             f"{clip(m['content'], MESSAGE_MAX_TOKENS)}" for m in older)
+            words = int(self.max_tokens * SUMMARY_SHARE * CHARS_PER_TOKEN / 6)
+            prompt = PROMPT.format(words=words, summary=(record or {}).get("summary") or "(nessuno)", messages=text)
+            with metrics.span("memory_fold"):
+                reply = llm.invoke(prompt)
+            summary = str(getattr(reply, "content", reply)).strip()
+            if not summary:
+                return
+            covered = (record or {}).get("covered", 0) + len(older)
+            new = {"summary": summary, "covered": covered, "last_hash": message_hash(older[-1])}
+            with self._lock:
+                if self._generation.get(username, 0) != generation:
+                    return
+                self._records[username] = new
+            self.store.save_summary(username, summary, covered, new["last_hash"])
+            metrics.incr("memory_folds")
+        except Exception:
+            # Si riprova al prossimo rollover: nel frattempo restano i turni recenti
+            metrics.incr("errors", stage="memory_fold")
+        finally:
+            with self._lock:
+                self._folding.discard(username)
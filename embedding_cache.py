@@ -0,0 +1,135 @@
+# embedding_cache.py
+# Cache persistente degli embedding a livello di chunk.
+#
+# Ogni chunk è identificato dall'hash (modello + testo): edizioni riviste
+# delle stesse dispense e intestazioni/piè di pagina ripetuti vengono
+# calcolati una sola volta. Solo i miss passano dal modello, a lotti.
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_DB_PATH = os.environ.get("STUDY_MASTER_EMBEDDING_CACHE", os.path.join(".cache", "embeddings.sqlite"))
+DEFAULT_BATCH_SIZE = int(os.environ.get("STUDY_MASTER_EMBEDDING_BATCH", "64"))
+
+# Limite di variabili per statement nelle build SQLite più vecchie
+_SQL_MAX_VARS = 900
+
+
+class EmbedStats:
+    """Statistiche di una chiamata (o cumulative) della cache."""
+
+    def __init__(self):
+        self.requested = 0     # testi richiesti
+        self.unique = 0        # testi distinti dopo la deduplica
+        self.hits = 0          # trovati in cache
+        self.embedded = 0      # calcolati dal modello
+        self.embed_seconds = 0.0
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.unique if self.unique else 0.0
+
+    @property
+    def throughput(self):
+        """Chunk calcolati al secondo (solo i miss)."""
+        return self.embedded / self.embed_seconds if self.embed_seconds else 0.0
+
+    def add(self, other):
+        self.requested += other.requested
+        self.unique += other.unique
+        self.hits += other.hits
+        self.embedded += other.embedded
+        self.embed_seconds += other.embed_seconds
+
+    def as_dict(self):
+        return {
+            "requested": self.requested,
+            "unique": self.unique,
+            "hits": self.hits,
+            "embedded": self.embedded,
+            "hit_rate": round(self.hit_rate, 3),
+            "chunks_per_sec": round(self.throughput, 1),
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """Wrapper di un modello di embedding con cache SQLite e batching."""
+
+    def __init__(self, underlying, model_name, db_path=DEFAULT_DB_PATH, batch_size=DEFAULT_BATCH_SIZE):
+        self.underlying = underlying
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.totals = EmbedStats()
+        self._lock = threading.Lock()
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # Connessione condivisa tra i thread di Streamlit, serializzata dal lock
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self._conn.commit()
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode()).hexdigest()
+
+    def _lookup(self, keys):
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), _SQL_MAX_VARS):
+                part = keys[i:i + _SQL_MAX_VARS]
+                marks = ",".join("?" * len(part))
+                rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", part)
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+        return found
+
+    def _save(self, items):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(k, array("f", v).tobytes()) for k, v in items],
+            )
+            self._conn.commit()
+
+    def embed_with_stats(self, texts):
+        """Come embed_documents, ma restituisce anche le EmbedStats della chiamata."""
+        stats = EmbedStats()
+        stats.requested = len(texts)
+
+        # Deduplica: testi identici nello stesso documento calcolati una volta
+        keys = [self._key(t) for t in texts]
+        unique = dict(zip(keys, texts))
+        stats.unique = len(unique)
+
+        vectors = self._lookup(list(unique))
+        stats.hits = len(vectors)
+
+        missing = [k for k in unique if k not in vectors]
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            start = time.perf_counter()
+            computed = self.underlying.embed_documents([unique[k] for k in batch])
+            stats.embed_seconds += time.perf_counter() - start
+            stats.embedded += len(batch)
+            new = list(zip(batch, computed))
+            self._save(new)
+            vectors.update(new)
+
+        with self._lock:
+            self.totals.add(stats)
+        return [vectors[k] for k in keys], stats
+
+    def embed_documents(self, texts):
+        return self.embed_with_stats(texts)[0]
+
+    def embed_query(self, text):
+        # Le domande sono quasi sempre diverse: niente cache
+        return self.underlying.embed_query(text)
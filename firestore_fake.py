@@ -0,0 +1,193 @@
+# firestore_fake.py
+# Client Firestore in-process, per benchmark e prove senza rete.
+#
+# Implementa solo il sottoinsieme di google.cloud.firestore usato da
+# storage.FirestoreStore: collection/document, where ==, order_by, limit,
+# start_after, select, stream, batch e bulk_writer. Conta i round trip
+# che il client reale farebbe verso il server.
+
+import copy
+import itertools
+import threading
+
+_auto_ids = itertools.count()
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return self._data.get(field)
+
+
+class FakeDocumentReference:
+    def __init__(self, client, collection, doc_id):
+        self._client = client
+        self._collection = collection
+        self.id = doc_id
+
+    def get(self):
+        self._client.round_trips += 1
+        with self._client._lock:
+            data = self._client._data.get(self._collection, {}).get(self.id)
+        return FakeSnapshot(self, copy.deepcopy(data))
+
+    def set(self, data):
+        self._client.round_trips += 1
+        self._client._write(self._collection, self.id, data)
+
+    def delete(self):
+        self._client.round_trips += 1
+        self._client._write(self._collection, self.id, None)
+
+
+class FakeQuery:
+    def __init__(self, client, collection, filters=(), orders=(), limit=None, start_after=None, fields=None):
+        self._client = client
+        self._collection = collection
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit
+        self._start_after = start_after
+        self._fields = fields
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, orders=self._orders, limit=self._limit,
+                     start_after=self._start_after, fields=self._fields)
+        state.update(changes)
+        return FakeQuery(self._client, self._collection, **state)
+
+    def where(self, field, op, value):
+        if op != "==":
+            raise NotImplementedError(f"operatore non supportato dal fake: {op}")
+        return self._copy(filters=self._filters + ((field, value),))
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field, direction == "DESCENDING"),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, values):
+        if isinstance(values, FakeSnapshot):
+            values = values.to_dict()
+        return self._copy(start_after=values)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def _sort_key(self, data):
+        return tuple(data[field] for field, _ in self._orders)
+
+    def _after_cursor(self, data):
+        # Confronto lessicografico campo per campo, rispettando la direzione
+        for field, descending in self._orders:
+            if field not in self._start_after:
+                break
+            value, cursor = data[field], self._start_after[field]
+            if value == cursor:
+                continue
+            return value < cursor if descending else value > cursor
+        return False
+
+    def stream(self):
+        self._client.round_trips += 1
+        with self._client._lock:
+            items = list(self._client._data.get(self._collection, {}).items())
+        rows = [(doc_id, data) for doc_id, data in items
+                if all(data.get(f) == v for f, v in self._filters)
+                # Come Firestore: i documenti senza un campo di ordinamento sono esclusi
+                and all(f in data for f, _ in self._orders)]
+        for field, descending in reversed(self._orders):
+            rows.sort(key=lambda r: r[1][field], reverse=descending)
+        if self._start_after is not None:
+            rows = [r for r in rows if self._after_cursor(r[1])]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        for doc_id, data in rows:
+            if self._fields is not None:
+                data = {f: data[f] for f in self._fields if f in data}
+            yield FakeSnapshot(FakeDocumentReference(self._client, self._collection, doc_id), copy.deepcopy(data))
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, client, name):
+        super().__init__(client, name)
+
+    def document(self, doc_id=None):
+        return FakeDocumentReference(self._client, self._collection, doc_id or f"auto{next(_auto_ids):012d}")
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return None, ref
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._ops = []
+
+    def set(self, ref, data):
+        self._ops.append((ref, data))
+
+    def delete(self, ref):
+        self._ops.append((ref, None))
+
+    def commit(self):
+        self._client.round_trips += 1
+        for ref, data in self._ops:
+            self._client._write(ref._collection, ref.id, data)
+        self._ops = []
+
+
+class FakeBulkWriter(FakeWriteBatch):
+    # Il BulkWriter reale invia lotti da 20 operazioni in parallelo
+    BATCH = 20
+
+    def create(self, ref, data):
+        self.set(ref, data)
+
+    def flush(self):
+        while self._ops:
+            ops, self._ops = self._ops[:self.BATCH], self._ops[self.BATCH:]
+            pending = FakeWriteBatch(self._client)
+            pending._ops = ops
+            pending.commit()
+
+    def close(self):
+        self.flush()
+
+
+class FakeClient:
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+        self.round_trips = 0
+
+    def _write(self, collection, doc_id, data):
+        with self._lock:
+            docs = self._data.setdefault(collection, {})
+            if data is None:
+                docs.pop(doc_id, None)
+            else:
+                docs[doc_id] = copy.deepcopy(data)
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def bulk_writer(self):
+        return FakeBulkWriter(self)
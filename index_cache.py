@@ -0,0 +1,196 @@
+# index_cache.py
+# Cache su disco degli indici FAISS, indirizzata per contenuto.
+#
+# Ogni indice vive in una cartella il cui nome è l'hash dei byte del PDF
+# più i parametri di chunking/embedding: lo stesso PDF caricato da più
+# studenti viene indicizzato una volta sola.
+
+import os
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import tempfile
+
+import faiss
+from langchain_community.vectorstores import FAISS
+
+# Versione del formato su disco: cambiarla invalida tutte le chiavi esistenti
+CACHE_FORMAT_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.environ.get("STUDY_MASTER_INDEX_CACHE_DIR", os.path.join(".cache", "indexes"))
+DEFAULT_MAX_BYTES = int(os.environ.get("STUDY_MASTER_INDEX_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+_TMP_PREFIX = ".tmp-"
+_TRASH_PREFIX = ".trash-"
+_META_FILE = "meta.json"
+# Nomi dei file scritti da FAISS.save_local
+INDEX_FILE = "index.faiss"
+DOCSTORE_FILE = "index.pkl"
+_STALE_TMP_SECONDS = 3600
+
+
+def make_cache_key(pdf_bytes, **params):
+    """Hash del PDF + parametri che influenzano l'indice (chunk_size, modello, ...)."""
+    h = hashlib.sha256()
+    h.update(pdf_bytes)
+    h.update(json.dumps({"v": CACHE_FORMAT_VERSION, **params}, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def _read_index_mmap(index_path):
+    # IO_FLAG_MMAP_IFC (faiss >= 1.9) mappa anche gli indici flat; IO_FLAG_MMAP
+    # copre IVF e versioni precedenti. Se il tipo di indice non lo supporta, lettura normale.
+    for flag_name in ("IO_FLAG_MMAP_IFC", "IO_FLAG_MMAP"):
+        flag = getattr(faiss, flag_name, None)
+        if flag is None:
+            continue
+        try:
+            return faiss.read_index(index_path, flag | faiss.IO_FLAG_READ_ONLY), True
+        except RuntimeError:
+            continue
+    return faiss.read_index(index_path), False
+
+
+def _load_mmap(path, embeddings):
+    # Come FAISS.load_local, ma con l'indice mappato in memoria
+    index, mapped = _read_index_mmap(os.path.join(path, INDEX_FILE))
+    with open(os.path.join(path, DOCSTORE_FILE), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    vectorstore = FAISS(embeddings, index, docstore, index_to_docstore_id)
+    vectorstore.mmapped = mapped
+    return vectorstore
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+class IndexCache:
+    """Archivio di indici FAISS su disco con eviction LRU a budget di spazio.
+
+    Le scritture sono atomiche: l'indice viene salvato in una cartella
+    temporanea e poi rinominato. Se due processi indicizzano lo stesso PDF
+    in parallelo vince il primo rename, l'altro scarta la propria copia.
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def contains(self, key):
+        return os.path.isfile(os.path.join(self._path(key), _META_FILE))
+
+    def index_path(self, key):
+        return os.path.join(self._path(key), INDEX_FILE)
+
+    def load(self, key, embeddings, mmap=False):
+        """Restituisce il vectorstore salvato, oppure None se non presente o corrotto.
+
+        Con mmap=True i vettori sono mappati in memoria invece che copiati: più
+        processi che aprono lo stesso indice condividono le pagine della page cache.
+        """
+        path = self._path(key)
+        if not self.contains(key):
+            return None
+        try:
+            if mmap:
+                vectorstore = _load_mmap(path, embeddings)
+            else:
+                vectorstore = FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+        except Exception:
+            # Indice illeggibile (scrittura interrotta, versione FAISS diversa...): lo scartiamo
+            self._remove(path)
+            return None
+        self._touch(path)
+        return vectorstore
+
+    def load_extra(self, key, name):
+        """Byte di un file accessorio salvato con store(extra_files=...), o None."""
+        try:
+            with open(os.path.join(self._path(key), name), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def store(self, key, vectorstore, extra_files=None, **meta):
+        """Salva l'indice sotto `key` e applica il budget di spazio.
+
+        `extra_files` ({nome: bytes}) vengono salvati nella stessa cartella,
+        nella stessa scrittura atomica (es. l'indice lessicale BM25).
+        """
+        if self.contains(key):
+            self._touch(self._path(key))
+            return
+        tmp = tempfile.mkdtemp(prefix=_TMP_PREFIX, dir=self.root)
+        try:
+            vectorstore.save_local(tmp)
+            for name, data in (extra_files or {}).items():
+                with open(os.path.join(tmp, name), "wb") as f:
+                    f.write(data)
+            with open(os.path.join(tmp, _META_FILE), "w") as f:
+                json.dump({"created": time.time(), **meta}, f)
+            try:
+                os.rename(tmp, self._path(key))
+            except OSError:
+                # Un altro writer ha già pubblicato lo stesso indice
+                self._remove(tmp)
+        except Exception:
+            self._remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Rimuove gli indici usati meno di recente finché si rientra nel budget."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if name.startswith((_TMP_PREFIX, _TRASH_PREFIX)):
+                # Residui di writer terminati a metà scrittura
+                if time.time() - mtime > _STALE_TMP_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            if not os.path.isdir(path):
+                continue
+            size = _dir_size(path)
+            entries.append((mtime, path, size))
+            total += size
+
+        entries.sort()
+        for _, path, size in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def _remove(self, path):
+        # Rename prima del delete: i lettori non vedono mai una cartella a metà
+        trash = os.path.join(self.root, f"{_TRASH_PREFIX}{os.getpid()}-{time.monotonic_ns()}")
+        try:
+            os.rename(path, trash)
+        except OSError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
@@ -0,0 +1,162 @@
+# index_registry.py
+# Registro di processo degli indici FAISS, condivisi in sola lettura.
+#
+# Tutte le sessioni Streamlit che interrogano lo stesso documento ricevono
+# lo stesso oggetto, caricato una volta dalla cache su disco (mappato in
+# memoria quando FAISS lo consente: i worker di processi diversi condividono
+# le pagine tramite la page cache del sistema operativo). Gli indici usati
+# meno di recente escono dal registro quando si supera il budget di memoria.
+
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import bm25
+import ann_index
+
+DEFAULT_MAX_BYTES = int(os.environ.get("STUDY_MASTER_INDEX_MEMORY_MB", "1024")) * 1024 * 1024
+
+
+def _docstore_bytes(vectorstore):
+    docs = getattr(vectorstore.docstore, "_dict", {})
+    return sum(sys.getsizeof(doc.page_content) for doc in docs.values())
+
+
+def estimate_bytes(vectorstore):
+    """Memoria privata stimata dell'indice: codici FAISS + testo dei chunk nel docstore.
+
+    Per un indice mappato i vettori stanno nella page cache (condivisa tra
+    processi) e non vengono contati.
+    """
+    total = _docstore_bytes(vectorstore) + getattr(vectorstore, "lexical_bytes", 0)
+    if not getattr(vectorstore, "mmapped", False):
+        total += ann_index.memory_bytes(vectorstore.index)
+    return total
+
+
+def mapped_rss(path):
+    """Byte residenti (RSS) della mappatura di `path` nel processo corrente, se Linux."""
+    try:
+        with open("/proc/self/smaps") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    path = os.path.realpath(path)
+    total, inside = 0, False
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 6 and "-" in fields[0]:
+            # Intestazione di una mappatura: indirizzi perms offset dev inode path
+            inside = os.path.realpath(fields[5]) == path if fields[5].startswith("/") else False
+        elif inside and fields[0] == "Rss:":
+            total += int(fields[1]) * 1024
+    return total
+
+
+class _Entry:
+    __slots__ = ("vectorstore", "bytes", "hits")
+
+    def __init__(self, vectorstore, size):
+        self.vectorstore = vectorstore
+        self.bytes = size
+        self.hits = 0
+
+
+class IndexRegistry:
+    """Indici condivisi per chiave di contenuto, con LRU a budget di memoria.
+
+    `embeddings` può essere il modello o una funzione senza argomenti che lo
+    restituisce, chiamata solo quando serve caricare un indice dal disco.
+    """
+
+    def __init__(self, index_cache, embeddings, max_bytes=DEFAULT_MAX_BYTES):
+        self.index_cache = index_cache
+        self._embeddings = embeddings
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}      # chiave -> Lock: un solo caricamento per chiave
+
+    def get(self, key):
+        """Indice condiviso per `key`: dalla memoria, oppure dalla cache su disco. None se assente."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry.hits += 1
+                return entry.vectorstore
+            load_lock = self._loading.setdefault(key, threading.Lock())
+
+        with load_lock:
+            # Un'altra sessione potrebbe averlo caricato mentre aspettavamo
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None:
+                return entry.vectorstore
+            vectorstore = self.index_cache.load(key, self.embeddings, mmap=True)
+            if vectorstore is not None:
+                self._add(key, vectorstore)
+        with self._lock:
+            self._loading.pop(key, None)
+        return vectorstore
+
+    @property
+    def embeddings(self):
+        if callable(self._embeddings) and not hasattr(self._embeddings, "embed_query"):
+            self._embeddings = self._embeddings()
+        return self._embeddings
+
+    def put(self, key, vectorstore):
+        """Registra un indice appena costruito (preferire get() dopo averlo salvato su disco)."""
+        self._add(key, vectorstore)
+        return vectorstore
+
+    def _attach_lexical(self, key, vectorstore):
+        # Indice BM25 salvato all'ingestione; per indici più vecchi lo si ricostruisce dal docstore
+        data = self.index_cache.load_extra(key, bm25.FILE_NAME)
+        if data is not None:
+            vectorstore.lexical_index = bm25.BM25Index.from_bytes(data)
+        else:
+            vectorstore.lexical_index = bm25.BM25Index.from_vectorstore(vectorstore)
+            data = vectorstore.lexical_index.to_bytes()
+        vectorstore.lexical_bytes = len(data)
+
+    def _add(self, key, vectorstore):
+        if getattr(vectorstore, "lexical_index", None) is None:
+            self._attach_lexical(key, vectorstore)
+        size = estimate_bytes(vectorstore)
+        with self._lock:
+            self._entries[key] = _Entry(vectorstore, size)
+            self._entries.move_to_end(key)
+            total = sum(e.bytes for e in self._entries.values())
+            # Le sessioni che tengono ancora un riferimento lo liberano al prossimo rerun
+            while total > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                total -= evicted.bytes
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        """Una riga per indice: chiave, vettori, tipo, byte stimati, RSS mappato, hit."""
+        with self._lock:
+            items = list(self._entries.items())
+        rows = []
+        for key, entry in items:
+            mmapped = getattr(entry.vectorstore, "mmapped", False)
+            rows.append({
+                "key": key[:12],
+                "vectors": entry.vectorstore.index.ntotal,
+                "type": ann_index.index_kind(entry.vectorstore.index),
+                "bytes": entry.bytes,
+                "mmapped": mmapped,
+                "mapped_rss": mapped_rss(self.index_cache.index_path(key)) if mmapped else None,
+                "hits": entry.hits,
+            })
+        return rows
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(e.bytes for e in self._entries.values())
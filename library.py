@@ -0,0 +1,164 @@
+# library.py
+# Libreria di documenti per utente.
+#
+# I PDF sono salvati una volta sola, indirizzati per hash del contenuto:
+# lo stesso file caricato da più utenti occupa un solo blob e (tramite
+# index_cache) un solo indice. La libreria di ogni utente contiene solo i
+# riferimenti (doc_id + nome file) ed è salvata nel backend di storage.
+# Quando l'ultimo riferimento sparisce il blob viene cancellato (release);
+# per questo il riferimento va aggiunto prima di put().
+
+import os
+import hashlib
+import tempfile
+import threading
+from typing import List, Optional
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+import metrics
+from bm25 import reciprocal_rank_fusion
+
+DEFAULT_PDF_DIR = os.environ.get("STUDY_MASTER_PDF_DIR", os.path.join(".cache", "pdfs"))
+
+
+def document_id(pdf_bytes):
+    """Identità del documento: hash dei soli byte del PDF."""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+class PdfStore:
+    """Blob store dei PDF, un file per doc_id, con scritture atomiche."""
+
+    def __init__(self, root=DEFAULT_PDF_DIR):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+        # put e release non si sovrappongono: un PDF appena aggiunto non viene cancellato
+        self._lock = threading.Lock()
+
+    def _path(self, doc_id):
+        return os.path.join(self.root, f"{doc_id}.pdf")
+
+    def put(self, pdf_bytes):
+        doc_id = document_id(pdf_bytes)
+        path = self._path(doc_id)
+        with self._lock:
+            if not os.path.exists(path):
+                fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(pdf_bytes)
+                # Contenuto identico per costruzione: se un altro writer ci ha preceduti va bene lo stesso
+                os.replace(tmp, path)
+        return doc_id
+
+    def release(self, doc_id, in_use):
+        """Cancella il PDF se `in_use(doc_id)` è falso (nessuna libreria lo contiene); True se cancellato."""
+        with self._lock:
+            if in_use(doc_id):
+                return False
+            try:
+                os.remove(self._path(doc_id))
+            except FileNotFoundError:
+                return False
+        metrics.incr("pdf_blobs_deleted")
+        return True
+
+    def get(self, doc_id):
+        try:
+            with open(self._path(doc_id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+def _matches(metadata, filter):
+    # Stessa semantica del filtro a dizionario di FAISS: uguaglianza, o appartenenza se lista
+    for key, value in filter.items():
+        if isinstance(value, list):
+            if metadata.get(key) not in value:
+                return False
+        elif metadata.get(key) != value:
+            return False
+    return True
+
+
+class MultiDocRetriever(BaseRetriever):
+    """Cerca in più documenti e unisce i risultati.
+
+    `stores` è una lista di (doc_id, nome file, vectorstore FAISS). Tutti gli
+    indici usano lo stesso modello di embedding, quindi le distanze sono
+    confrontabili e la domanda viene vettorizzata una volta sola. `filter`
+    è passato a ogni indice per filtrare sui metadati dei chunk (es. pagina).
+
+    Con search_type="hybrid" alla classifica per similarità si affianca quella
+    BM25 dell'indice lessicale (vectorstore.lexical_index) e le due vengono
+    fuse con reciprocal rank fusion pesata; "similarity" usa solo i vettori.
+    """
+
+    stores: list
+    k: int = 6
+    filter: Optional[dict] = None
+    search_type: str = "hybrid"
+    vector_weight: float = 1.0
+    lexical_weight: float = 1.0
+    # Candidati per classifica prima della fusione
+    fetch_k: int = 20
+    rrf_k: int = 60
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query, *, run_manager=None) -> List[Document]:
+        if not self.stores:
+            return []
+        with metrics.span("retrieval", mode=self.search_type):
+            return self._search(query)
+
+    def _search(self, query):
+        fetch_k = self.fetch_k if self.search_type == "hybrid" else self.k
+        vector = self.stores[0][2].embedding_function.embed_query(query)
+
+        docs = {}
+        vector_hits = []
+        lexical_hits = []
+        for doc_id, filename, vectorstore in self.stores:
+            for doc, score in vectorstore.similarity_search_with_score_by_vector(vector, k=fetch_k, filter=self.filter):
+                key = (doc_id, doc.metadata.get("start_index", doc.page_content))
+                docs[key] = (doc, filename)
+                vector_hits.append((score, key))
+
+            lexical = getattr(vectorstore, "lexical_index", None)
+            if self.search_type != "hybrid" or lexical is None:
+                continue
+            ids = vectorstore.index_to_docstore_id
+            allowed = None
+            if self.filter:
+                allowed = {i for i in range(len(ids))
+                           if _matches(vectorstore.docstore.search(ids[i]).metadata, self.filter)}
+            for position, score in lexical.search(query, k=fetch_k, allowed=allowed):
+                doc = vectorstore.docstore.search(ids[position])
+                key = (doc_id, doc.metadata.get("start_index", doc.page_content))
+                docs[key] = (doc, filename)
+                lexical_hits.append((-score, key))
+
+        # Distanza L2: più piccola = più simile; BM25 negato per lo stesso ordinamento
+        vector_hits.sort(key=lambda item: item[0])
+        lexical_hits.sort(key=lambda item: item[0])
+        vector_ranking = [key for _, key in vector_hits]
+        if lexical_hits:
+            ranking = reciprocal_rank_fusion(
+                [vector_ranking, [key for _, key in lexical_hits]],
+                weights=[self.vector_weight, self.lexical_weight],
+                k=self.rrf_k,
+            )
+        else:
+            ranking = vector_ranking
+
+        results = []
+        for key in ranking[:self.k]:
+            doc, filename = docs[key]
+            # Copia: i Document appartengono al docstore condiviso
+            metadata = {**doc.metadata, "doc_id": key[0], "source": filename}
+            results.append(Document(page_content=doc.page_content, metadata=metadata))
+        return results
@@ -0,0 +1,91 @@
+# llm_clients.py
+# Registro di processo dei client LLM.
+#
+# Un client ChatGoogleGenerativeAI tiene aperto il proprio canale gRPC
+# (HTTP/2, multiplexato): riusarlo tra domande e sessioni evita di rifare
+# setup e handshake TLS a ogni messaggio. Vive in un modulo importato
+# (non in app.py, che Streamlit riesegue a ogni rerun).
+#
+# get_llm restituisce un involucro leggero che fa passare ogni chiamata
+# dallo scheduler di processo (llm_scheduler): limiti per API key, coda
+# equa tra utenti, richieste identiche unite e ritentativi con backoff.
+
+import json
+import hashlib
+import threading
+from typing import Any
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_google_genai import ChatGoogleGenerativeAI
+
+import llm_scheduler
+
+_lock = threading.Lock()
+_clients = {}
+# Con chiavi inserite a mano dagli utenti il registro non deve crescere senza limite
+MAX_CLIENTS = 64
+
+
+def get_client(model, temperature, api_key):
+    """Client condiviso per (modello, temperatura, API key)."""
+    key = (model, float(temperature), api_key)
+    with _lock:
+        llm = _clients.get(key)
+        if llm is None:
+            # Un solo tentativo nel client: i ritentativi li gestisce lo scheduler
+            llm = ChatGoogleGenerativeAI(model=model, temperature=temperature, google_api_key=api_key,
+                                         max_retries=1)
+            if len(_clients) >= MAX_CLIENTS:
+                _clients.pop(next(iter(_clients)))
+            _clients[key] = llm
+        return llm
+
+
+def _request_key(model, temperature, messages, stop):
+    # Stesso modello, temperatura e messaggi: la stessa richiesta
+    payload = json.dumps([model, temperature, [(m.type, m.content) for m in messages], stop],
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ScheduledChatModel(BaseChatModel):
+    """Delega al client condiviso passando dallo scheduler; `user` serve alla coda equa."""
+
+    client: Any
+    key: str
+    user: str = "system"
+    scheduler: Any = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @property
+    def _llm_type(self):
+        return self.client._llm_type
+
+    def _scheduler(self):
+        return self.scheduler or llm_scheduler.SCHEDULER
+
+    def _request(self, messages, stop):
+        return _request_key(self.client.model, self.client.temperature, messages, stop)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return self._scheduler().call(
+            self.key, self.user, self._request(messages, stop),
+            lambda: self.client._generate(messages, stop=stop, **kwargs),
+        )
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for chunk in self._scheduler().stream(
+            self.key, self.user, self._request(messages, stop),
+            lambda: self.client._stream(messages, stop=stop, **kwargs),
+        ):
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+def get_llm(model, temperature, api_key, user="system"):
+    """Modello per le chiamate di `user`: client condiviso + scheduler di processo."""
+    return ScheduledChatModel(client=get_client(model, temperature, api_key),
+                              key=llm_scheduler.key_id(api_key), user=user)
@@ -0,0 +1,328 @@
+# llm_scheduler.py
+# Scheduler di processo per le chiamate LLM.
+#
+# Tutte le sessioni passano da qui: per ogni API key un limite di richieste
+# contemporanee e di richieste al minuto (token bucket), con una coda equa
+# tra utenti (round robin: chi ha già una richiesta in corso non scavalca
+# gli altri). Richieste identiche in volo vengono unite in una sola chiamata
+# e gli errori di quota o di servizio sono ritentati con backoff esponenziale
+# e jitter, senza che lo studente debba riprovare a mano.
+
+import os
+import time
+import random
+import hashlib
+import threading
+from collections import deque
+
+import metrics
+
+DEFAULT_CONCURRENCY = int(os.environ.get("STUDY_MASTER_LLM_CONCURRENCY", "4"))
+DEFAULT_RPM = float(os.environ.get("STUDY_MASTER_LLM_RPM", "60"))
+DEFAULT_MAX_WAIT = float(os.environ.get("STUDY_MASTER_LLM_MAX_WAIT", "120"))
+DEFAULT_RETRIES = int(os.environ.get("STUDY_MASTER_LLM_RETRIES", "4"))
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+
+# Errori transitori di Gemini / google-api-core, riconosciuti per nome per non importare il client
+_RETRYABLE_NAMES = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded",
+                    "InternalServerError", "GatewayTimeout"}
+_RETRYABLE_TEXT = ("429", "quota", "rate limit", "resource exhausted", "503", "unavailable", "overloaded")
+
+
+class LLMBusyError(RuntimeError):
+    """Il servizio resta sovraccarico dopo attese e tentativi."""
+
+
+def is_retryable(error):
+    if type(error).__name__ in _RETRYABLE_NAMES:
+        return True
+    text = str(error).lower()
+    return any(marker in text for marker in _RETRYABLE_TEXT)
+
+
+def key_id(api_key):
+    """Identificativo della chiave per log e metriche (mai la chiave in chiaro)."""
+    return hashlib.sha256((api_key or "").encode()).hexdigest()[:8]
+
+
+class _KeyLimiter:
+    """Slot di concorrenza e token bucket di una API key, assegnati in round robin tra utenti."""
+
+    def __init__(self, name, concurrency, rpm):
+        self.name = name
+        self.concurrency = concurrency
+        self.rate = rpm / 60.0
+        self.capacity = max(1.0, min(rpm, concurrency))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.active = 0
+        self.queues = {}            # utente -> deque di ticket
+        self.turns = deque()        # utenti in attesa, nell'ordine in cui tocca a loro
+        self.cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def queued(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def acquire(self, user, timeout):
+        ticket = object()
+        start = time.monotonic()
+        with self.cond:
+            queue = self.queues.setdefault(user, deque())
+            queue.append(ticket)
+            if user not in self.turns:
+                self.turns.append(user)
+            metrics.gauge("llm_queue_depth", self.queued(), key=self.name)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    my_turn = self.turns and self.turns[0] == user and queue[0] is ticket
+                    if my_turn and self.active < self.concurrency and self.tokens >= 1:
+                        break
+                    remaining = timeout - (now - start)
+                    if remaining <= 0:
+                        raise LLMBusyError("Il servizio è molto richiesto in questo momento: riprova tra poco.")
+                    wait = remaining
+                    if my_turn and self.active < self.concurrency:
+                        # Manca solo un token: si attende esattamente il tempo di ricarica
+                        wait = min(wait, (1 - self.tokens) / self.rate)
+                    self.cond.wait(wait)
+            except BaseException:
+                queue.remove(ticket)
+                if not queue and user in self.turns:
+                    self.turns.remove(user)
+                self.cond.notify_all()
+                raise
+            queue.popleft()
+            self.turns.popleft()
+            if queue:
+                # Le altre richieste dello stesso utente tornano in fondo al giro
+                self.turns.append(user)
+            else:
+                del self.queues[user]
+            self.active += 1
+            self.tokens -= 1
+            metrics.gauge("llm_queue_depth", self.queued(), key=self.name)
+            metrics.gauge("llm_active", self.active, key=self.name)
+            self.cond.notify_all()
+        waited = time.monotonic() - start
+        metrics.observe("llm_queue_wait", waited, key=self.name)
+        return waited
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            metrics.gauge("llm_active", self.active, key=self.name)
+            self.cond.notify_all()
+
+
+class _Flight:
+    """Richiesta in volo condivisa: risultato unico o pezzi dello stream ripetuti ai follower."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.result = None
+        self.error = None
+        self.done = False
+        self.followers = 0
+
+    def push(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+
+    def finish(self, result=None, error=None):
+        with self.cond:
+            self.result = result
+            self.error = error
+            self.done = True
+            self.cond.notify_all()
+
+    def replay(self):
+        index = 0
+        while True:
+            with self.cond:
+                while index >= len(self.chunks) and not self.done:
+                    self.cond.wait()
+                if index < len(self.chunks):
+                    chunk = self.chunks[index]
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            index += 1
+            yield chunk
+
+    def wait(self):
+        with self.cond:
+            while not self.done:
+                self.cond.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class LLMScheduler:
+    """Punto unico da cui passano le chiamate LLM di tutte le sessioni."""
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, rpm=DEFAULT_RPM, max_wait=DEFAULT_MAX_WAIT,
+                 retries=DEFAULT_RETRIES, sleep=time.sleep):
+        self.concurrency = concurrency
+        self.rpm = rpm
+        self.max_wait = max_wait
+        self.retries = retries
+        self._sleep = sleep
+        self._limiters = {}
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+        self.retried = 0
+
+    def _limiter(self, key):
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiter = self._limiters[key] = _KeyLimiter(key, self.concurrency, self.rpm)
+            return limiter
+
+    def _join(self, request_key):
+        """(flight, leader): il primo chiamante esegue, gli altri aspettano il suo risultato.
+
+        `request_key` comprende il tipo di chiamata e la API key: una richiesta
+        non si unisce mai a una in volo con un'altra chiave (risultato, errori
+        e quota sono suoi), né una call() a uno stream() o viceversa (il leader
+        di uno stream non ha un risultato, quello di una call non ha pezzi).
+        """
+        with self._lock:
+            flight = self._flights.get(request_key)
+            if flight is not None:
+                flight.followers += 1
+                self.coalesced += 1
+                metrics.incr("llm_coalesced")
+                return flight, False
+            flight = self._flights[request_key] = _Flight()
+            return flight, True
+
+    def _leave(self, request_key, flight):
+        with self._lock:
+            if self._flights.get(request_key) is flight:
+                del self._flights[request_key]
+
+    def _backoff(self, attempt, error, key):
+        """Secondi da attendere prima del prossimo tentativo, o None se non si ritenta."""
+        if attempt >= self.retries or not is_retryable(error):
+            return None
+        self.retried += 1
+        metrics.incr("llm_retries", key=key)
+        # Full jitter: attese casuali evitano che le sessioni ritentino tutte insieme
+        return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+    def call(self, key, user, request_key, func):
+        """Esegue func() con limiti, coda equa, coalescing su `request_key` e ritentativi."""
+        request_key = ("call", key, request_key) if request_key else None
+        flight, leader = self._join(request_key) if request_key else (None, True)
+        if not leader:
+            return flight.wait()
+        limiter = self._limiter(key)
+        try:
+            attempt = 0
+            while True:
+                limiter.acquire(user, self.max_wait)
+                try:
+                    with metrics.span("llm_call", key=key):
+                        result = func()
+                    break
+                except Exception as e:
+                    delay = self._backoff(attempt, e, key)
+                    if delay is None:
+                        raise
+                finally:
+                    limiter.release()
+                # Lo slot è già libero: durante l'attesa lo usano le richieste degli altri
+                self._sleep(delay)
+                attempt += 1
+        except BaseException as e:
+            if flight is not None:
+                flight.finish(error=e)
+            raise
+        finally:
+            if flight is not None:
+                self._leave(request_key, flight)
+        if flight is not None:
+            flight.finish(result=result)
+        return result
+
+    def stream(self, key, user, request_key, func):
+        """Come call(), per uno stream: func() restituisce un iteratore di pezzi.
+
+        Si ritenta solo se l'errore arriva prima del primo pezzo; i follower
+        ricevono gli stessi pezzi del leader man mano che arrivano.
+        """
+        request_key = ("stream", key, request_key) if request_key else None
+        flight, leader = self._join(request_key) if request_key else (None, True)
+        if not leader:
+            yield from flight.replay()
+            return
+        limiter = self._limiter(key)
+        error = None
+        try:
+            attempt = 0
+            while True:
+                limiter.acquire(user, self.max_wait)
+                started = False
+                try:
+                    with metrics.span("llm_call", key=key, stream=True):
+                        for chunk in func():
+                            started = True
+                            if flight is not None:
+                                flight.push(chunk)
+                            yield chunk
+                    break
+                except Exception as e:
+                    delay = None if started else self._backoff(attempt, e, key)
+                    if delay is None:
+                        raise
+                finally:
+                    limiter.release()
+                self._sleep(delay)
+                attempt += 1
+        except GeneratorExit:
+            # Il leader ha smesso di leggere (rerun interrotto): i follower non avranno il resto
+            error = LLMBusyError("Risposta interrotta: riprova.")
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if flight is not None:
+                self._leave(request_key, flight)
+                flight.finish(error=error)
+
+    def stats(self):
+        """Una riga per API key: richieste attive, in coda, utenti in attesa, token disponibili."""
+        with self._lock:
+            limiters = list(self._limiters.values())
+            in_flight = len(self._flights)
+        rows = []
+        for limiter in limiters:
+            with limiter.cond:
+                limiter._refill(time.monotonic())
+                rows.append({
+                    "key": limiter.name,
+                    "active": limiter.active,
+                    "queued": limiter.queued(),
+                    "waiting_users": len(limiter.turns),
+                    "tokens": round(limiter.tokens, 1),
+                    "concurrency": limiter.concurrency,
+                    "rpm": self.rpm,
+                })
+        return {"keys": rows, "in_flight": in_flight, "coalesced": self.coalesced, "retried": self.retried}
+
+
+SCHEDULER = LLMScheduler()
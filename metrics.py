@@ -0,0 +1,284 @@
+# metrics.py
+# Strumentazione leggera: span per fase, istogrammi e contatori di processo.
+#
+# Ogni fase (estrazione PDF, embedding, ricerca, chiamata LLM, scrittura DB)
+# si misura con `with metrics.span("fase"):`. Le durate finiscono in
+# istogrammi a bucket fissi (formato Prometheus) e in una finestra delle
+# ultime osservazioni per p50/p95. Con STUDY_MASTER_METRICS=0 span() ritorna
+# un oggetto vuoto condiviso e le altre funzioni escono subito.
+
+import os
+import json
+import time
+import atexit
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ENABLED = os.environ.get("STUDY_MASTER_METRICS", "1") != "0"
+# Se impostato, ogni span viene anche accodato come riga JSON in questo file
+JSONL_PATH = os.environ.get("STUDY_MASTER_METRICS_JSONL")
+PREFIX = "study_master"
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Osservazioni recenti tenute per fase, per i percentili del pannello admin
+RECENT_SAMPLES = 512
+_JSONL_FLUSH_EVERY = 50
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count", "recent")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _escape_label(value):
+    # Formato testuale di Prometheus: backslash, virgolette e a capo vanno escapati
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key, extra=None):
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in items) + "}"
+
+
+class Registry:
+    """Istogrammi e contatori del processo, condivisi da tutte le sessioni."""
+
+    def __init__(self, jsonl_path=JSONL_PATH):
+        self._lock = threading.Lock()
+        self._histograms = {}       # (nome, etichette) -> _Histogram
+        self._counters = {}         # (nome, etichette) -> valore
+        self._gauges = {}           # (nome, etichette) -> valore attuale
+        self.jsonl_path = jsonl_path
+        self._events = []
+
+    def observe(self, name, seconds, labels=None, error=False):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram()
+            histogram.observe(seconds)
+            if self.jsonl_path:
+                event = {"ts": round(time.time(), 3), "name": name, "seconds": round(seconds, 6), **(labels or {})}
+                if error:
+                    event["error"] = True
+                self._events.append(event)
+                if len(self._events) >= _JSONL_FLUSH_EVERY:
+                    self._flush_events()
+
+    def incr(self, name, value=1, labels=None):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, labels=None):
+        with self._lock:
+            self._gauges[(name, _labels_key(labels))] = value
+
+    def _flush_events(self):
+        events, self._events = self._events, []
+        if not events:
+            return
+        try:
+            if os.path.dirname(self.jsonl_path):
+                os.makedirs(os.path.dirname(self.jsonl_path), exist_ok=True)
+            with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(e) + "\n" for e in events))
+        except OSError:
+            pass
+
+    def flush(self):
+        with self._lock:
+            if self.jsonl_path:
+                self._flush_events()
+
+    def summary(self):
+        """Una riga per istogramma: nome, etichette, conteggio, p50/p95 recenti in ms."""
+        with self._lock:
+            items = [(key, list(h.recent), h.count) for key, h in self._histograms.items()]
+        rows = []
+        for (name, labels), recent, count in sorted(items):
+            recent.sort()
+            rows.append({
+                "stage": name,
+                **dict(labels),
+                "count": count,
+                "p50_ms": round(recent[len(recent) // 2] * 1000, 1) if recent else None,
+                "p95_ms": round(recent[int(len(recent) * 0.95)] * 1000, 1) if recent else None,
+            })
+        return rows
+
+    def counters(self):
+        with self._lock:
+            return {name + _format_labels(labels): value for (name, labels), value in sorted(self._counters.items())}
+
+    def gauges(self):
+        with self._lock:
+            return {name + _format_labels(labels): value for (name, labels), value in sorted(self._gauges.items())}
+
+    def prometheus_text(self):
+        """Esposizione nel formato testuale di Prometheus."""
+        with self._lock:
+            histograms = [(key, list(h.counts), h.sum, h.count) for key, h in self._histograms.items()]
+            counters = list(self._counters.items())
+            gauges = list(self._gauges.items())
+        lines = []
+        seen = set()
+        for (name, labels), counts, total, count in sorted(histograms):
+            metric = f"{PREFIX}_{name}_seconds"
+            if metric not in seen:
+                lines.append(f"# TYPE {metric} histogram")
+                seen.add(metric)
+            cumulative = 0
+            for bound, n in zip(BUCKETS, counts):
+                cumulative += n
+                lines.append(f"{metric}_bucket{_format_labels(labels, ('le', bound))} {cumulative}")
+            lines.append(f"{metric}_bucket{_format_labels(labels, ('le', '+Inf'))} {count}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {count}")
+        for (name, labels), value in sorted(counters):
+            metric = f"{PREFIX}_{name}_total"
+            if metric not in seen:
+                lines.append(f"# TYPE {metric} counter")
+                seen.add(metric)
+            lines.append(f"{metric}{_format_labels(labels)} {value}")
+        for (name, labels), value in sorted(gauges):
+            metric = f"{PREFIX}_{name}"
+            if metric not in seen:
+                lines.append(f"# TYPE {metric} gauge")
+                seen.add(metric)
+            lines.append(f"{metric}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def jsonl_snapshot(self):
+        """Stato attuale come JSONL: una riga per istogramma e una per contatore."""
+        lines = [json.dumps({"type": "histogram", **row}) for row in self.summary()]
+        lines += [json.dumps({"type": "counter", "name": name, "value": value})
+                  for name, value in self.counters().items()]
+        lines += [json.dumps({"type": "gauge", "name": name, "value": value})
+                  for name, value in self.gauges().items()]
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+atexit.register(REGISTRY.flush)
+
+
+class _Span:
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        failed = exc_type is not None
+        REGISTRY.observe(self.name, time.perf_counter() - self.start, self.labels, error=failed)
+        if failed:
+            REGISTRY.incr("errors", labels={"stage": self.name, **(self.labels or {})})
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name, **labels):
+    """Misura il blocco `with` come fase `name`; le eccezioni contano in errors_total."""
+    if not ENABLED:
+        return _NOOP
+    return _Span(name, labels)
+
+
+def timed(name):
+    """Decoratore equivalente a span(); disabilitato, restituisce la funzione invariata."""
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        def wrapper(*args, **kwargs):
+            with _Span(name, None):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+def observe(name, seconds, **labels):
+    """Registra una durata misurata altrove (es. tempo al primo token)."""
+    if ENABLED and seconds is not None:
+        REGISTRY.observe(name, seconds, labels)
+
+
+def incr(name, value=1, **labels):
+    if ENABLED and value:
+        REGISTRY.incr(name, value, labels)
+
+
+def gauge(name, value, **labels):
+    """Valore istantaneo (es. profondità di una coda)."""
+    if ENABLED:
+        REGISTRY.set_gauge(name, value, labels)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = REGISTRY.prometheus_text(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.jsonl":
+            body, content_type = REGISTRY.jsonl_snapshot(), "application/x-ndjson"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host="127.0.0.1"):
+    """Espone /metrics (Prometheus) e /metrics.jsonl su un thread daemon."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -0,0 +1,133 @@
+# pdf_extract.py
+# Estrazione del testo dei PDF in parallelo, pagina per pagina.
+#
+# Le pagine vengono divise in intervalli ed estratte da un pool di processi
+# (pypdf è CPU-bound e non rilascia il GIL). I risultati arrivano in ordine
+# come generatore, con numero di pagina e offset nel testo complessivo.
+
+import io
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from pypdf import PdfReader
+
+# page: numero di pagina (da 1); offset: posizione del primo carattere nel testo concatenato
+PageText = namedtuple("PageText", ["page", "offset", "text"])
+
+DEFAULT_WORKERS = int(os.environ.get("STUDY_MASTER_PDF_WORKERS", "0")) or min(4, os.cpu_count() or 1)
+PAGES_PER_TASK = 16
+# Sotto questa soglia il costo di avvio del pool supera il guadagno
+MIN_PAGES_FOR_POOL = 48
+
+# Stato del processo worker: il PDF viene letto una volta sola per processo
+_worker_reader = None
+
+
+def _init_worker(pdf_bytes):
+    global _worker_reader
+    _worker_reader = PdfReader(io.BytesIO(pdf_bytes))
+
+
+def _extract_range(start, stop):
+    return [_extract_page(_worker_reader, i) for i in range(start, stop)]
+
+
+def _extract_page(reader, index):
+    try:
+        return reader.pages[index].extract_text() or ""
+    except Exception:
+        # Una pagina malformata non deve far fallire l'intero documento
+        return ""
+
+
+def _iter_raw_pages(pdf_bytes, workers, pages_per_task, on_progress):
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    total = len(reader.pages)
+
+    if workers <= 1 or total < MIN_PAGES_FOR_POOL:
+        for i in range(total):
+            yield _extract_page(reader, i)
+            if on_progress:
+                on_progress(i + 1, total)
+        return
+
+    ranges = [(s, min(s + pages_per_task, total)) for s in range(0, total, pages_per_task)]
+    # "spawn": il server Streamlit è multi-thread, fork non è sicuro
+    ctx = multiprocessing.get_context("spawn")
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                               initializer=_init_worker, initargs=(pdf_bytes,))
+    try:
+        futures = [pool.submit(_extract_range, s, e) for s, e in ranges]
+        for (_, stop), future in zip(ranges, futures):
+            for text in future.result():
+                yield text
+            if on_progress:
+                on_progress(stop, total)
+    finally:
+        # Se il consumatore interrompe il generatore non aspettiamo le pagine restanti
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def iter_pages(pdf_bytes, workers=None, pages_per_task=PAGES_PER_TASK, on_progress=None):
+    """Genera un PageText per ogni pagina del PDF, in ordine.
+
+    on_progress(pagine_fatte, pagine_totali) viene chiamato dal thread chiamante.
+    """
+    workers = DEFAULT_WORKERS if workers is None else workers
+    offset = 0
+    for index, text in enumerate(_iter_raw_pages(pdf_bytes, workers, pages_per_task, on_progress)):
+        yield PageText(page=index + 1, offset=offset, text=text)
+        offset += len(text)
+
+
+def page_at_offset(pages, offset):
+    """Numero di pagina che contiene il carattere `offset` del testo concatenato."""
+    lo, hi = 0, len(pages) - 1
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if pages[mid].offset <= offset:
+            lo = mid
+        else:
+            hi = mid - 1
+    return pages[lo].page if pages else None
+
+
+# --- BENCHMARK ---
+
+def benchmark(pdf_bytes, worker_counts=(1, 2, 4, 8), repeat=1):
+    """Misura pagine/sec per ciascun numero di worker."""
+    results = []
+    for workers in worker_counts:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            pages = sum(1 for _ in iter_pages(pdf_bytes, workers=workers))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append({"workers": workers, "pages": pages, "seconds": round(best, 3),
+                        "pages_per_sec": round(pages / best, 1) if best else None})
+    return results
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark estrazione PDF (pagine/sec per numero di worker)")
+    parser.add_argument("pdf")
+    parser.add_argument("--workers", default="1,2,4,8", help="numeri di worker separati da virgola")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    with open(args.pdf, "rb") as f:
+        data = f.read()
+    counts = [int(w) for w in args.workers.split(",")]
+    print(f"{'workers':>8} {'pagine':>8} {'secondi':>9} {'pag/s':>9}")
+    for r in benchmark(data, counts, args.repeat):
+        print(f"{r['workers']:>8} {r['pages']:>8} {r['seconds']:>9} {r['pages_per_sec']:>9}")
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
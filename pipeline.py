@@ -0,0 +1,185 @@
+# pipeline.py
+# Il percorso RAG senza Streamlit: parametri di indicizzazione, chunking,
+# catena di risposta e prompt. Lo usano sia app.py sia batch.py, così
+# interfaccia e modalità batch indicizzano e rispondono allo stesso modo.
+# I moduli pesanti sono importati al primo uso.
+
+import os
+
+import warmup
+
+index_cache = warmup.lazy_module("index_cache")
+pdf_extract = warmup.lazy_module("pdf_extract")
+embedding_cache = warmup.lazy_module("embedding_cache")
+library = warmup.lazy_module("library")
+context_packing = warmup.lazy_module("context_packing")
+conversation_memory = warmup.lazy_module("conversation_memory")
+
+LLM_MODEL = "gemini-2.5-flash"
+
+# Parametri di indicizzazione (fanno parte della chiave della cache indici)
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# Tipo di indice FAISS: "auto" (per numero di chunk) o flat/hnsw/sq8/sq16/ivfpq
+INDEX_TYPE = os.environ.get("STUDY_MASTER_INDEX_TYPE", "auto")
+
+# Recupero: "hybrid" (vettori + BM25 fusi con RRF) oppure "similarity" (solo vettori)
+RETRIEVAL_MODE = os.environ.get("STUDY_MASTER_RETRIEVAL_MODE", "hybrid")
+VECTOR_WEIGHT = 1.0
+LEXICAL_WEIGHT = 1.0
+# Budget di token del contesto passato al modello (chunk fusi e senza sovrapposizioni)
+CONTEXT_MAX_TOKENS = int(os.environ.get("STUDY_MASTER_CONTEXT_TOKENS", "2000"))
+
+# Modalità di studio: nome breve (batch) -> etichetta dell'interfaccia
+MODES = {
+    "chat": "💬 Chat / Spiegazione",
+    "quiz": "❓ Simulazione Quiz",
+    "flashcards": "🃏 Flashcards",
+}
+STYLES = ("Sintetico", "Bilanciato", "Esaustivo")
+
+
+def build_local_embeddings(db_path=None):
+    # Usa un modello di embedding leggero per CPU, con cache persistente per chunk
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+    return embedding_cache.CachedEmbeddings(model, EMBEDDING_MODEL,
+                                            db_path=db_path or embedding_cache.DEFAULT_DB_PATH)
+
+
+def get_document_key(pdf_bytes, embedding_model=EMBEDDING_MODEL):
+    """Hash del PDF + parametri di indicizzazione: identifica l'indice nelle cache."""
+    return index_cache.make_cache_key(
+        pdf_bytes,
+        embedding_model=embedding_model,
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        page_metadata=True,
+        # "auto" è deterministico dato il PDF: entra nella chiave solo se forzato
+        **({"index_type": INDEX_TYPE} if INDEX_TYPE != "auto" else {}),
+    )
+
+
+def split_pages(pages):
+    """Divide il testo in chunk e annota ciascuno con la pagina di origine."""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, add_start_index=True
+    )
+    raw_text = "".join(p.text for p in pages)
+    docs = text_splitter.create_documents([raw_text])
+    for doc in docs:
+        doc.metadata["page"] = pdf_extract.page_at_offset(pages, doc.metadata["start_index"])
+    return docs
+
+
+def build_rag_chain(documents, llm):
+    """Catena RAG sui documenti attivi: lista di (doc_id, nome file, vectorstore).
+
+    `llm` è il modello di chat da usare (di solito a temperatura bassa, per fedeltà al testo).
+    """
+    from langchain_core.prompts import ChatPromptTemplate, PromptTemplate, MessagesPlaceholder
+    from langchain.chains import create_retrieval_chain
+    from langchain.chains.combine_documents import create_stuff_documents_chain
+    # Aumentiamo k=6 per avere più contesto (top-k complessivo su tutti i documenti)
+    retriever = library.MultiDocRetriever(
+        stores=documents, k=6, search_type=RETRIEVAL_MODE,
+        vector_weight=VECTOR_WEIGHT, lexical_weight=LEXICAL_WEIGHT,
+    )
+    # Chunk adiacenti fusi, overlap rimossi, ordine per posizione, entro il budget
+    retriever = context_packing.PackedRetriever(retriever=retriever, max_tokens=CONTEXT_MAX_TOKENS)
+    
+    # Prompt STRICT MODE per vincolare al PDF
+    # (il riassunto della conversazione arriva dentro system_instruction, i turni recenti in chat_history)
+    prompt_template = ChatPromptTemplate.from_messages([
+        ("system", """{system_instruction}
+        
+        SEI IN MODALITÀ "DOCUMENTO ATTIVO".
+        
+        REGOLE TASSATIVE (STRICT MODE):
+        1. DEVI rispondere alla domanda dell'utente BASANDOTI ESCLUSIVAMENTE sui seguenti estratti dai documenti PDF forniti.
+        2. NON usare la tua conoscenza interna per rispondere a domande che non trovano riscontro nel testo.
+        3. Se l'informazione richiesta non è presente nel documento, DEVI RISPONDERE: "Mi dispiace, ma questa informazione non è presente nel documento PDF caricato." (Puoi suggerire di cercare online se rilevante, ma non inventare la risposta).
+        4. Cita il documento quando possibile per confermare le tue affermazioni, indicando file e numero di pagina.
+        
+        CONTESTO ESTRATTO DAL PDF:
+        {context}"""),
+        MessagesPlaceholder("chat_history", optional=True),
+        ("human", "{input}"),
+    ])
+    
+    # Ogni estratto porta file e numero di pagina, così il modello può citarli
+    document_prompt = PromptTemplate.from_template("[{source}, pagina {page}]\n{page_content}")
+    qa_chain = create_stuff_documents_chain(llm, prompt_template, document_prompt=document_prompt)
+    # Le domande di seguito cercano anche con la domanda precedente (vedi conversation_memory.search_query)
+    search = (lambda inputs: inputs.get("search_query") or inputs["input"]) | retriever
+    return create_retrieval_chain(search, qa_chain)
+
+
+def history_messages(memory):
+    """Turni recenti della memoria come messaggi langchain."""
+    from langchain_core.messages import HumanMessage, AIMessage
+    return [HumanMessage(content=m["content"]) if m["role"] == "user" else AIMessage(content=m["content"])
+            for m in memory.messages]
+
+
+def with_summary(system_instruction, memory):
+    if memory is None or not memory.summary:
+        return system_instruction
+    return f"{system_instruction}\n\nRIASSUNTO DELLA CONVERSAZIONE PRECEDENTE:\n{memory.summary}"
+
+
+def general_messages(user_input, system_instruction, memory=None):
+    """Messaggi per una risposta senza documenti: istruzioni (con riassunto), turni recenti, domanda."""
+    from langchain_core.messages import SystemMessage, HumanMessage
+    return [
+        SystemMessage(content=with_summary(system_instruction, memory)),
+        *(history_messages(memory) if memory else []),
+        HumanMessage(content=user_input)
+    ]
+
+
+def rag_inputs(user_input, system_instruction, memory=None):
+    """Input della catena RAG per una domanda, con la memoria della conversazione se presente."""
+    inputs = {"input": user_input, "system_instruction": with_summary(system_instruction, memory)}
+    if memory is not None:
+        inputs["chat_history"] = history_messages(memory)
+        inputs["search_query"] = conversation_memory.search_query(user_input, memory.messages)
+    return inputs
+
+
+def stream_rag(chain, inputs, packing=None):
+    """Genera solo i pezzi della chiave 'answer'; `packing` riceve le statistiche del contesto."""
+    for chunk in chain.stream(inputs):
+        if packing is not None and chunk.get("context"):
+            packing.update(chunk["context"][0].metadata.get("packing", {}))
+        if chunk.get("answer"):
+            yield chunk["answer"]
+
+
+def stream_general(llm, messages):
+    for chunk in llm.stream(messages):
+        if chunk.content:
+            yield chunk.content
+
+
+def get_system_instruction(mode, style, num_questions):
+    style_map = {
+        "Sintetico": "Sii estremamente conciso. Usa elenchi puntati.",
+        "Bilanciato": "Fornisci una risposta chiara e completa.",
+        "Esaustivo": "Spiega ogni dettaglio, includi contesto ed esempi."
+    }
+    style_text = style_map.get(style, "Rispondi normalmente.")
+
+    if mode == "💬 Chat / Spiegazione":
+        role = f"Sei un tutor universitario esperto. {style_text}"
+    elif mode == "❓ Simulazione Quiz":
+        role = (f"Sei un professore d'esame. Genera ORA {num_questions} domande difficili basate SOLO sul materiale fornito. "
+                "Numera le domande. NON dare le soluzioni.")
+    elif mode == "🃏 Flashcards":
+        role = f"Crea materiale di studio schematico basato SOLO sul testo. {style_text}. Formatta: **Termine** -> _Definizione_."
+    else:
+        role = "Sei un assistente utile."
+
+    return f"RUOLO: {role}"
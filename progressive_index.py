@@ -0,0 +1,194 @@
+# progressive_index.py
+# Indicizzazione progressiva dei PDF su un worker di background.
+#
+# Dopo l'upload il PDF viene estratto, diviso in chunk e vettorizzato a
+# lotti di `batch_size` chunk. Dopo il primo lotto si pubblica un'istantanea
+# (indice flat con tutti i chunk fin qui): la chat la interroga subito,
+# mentre il resto del documento viene indicizzato. Le istantanee successive
+# escono quando i chunk sono cresciuti di SNAPSHOT_GROWTH volte: ognuna
+# ricopia tutti i vettori, e a intervalli crescenti il costo totale resta
+# lineare nella lunghezza del documento invece che quadratico. Un'istantanea
+# non viene più modificata dopo la pubblicazione, quindi i lettori non hanno
+# bisogno di lock. A fine lavoro si costruisce l'indice definitivo (tipo
+# scelto da ann_index, con BM25), lo si salva in cache e lo si registra nel
+# registro condiviso.
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bm25
+import metrics
+import ann_index
+import pdf_extract
+from embedding_cache import EmbedStats
+
+DEFAULT_BATCH_SIZE = int(os.environ.get("STUDY_MASTER_INDEX_BATCH", "64"))
+# Un worker: l'embedding satura già la CPU, i documenti successivi aspettano in coda
+DEFAULT_WORKERS = int(os.environ.get("STUDY_MASTER_INDEX_WORKERS", "1"))
+# Nuova istantanea quando i chunk indicizzati superano di tanto quelli dell'ultima:
+# i vettori ricopiati in tutto restano circa 3 volte il documento
+SNAPSHOT_GROWTH = 1.5
+
+ACTIVE_STATES = ("queued", "extracting", "indexing", "finalizing")
+
+
+class IndexJob:
+    __slots__ = ("key", "filename", "state", "pages_done", "pages_total", "chunks_done", "chunks_total",
+                 "last_page", "vectorstore", "embed_stats", "error", "started", "finished", "_done")
+
+    def __init__(self, key, filename):
+        self.key = key
+        self.filename = filename
+        self.state = "queued"       # queued | extracting | indexing | finalizing | complete | empty | error
+        self.pages_done = 0
+        self.pages_total = 0
+        self.chunks_done = 0
+        self.chunks_total = 0
+        self.last_page = None       # ultima pagina coperta dall'istantanea
+        self.vectorstore = None     # ultima istantanea pubblicata
+        self.embed_stats = EmbedStats()
+        self.error = None
+        self.started = time.monotonic()
+        self.finished = None
+        self._done = threading.Event()
+
+    def active(self):
+        return self.state in ACTIVE_STATES
+
+    def wait(self, timeout=None):
+        """Attende la fine del job (completo, vuoto o fallito); False se scade il timeout."""
+        return self._done.wait(timeout)
+
+    def progress(self):
+        """Avanzamento 0-1: l'estrazione pesa il 20%, l'embedding il resto."""
+        if self.state in ("queued", "extracting"):
+            return 0.2 * self.pages_done / self.pages_total if self.pages_total else 0.0
+        if self.state == "indexing":
+            return 0.2 + 0.8 * self.chunks_done / self.chunks_total if self.chunks_total else 0.2
+        return 1.0
+
+
+class ProgressiveIndexer:
+    """Job di indicizzazione di processo, uno per chiave di indice, condivisi tra le sessioni."""
+
+    def __init__(self, registry, batch_size=DEFAULT_BATCH_SIZE, index_type="auto", workers=DEFAULT_WORKERS):
+        self.registry = registry
+        self.batch_size = max(1, batch_size)
+        self.index_type = index_type
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="indexer")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def job(self, key):
+        """Job in corso (o fallito) per `key`; None se l'indice è pronto o mai richiesto."""
+        with self._lock:
+            return self._jobs.get(key)
+
+    def current(self, key):
+        """Indice interrogabile: ultima istantanea se il job è in corso, altrimenti quello del registro."""
+        job = self.job(key)
+        if job is not None and job.active():
+            return job.vectorstore
+        return self.registry.get(key)
+
+    def ensure(self, key, filename, load_pdf, split):
+        """Avvia l'indicizzazione se l'indice non è né in memoria né su disco.
+
+        `load_pdf` restituisce i byte del PDF e `split` divide le PageText in
+        Document annotati con la pagina: entrambe girano sul worker. Ritorna
+        None se l'indice è già pronto, altrimenti il job (nuovo o già in corso).
+        """
+        if self.registry.get(key) is not None:
+            return None
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.active():
+                return job
+            job = self._jobs[key] = IndexJob(key, filename)
+        self._pool.submit(self._run, job, load_pdf, split)
+        return job
+
+    def _publish(self, job, text_embeddings, metadatas, embeddings):
+        # Indice flat: nessun addestramento, ricostruirlo costa una copia dei vettori
+        with metrics.span("index_snapshot"):
+            snapshot = ann_index.create_vectorstore(text_embeddings, embeddings, metadatas=metadatas,
+                                                    index_type="flat")
+        snapshot.partial = True
+        if job.vectorstore is None:
+            metrics.observe("index_first_batch", time.monotonic() - job.started)
+        job.vectorstore = snapshot
+
+    def _run(self, job, load_pdf, split):
+        try:
+            embeddings = self.registry.embeddings
+            job.state = "extracting"
+
+            def on_progress(done, total):
+                job.pages_done, job.pages_total = done, total
+
+            with metrics.span("pdf_extract"):
+                pages = list(pdf_extract.iter_pages(load_pdf(), on_progress=on_progress))
+            if not any(p.text for p in pages):
+                job.state = "empty"
+                return
+            with metrics.span("chunking"):
+                docs = split(pages)
+            job.chunks_total = len(docs)
+            job.state = "indexing"
+
+            text_embeddings, metadatas = [], []
+            published = 0
+            for start in range(0, len(docs), self.batch_size):
+                batch = docs[start:start + self.batch_size]
+                texts = [d.page_content for d in batch]
+                with metrics.span("embedding"):
+                    vectors, stats = embeddings.embed_with_stats(texts)
+                metrics.incr("embedding_cache_hits", stats.hits)
+                metrics.incr("embedding_cache_misses", stats.embedded)
+                job.embed_stats.add(stats)
+                text_embeddings += zip(texts, vectors)
+                metadatas += [d.metadata for d in batch]
+                # L'ultimo lotto non serve pubblicarlo: arriva l'indice definitivo
+                if published * SNAPSHOT_GROWTH <= len(text_embeddings) < len(docs):
+                    self._publish(job, list(text_embeddings), list(metadatas), embeddings)
+                    job.last_page = batch[-1].metadata.get("page")
+                    published = len(text_embeddings)
+                job.chunks_done = len(text_embeddings)
+
+            job.state = "finalizing"
+            with metrics.span("index_build"):
+                vectorstore = ann_index.create_vectorstore(text_embeddings, embeddings, metadatas=metadatas,
+                                                           index_type=self.index_type)
+                # Indice lessicale BM25 costruito insieme a quello vettoriale e salvato accanto
+                lexical = bm25.BM25Index.build([text for text, _ in text_embeddings])
+            with metrics.span("index_store"):
+                self.registry.index_cache.store(job.key, vectorstore,
+                                                extra_files={bm25.FILE_NAME: lexical.to_bytes()},
+                                                filename=job.filename, chunks=len(docs),
+                                                index_type=vectorstore.index_type)
+            # Riletto dal disco (mappato) se possibile, così la copia in RAM costruita qui viene liberata
+            if self.registry.get(job.key) is None:
+                self.registry.put(job.key, vectorstore)
+            metrics.observe("index_total", time.monotonic() - job.started)
+            job.state = "complete"
+        except Exception as e:
+            job.state = "error"
+            job.error = str(e) or type(e).__name__
+            metrics.incr("errors", stage="indexing")
+        finally:
+            job.finished = time.monotonic()
+            # L'istantanea parziale non serve più: i lettori passano al registro
+            job.vectorstore = None
+            with self._lock:
+                if self._jobs.get(job.key) is job and job.state == "complete":
+                    del self._jobs[job.key]
+            job._done.set()
+
+    def stats(self):
+        """Una riga per job ancora registrato: file, stato, chunk indicizzati."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [{"file": j.filename, "state": j.state, "chunks": f"{j.chunks_done}/{j.chunks_total}",
+                 "progress": round(j.progress(), 2)} for j in jobs]
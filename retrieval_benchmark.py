@@ -0,0 +1,118 @@
+# retrieval_benchmark.py
+# Benchmark di recupero: recall@k per solo similarità vs ibrido (vettori + BM25).
+#
+# Usa un piccolo corpus etichettato incorporato (regolamento d'esame e
+# dispense di statistica, con numeri di articolo e formule) oppure uno
+# passato con --corpus: {"chunks": [...], "questions": [{"question": ..., "relevant": [indici]}]}.
+#
+#   python retrieval_benchmark.py --k 1,3,6
+
+import sys
+import json
+import time
+import argparse
+
+from langchain_community.vectorstores import FAISS
+
+import bm25
+from library import MultiDocRetriever
+
+CORPUS = {
+    "chunks": [
+        "Art. 1 - Ambito di applicazione. Il presente regolamento disciplina le modalità di svolgimento degli esami di profitto dei corsi di laurea triennale.",
+        "Art. 2 - Appelli. Sono previsti almeno sei appelli per anno accademico, distribuiti nelle sessioni invernale, estiva e autunnale.",
+        "Art. 3 - Iscrizione. Lo studente si iscrive all'appello tramite il portale entro cinque giorni dalla data della prova; l'iscrizione tardiva non è ammessa.",
+        "Art. 4 - Prova scritta. La prova scritta ha durata massima di tre ore; non è consentito l'uso di appunti salvo diversa indicazione del docente.",
+        "Art. 5 - Rifiuto del voto. Lo studente può rifiutare il voto una sola volta per insegnamento, comunicandolo entro sette giorni dalla pubblicazione.",
+        "Art. 6 - Commissione. La commissione d'esame è composta da almeno due membri, di cui uno è il titolare dell'insegnamento.",
+        "Art. 12 - Ritiro. Lo studente che si ritira durante la prova non vede registrato alcun esito e può ripresentarsi all'appello successivo.",
+        "La funzione di ripartizione F(x) = P(X <= x) di una variabile aleatoria è non decrescente, continua a destra e tende a 0 per x che tende a meno infinito.",
+        "La densità di probabilità f(x) di una variabile continua è la derivata della funzione di ripartizione, e il suo integrale su tutto R vale 1.",
+        "Il valore atteso E[X] = somma di x per p(x) nel caso discreto rappresenta la media teorica della distribuzione.",
+        "La varianza Var(X) = E[X^2] - E[X]^2 misura la dispersione dei valori attorno al valore atteso.",
+        "La distribuzione binomiale B(n, p) conta il numero di successi in n prove indipendenti, ciascuna con probabilità di successo p.",
+        "La distribuzione di Poisson con parametro lambda approssima la binomiale quando n è grande e p è piccolo, con lambda = n p.",
+        "Il teorema del limite centrale afferma che la media campionaria standardizzata converge in distribuzione a una normale standard N(0, 1).",
+        "L'intervallo di confidenza al 95% per la media, con varianza nota, è dato da media campionaria più o meno 1.96 sigma su radice di n.",
+        "Il test chi quadrato di Pearson confronta le frequenze osservate con quelle attese sotto l'ipotesi nulla di indipendenza.",
+    ],
+    "questions": [
+        {"question": "Cosa dice l'art. 12 del regolamento?", "relevant": [6]},
+        {"question": "Art. 5: entro quanti giorni si rifiuta il voto?", "relevant": [4]},
+        {"question": "Quanti appelli all'anno sono previsti?", "relevant": [1]},
+        {"question": "Entro quando devo iscrivermi all'appello sul portale?", "relevant": [2]},
+        {"question": "Quanto dura la prova scritta?", "relevant": [3]},
+        {"question": "Chi fa parte della commissione d'esame?", "relevant": [5]},
+        {"question": "Cos'è la funzione di ripartizione?", "relevant": [7]},
+        {"question": "Che relazione c'è tra densità e funzione di ripartizione?", "relevant": [8, 7]},
+        {"question": "Formula della varianza con E[X^2]", "relevant": [10]},
+        {"question": "Cosa conta la binomiale B(n, p)?", "relevant": [11]},
+        {"question": "Quando Poisson approssima la binomiale? lambda = n p", "relevant": [12]},
+        {"question": "Enunciato del teorema del limite centrale", "relevant": [13]},
+        {"question": "Da dove viene il 1.96 nell'intervallo di confidenza?", "relevant": [14]},
+        {"question": "A cosa serve il test chi quadrato di Pearson?", "relevant": [15]},
+        {"question": "Cosa succede se mi ritiro durante l'esame?", "relevant": [6]},
+        {"question": "Valore atteso nel caso discreto", "relevant": [9]},
+    ],
+}
+
+
+def build_store(chunks, embeddings):
+    metadatas = [{"start_index": i, "chunk": i} for i in range(len(chunks))]
+    vectorstore = FAISS.from_texts(chunks, embeddings, metadatas=metadatas)
+    vectorstore.lexical_index = bm25.BM25Index.build(chunks)
+    return vectorstore
+
+
+def recall_at_k(vectorstore, questions, k, search_type):
+    retriever = MultiDocRetriever(stores=[("bench", "bench", vectorstore)], k=k, search_type=search_type)
+    found = 0
+    for item in questions:
+        hits = {doc.metadata["chunk"] for doc in retriever.invoke(item["question"])}
+        found += bool(hits & set(item["relevant"]))
+    return found / len(questions)
+
+
+def benchmark(embeddings, corpus=CORPUS, ks=(1, 3, 6)):
+    vectorstore = build_store(corpus["chunks"], embeddings)
+    rows = []
+    for k in ks:
+        rows.append({
+            "k": k,
+            "similarity": round(recall_at_k(vectorstore, corpus["questions"], k, "similarity"), 3),
+            "hybrid": round(recall_at_k(vectorstore, corpus["questions"], k, "hybrid"), 3),
+        })
+
+    lexical = vectorstore.lexical_index
+    start = time.perf_counter()
+    rounds = 200
+    for _ in range(rounds):
+        for item in corpus["questions"]:
+            lexical.search(item["question"], k=20)
+    bm25_ms = (time.perf_counter() - start) * 1000 / (rounds * len(corpus["questions"]))
+    return {"recall": rows, "bm25_query_ms": round(bm25_ms, 4)}
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser(description="Recall@k: similarità vs ibrido BM25 + vettori")
+    parser.add_argument("--corpus", help="JSON con chunks e questions etichettate")
+    parser.add_argument("--k", default="1,3,6")
+    parser.add_argument("--model", default="all-MiniLM-L6-v2")
+    args = parser.parse_args(argv)
+
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    embeddings = HuggingFaceEmbeddings(model_name=args.model)
+    corpus = CORPUS
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            corpus = json.load(f)
+
+    result = benchmark(embeddings, corpus, [int(k) for k in args.k.split(",")])
+    print(f"{'k':>4} {'similarità':>12} {'ibrido':>8}")
+    for row in result["recall"]:
+        print(f"{row['k']:>4} {row['similarity']:>12} {row['hybrid']:>8}")
+    print(f"BM25: {result['bm25_query_ms']} ms/query")
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
@@ -0,0 +1,430 @@
+# storage.py
+# Backend di persistenza: SQLite (locale) e Firestore (cloud), con la stessa interfaccia.
+#
+# SQLite: pool di connessioni, WAL e migrazioni dello schema. Le connessioni
+# restano aperte e vengono riusate tra le richieste: sqlite3 tiene in cache
+# gli statement preparati per connessione, quindi le query (scritte come
+# costanti) vengono compilate una volta sola.
+
+import os
+import sys
+import time
+import queue
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+DEFAULT_DB_PATH = "study_master.db"
+DEFAULT_POOL_SIZE = int(os.environ.get("STUDY_MASTER_DB_POOL", "4"))
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",       # lettori e scrittore non si bloccano a vicenda
+    "PRAGMA synchronous=NORMAL",     # con WAL è sicuro e molto più veloce di FULL
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",      # ~16 MB di page cache per connessione
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA foreign_keys=ON",
+)
+
+# Migrazioni in ordine: l'indice +1 è la versione in PRAGMA user_version
+MIGRATIONS = (
+    # 1: schema originale
+    """
+    CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT);
+    CREATE TABLE IF NOT EXISTS chat_history
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, role TEXT, content TEXT,
+         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP);
+    """,
+    # 2: indice per cronologia e cancellazione per utente
+    """
+    CREATE INDEX IF NOT EXISTS idx_chat_history_user_ts ON chat_history (username, timestamp);
+    """,
+    # 3: indice per la paginazione keyset sulla cronologia (cursore = id)
+    """
+    CREATE INDEX IF NOT EXISTS idx_chat_history_user_id ON chat_history (username, id);
+    """,
+    # 4: libreria documenti per utente (i PDF e gli indici sono condivisi, qui solo i riferimenti)
+    """
+    CREATE TABLE IF NOT EXISTS user_documents
+        (username TEXT NOT NULL, doc_id TEXT NOT NULL, filename TEXT NOT NULL,
+         added DATETIME DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (username, doc_id));
+    """,
+    # 5: riassunto progressivo della conversazione (memoria), uno per utente
+    """
+    CREATE TABLE IF NOT EXISTS chat_summaries
+        (username TEXT PRIMARY KEY, summary TEXT NOT NULL, covered INTEGER NOT NULL DEFAULT 0,
+         last_hash TEXT, updated DATETIME DEFAULT CURRENT_TIMESTAMP);
+    """,
+    # 6: riferimenti a un documento da qualunque utente (cancellazione del PDF condiviso)
+    """
+    CREATE INDEX IF NOT EXISTS idx_user_documents_doc ON user_documents (doc_id);
+    """,
+)
+
+# Query costanti: riusate dalla cache degli statement di ogni connessione
+SQL_INSERT_USER = "INSERT INTO users (username, password) VALUES (?, ?)"
+SQL_CHECK_USER = "SELECT 1 FROM users WHERE username = ? AND password = ?"
+SQL_INSERT_MESSAGE = "INSERT INTO chat_history (username, role, content) VALUES (?, ?, ?)"
+SQL_LOAD_HISTORY = "SELECT role, content FROM chat_history WHERE username = ? ORDER BY timestamp ASC, id ASC"
+SQL_LOAD_PAGE = "SELECT id, role, content FROM chat_history WHERE username = ? AND id < ? ORDER BY id DESC LIMIT ?"
+SQL_CLEAR_HISTORY = "DELETE FROM chat_history WHERE username = ?"
+SQL_ADD_DOCUMENT = ("INSERT INTO user_documents (username, doc_id, filename) VALUES (?, ?, ?) "
+                    "ON CONFLICT (username, doc_id) DO UPDATE SET filename = excluded.filename")
+SQL_LIST_DOCUMENTS = "SELECT doc_id, filename FROM user_documents WHERE username = ? ORDER BY added, rowid"
+SQL_REMOVE_DOCUMENT = "DELETE FROM user_documents WHERE username = ? AND doc_id = ?"
+SQL_DOCUMENT_IN_USE = "SELECT 1 FROM user_documents WHERE doc_id = ? LIMIT 1"
+SQL_LOAD_SUMMARY = "SELECT summary, covered, last_hash FROM chat_summaries WHERE username = ?"
+SQL_SAVE_SUMMARY = ("INSERT INTO chat_summaries (username, summary, covered, last_hash) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (username) DO UPDATE SET summary = excluded.summary, covered = excluded.covered, "
+                    "last_hash = excluded.last_hash, updated = CURRENT_TIMESTAMP")
+SQL_CLEAR_SUMMARY = "DELETE FROM chat_summaries WHERE username = ?"
+
+
+class SQLiteStore:
+    """Pool thread-safe di connessioni SQLite verso un singolo file."""
+
+    def __init__(self, path=DEFAULT_DB_PATH, pool_size=DEFAULT_POOL_SIZE):
+        self.path = path
+        self._pool = queue.LifoQueue()
+        self._migrate_lock = threading.Lock()
+        for _ in range(pool_size):
+            self._pool.put(self._connect())
+        self.migrate()
+
+    def _connect(self):
+        # isolation_level=None: le transazioni sono gestite esplicitamente
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None,
+                               cached_statements=256)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def migrate(self):
+        with self._migrate_lock, self.transaction() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+                for statement in script.split(";"):
+                    if statement.strip():
+                        conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {number}")
+
+    def close(self):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+    # --- UTENTI ---
+
+    def register_user(self, username, pwd_hash):
+        try:
+            with self.transaction() as conn:
+                conn.execute(SQL_INSERT_USER, (username, pwd_hash))
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def check_user(self, username, pwd_hash):
+        with self.connection() as conn:
+            return conn.execute(SQL_CHECK_USER, (username, pwd_hash)).fetchone() is not None
+
+    # --- CRONOLOGIA CHAT ---
+
+    def save_message(self, username, role, content):
+        with self.transaction() as conn:
+            conn.execute(SQL_INSERT_MESSAGE, (username, role, content))
+
+    def save_messages(self, rows):
+        """Inserisce più (username, role, content) in una sola transazione."""
+        with self.transaction() as conn:
+            conn.executemany(SQL_INSERT_MESSAGE, rows)
+
+    def load_history(self, username):
+        with self.connection() as conn:
+            rows = conn.execute(SQL_LOAD_HISTORY, (username,)).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def load_history_page(self, username, limit, before_id=None):
+        """Gli ultimi `limit` messaggi più vecchi di before_id, in ordine cronologico.
+
+        Ritorna (messaggi, cursore): il cursore va ripassato come before_id per la
+        pagina precedente ed è None quando non ci sono messaggi più vecchi.
+        """
+        before = sys.maxsize if before_id is None else before_id
+        with self.connection() as conn:
+            rows = conn.execute(SQL_LOAD_PAGE, (username, before, limit + 1)).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        messages = [{"id": row_id, "role": role, "content": content} for row_id, role, content in rows]
+        cursor = rows[0][0] if has_more and rows else None
+        return messages, cursor
+
+    def clear_history(self, username):
+        with self.transaction() as conn:
+            conn.execute(SQL_CLEAR_HISTORY, (username,))
+            conn.execute(SQL_CLEAR_SUMMARY, (username,))
+
+    def load_summary(self, username):
+        """Riassunto della conversazione: {"summary", "covered", "last_hash"} oppure None."""
+        with self.connection() as conn:
+            row = conn.execute(SQL_LOAD_SUMMARY, (username,)).fetchone()
+        if row is None:
+            return None
+        return {"summary": row[0], "covered": row[1], "last_hash": row[2]}
+
+    def save_summary(self, username, summary, covered, last_hash):
+        with self.transaction() as conn:
+            conn.execute(SQL_SAVE_SUMMARY, (username, summary, covered, last_hash))
+
+    # --- LIBRERIA DOCUMENTI ---
+
+    def add_document(self, username, doc_id, filename):
+        with self.transaction() as conn:
+            conn.execute(SQL_ADD_DOCUMENT, (username, doc_id, filename))
+
+    def list_documents(self, username):
+        with self.connection() as conn:
+            rows = conn.execute(SQL_LIST_DOCUMENTS, (username,)).fetchall()
+        return [{"doc_id": doc_id, "filename": filename} for doc_id, filename in rows]
+
+    def remove_document(self, username, doc_id):
+        with self.transaction() as conn:
+            conn.execute(SQL_REMOVE_DOCUMENT, (username, doc_id))
+
+    def document_in_use(self, doc_id):
+        """True se almeno un utente ha il documento in libreria."""
+        with self.connection() as conn:
+            return conn.execute(SQL_DOCUMENT_IN_USE, (doc_id,)).fetchone() is not None
+
+
+class FirestoreStore:
+    """Backend Firestore con la stessa interfaccia di SQLiteStore.
+
+    `client` è un google.cloud.firestore.Client già costruito (o un client
+    compatibile, es. firestore_fake.FakeClient). Con FIRESTORE_EMULATOR_HOST
+    impostato il client ufficiale parla con l'emulatore locale.
+
+    La paginazione della cronologia richiede un indice composito:
+
+        collection: chat_history
+        fields:     username ASC, timestamp DESC
+
+    (console Firebase -> Firestore -> Indici, oppure firestore.indexes.json:
+    {"collectionGroup": "chat_history", "queryScope": "COLLECTION",
+     "fields": [{"fieldPath": "username", "order": "ASCENDING"},
+                {"fieldPath": "timestamp", "order": "DESCENDING"}]})
+    """
+
+    # Limite di operazioni per WriteBatch imposto da Firestore
+    MAX_BATCH = 500
+
+    def __init__(self, client):
+        self.client = client
+        self._ts_lock = threading.Lock()
+        self._last_ts = None
+
+    def _next_timestamp(self):
+        # Timestamp lato client strettamente crescenti: in un WriteBatch tutti i
+        # documenti riceverebbero lo stesso SERVER_TIMESTAMP e l'ordine si perderebbe
+        with self._ts_lock:
+            now = datetime.now(timezone.utc)
+            if self._last_ts is not None and now <= self._last_ts:
+                now = self._last_ts + timedelta(microseconds=1)
+            self._last_ts = now
+            return now
+
+    def _history_query(self, username):
+        return self.client.collection("chat_history").where("username", "==", username)
+
+    # --- UTENTI ---
+
+    def register_user(self, username, pwd_hash):
+        doc_ref = self.client.collection("users").document(username)
+        if doc_ref.get().exists:
+            return False
+        doc_ref.set({"password": pwd_hash})
+        return True
+
+    def check_user(self, username, pwd_hash):
+        doc = self.client.collection("users").document(username).get()
+        if doc.exists:
+            return doc.to_dict().get("password") == pwd_hash
+        return False
+
+    # --- CRONOLOGIA CHAT ---
+
+    def save_message(self, username, role, content):
+        self.save_messages([(username, role, content)])
+
+    def save_messages(self, rows):
+        """Scrive più (username, role, content) con WriteBatch da al massimo 500 operazioni."""
+        collection = self.client.collection("chat_history")
+        for i in range(0, len(rows), self.MAX_BATCH):
+            batch = self.client.batch()
+            for username, role, content in rows[i:i + self.MAX_BATCH]:
+                batch.set(collection.document(), {
+                    "username": username,
+                    "role": role,
+                    "content": content,
+                    "timestamp": self._next_timestamp(),
+                })
+            batch.commit()
+
+    def load_history(self, username):
+        docs = self._history_query(username).order_by("timestamp").stream()
+        return [{"role": d["role"], "content": d["content"]} for d in (doc.to_dict() for doc in docs)]
+
+    def load_history_page(self, username, limit, before_id=None):
+        """Come SQLiteStore.load_history_page; il cursore è il timestamp del messaggio più vecchio."""
+        query = self._history_query(username).order_by("timestamp", direction="DESCENDING")
+        if before_id is not None:
+            query = query.start_after({"timestamp": before_id})
+        docs = list(query.limit(limit + 1).stream())
+        has_more = len(docs) > limit
+        docs = docs[:limit]
+        docs.reverse()
+        rows = [(doc.id, doc.to_dict()) for doc in docs]
+        messages = [{"id": doc_id, "role": d["role"], "content": d["content"]} for doc_id, d in rows]
+        cursor = rows[0][1]["timestamp"] if has_more and rows else None
+        return messages, cursor
+
+    def clear_history(self, username):
+        """Cancella a pagine di soli riferimenti (select vuota) con un BulkWriter."""
+        writer = self.client.bulk_writer()
+        try:
+            while True:
+                refs = [doc.reference for doc in
+                        self._history_query(username).select([]).limit(self.MAX_BATCH).stream()]
+                if not refs:
+                    break
+                for ref in refs:
+                    writer.delete(ref)
+                writer.flush()
+        finally:
+            writer.close()
+        self.client.collection("chat_summaries").document(username).delete()
+
+    def load_summary(self, username):
+        doc = self.client.collection("chat_summaries").document(username).get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        return {"summary": data["summary"], "covered": data.get("covered", 0), "last_hash": data.get("last_hash")}
+
+    def save_summary(self, username, summary, covered, last_hash):
+        self.client.collection("chat_summaries").document(username).set({
+            "summary": summary,
+            "covered": covered,
+            "last_hash": last_hash,
+            "updated": self._next_timestamp(),
+        })
+
+    # --- LIBRERIA DOCUMENTI ---
+
+    def _document_ref(self, username, doc_id):
+        return self.client.collection("user_documents").document(f"{username}__{doc_id}")
+
+    def add_document(self, username, doc_id, filename):
+        self._document_ref(username, doc_id).set({
+            "username": username,
+            "doc_id": doc_id,
+            "filename": filename,
+            "added": self._next_timestamp(),
+        })
+
+    def list_documents(self, username):
+        # Poche voci per utente: ordinamento lato client, senza indice composito
+        docs = [doc.to_dict() for doc in
+                self.client.collection("user_documents").where("username", "==", username).stream()]
+        docs.sort(key=lambda d: d["added"])
+        return [{"doc_id": d["doc_id"], "filename": d["filename"]} for d in docs]
+
+    def remove_document(self, username, doc_id):
+        self._document_ref(username, doc_id).delete()
+
+    def document_in_use(self, doc_id):
+        query = self.client.collection("user_documents").where("doc_id", "==", doc_id).select([]).limit(1)
+        return any(True for _ in query.stream())
+
+
+# --- BENCHMARK ---
+
+def benchmark(path, rows=1_000_000, users=1000, writes=2000):
+    """Scritture/sec e latenza di caricamento cronologia con `rows` righe in tabella."""
+    store = SQLiteStore(path)
+    with store.connection() as conn:
+        existing = conn.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0]
+    content = "x" * 400
+    batch = 10_000
+    for start in range(existing, rows, batch):
+        store.save_messages([(f"user{i % users}", "user", content) for i in range(start, min(start + batch, rows))])
+
+    start = time.perf_counter()
+    for i in range(writes):
+        store.save_message(f"user{i % users}", "assistant", content)
+    single = writes / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    store.save_messages([(f"user{i % users}", "assistant", content) for i in range(writes)])
+    batched = writes / (time.perf_counter() - start)
+
+    latencies = []
+    for i in range(0, users, max(1, users // 50)):
+        start = time.perf_counter()
+        history = store.load_history(f"user{i}")
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    page_latencies = []
+    for i in range(0, users, max(1, users // 50)):
+        start = time.perf_counter()
+        store.load_history_page(f"user{i}", 50)
+        page_latencies.append(time.perf_counter() - start)
+    page_latencies.sort()
+    store.close()
+    return {
+        "rows": max(rows, existing),
+        "writes_per_sec": round(single),
+        "batched_writes_per_sec": round(batched),
+        "history_messages": len(history),
+        "history_load_p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "history_load_p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 2),
+        "history_page_p50_ms": round(page_latencies[len(page_latencies) // 2] * 1000, 2),
+        "history_page_p95_ms": round(page_latencies[int(len(page_latencies) * 0.95)] * 1000, 2),
+    }
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark backend SQLite")
+    parser.add_argument("--db", default="bench_study_master.db")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--writes", type=int, default=2000)
+    args = parser.parse_args(argv)
+    for key, value in benchmark(args.db, args.rows, args.users, args.writes).items():
+        print(f"{key:>24}: {value}")
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
@@ -0,0 +1,323 @@
+# study_material.py
+# Quiz e flashcard pre-generati per documento.
+#
+# Dopo l'indicizzazione un job map-reduce divide il PDF in sezioni di pagine
+# consecutive, genera domande e flashcard per ogni sezione su un pool di
+# thread limitato (map) e unisce i risultati senza duplicati (reduce). Il
+# materiale è salvato per hash del documento: le richieste generiche in
+# modalità quiz o flashcard ("fammi un quiz", "altre flashcard") vengono
+# servite subito, campionando da tutto il documento; quelle su pagine o
+# argomenti precisi usano solo gli elementi che corrispondono, o passano al
+# modello se non ce ne sono abbastanza.
+
+import os
+import re
+import json
+import time
+import random
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+DEFAULT_DIR = os.environ.get("STUDY_MASTER_MATERIAL_DIR", os.path.join(".cache", "study_material"))
+DEFAULT_WORKERS = int(os.environ.get("STUDY_MASTER_PREGEN_WORKERS", "4"))
+# Versione del formato: cambiarla fa rigenerare il materiale
+FORMAT_VERSION = 1
+
+SECTION_CHARS = 8000
+# Oltre questo numero le sezioni vengono allargate: il costo resta limitato anche per PDF enormi
+MAX_SECTIONS = 40
+QUIZ_PER_SECTION = 5
+CARDS_PER_SECTION = 6
+# Dopo un job fallito si riprova solo trascorso questo intervallo
+RETRY_SECONDS = 600
+
+PROMPT = """Sei un professore d'esame. Dall'estratto seguente (pagine {pages} di "{filename}") crea
+{quiz} domande d'esame difficili con una risposta breve e {cards} flashcard (termine e definizione).
+Usa SOLO informazioni presenti nel testo.
+Rispondi esclusivamente con un oggetto JSON di questa forma:
+{{"quiz": [{{"question": "...", "answer": "..."}}], "flashcards": [{{"term": "...", "definition": "..."}}]}}
+
+ESTRATTO:
+{text}"""
+
+_JSON_RE = re.compile(r"\{.*\}", re.DOTALL)
+_PAGES_RE = re.compile(r"\b(?:pagin[ae]|pagg?\.?|pp?\.)\s*(\d+)(?:\s*[-–]\s*(\d+))?", re.IGNORECASE)
+# Parole di una richiesta generica: tutto il resto è un argomento da cercare negli elementi
+GENERIC_WORDS = frozenset("""
+    fammi fai fare crea creami genera generami prepara preparami dammi mostrami voglio vorrei puoi potresti
+    mi me ti per favore piacere grazie ok ciao perfetto bene adesso ora poi ancora altro altra altri altre
+    nuovo nuova nuovi nuove diverso diversa diversi diverse qualche alcune alcuni tutto tutta tutti tutte
+    un una uno il lo la i gli le l e ed o di del dello della dei degli delle su sul sullo sulla sui sugli
+    sulle da dal dalla nel nella nei nelle con tra fra sempre intero intera cos cosa che chi come quale quali
+    è sono
+    quiz domanda domande test simulazione esame esercizi flashcard flashcards card carte scheda schede
+    documento documenti pdf testo file materiale
+    new more another give make some questions cards on the of a an
+""".split())
+
+
+def make_sections(pages, section_chars=SECTION_CHARS, max_sections=MAX_SECTIONS):
+    """Raggruppa le pagine (PageText) in sezioni consecutive: [(prima, ultima, testo)]."""
+    total = sum(len(p.text) for p in pages)
+    size = max(section_chars, -(-total // max_sections)) if total else section_chars
+    sections, current = [], []
+    length = 0
+    for page in pages:
+        if not page.text.strip():
+            continue
+        current.append(page)
+        length += len(page.text)
+        if length >= size:
+            sections.append((current[0].page, current[-1].page, "".join(p.text for p in current)))
+            current, length = [], 0
+    if current:
+        sections.append((current[0].page, current[-1].page, "".join(p.text for p in current)))
+    return sections
+
+
+def parse_items(text):
+    """Estrae quiz e flashcard dalla risposta del modello (tollera ```json e testo attorno)."""
+    match = _JSON_RE.search(text or "")
+    if not match:
+        return [], []
+    try:
+        data = json.loads(match.group(0))
+    except ValueError:
+        return [], []
+    quiz = [{"question": str(q["question"]).strip(), "answer": str(q.get("answer", "")).strip()}
+            for q in data.get("quiz", []) if isinstance(q, dict) and q.get("question")]
+    cards = [{"term": str(c["term"]).strip(), "definition": str(c.get("definition", "")).strip()}
+             for c in data.get("flashcards", []) if isinstance(c, dict) and c.get("term")]
+    return quiz, cards
+
+
+def _normalize(text):
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+class MaterialStore:
+    """Un file JSON per documento, con scritture atomiche e copia in memoria."""
+
+    def __init__(self, root=DEFAULT_DIR):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+        # Il materiale non cambia dopo la scrittura: letto dal disco una volta per processo
+        self._loaded = {}
+
+    def _path(self, doc_id):
+        return os.path.join(self.root, f"{doc_id}.json")
+
+    def get(self, doc_id):
+        data = self._loaded.get(doc_id)
+        if data is not None:
+            return data
+        try:
+            with open(self._path(doc_id), encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("version") != FORMAT_VERSION:
+            return None
+        self._loaded[doc_id] = data
+        return data
+
+    def put(self, doc_id, material):
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"version": FORMAT_VERSION, **material}, f, ensure_ascii=False)
+        os.replace(tmp, self._path(doc_id))
+        self._loaded.pop(doc_id, None)
+
+
+def parse_request(text):
+    """Cosa chiede lo studente: (intervallo di pagine (prima, ultima) o None, parole di argomento)."""
+    pages = None
+    match = _PAGES_RE.search(text)
+    if match:
+        first, last = int(match.group(1)), int(match.group(2) or match.group(1))
+        pages = (min(first, last), max(first, last))
+        text = text[:match.start()] + text[match.end():]
+    topic = [w for w in re.findall(r"\w+", text.lower()) if w not in GENERIC_WORDS and not w.isdigit()]
+    return pages, topic
+
+
+def _page_range(item):
+    first, _, last = item["pages"].partition("-")
+    return int(first), int(last or first)
+
+
+def _item_text(item):
+    return _normalize(" ".join(str(item.get(field, "")) for field in ("question", "answer", "term", "definition")))
+
+
+def request_matcher(text):
+    """Filtro sugli elementi per la richiesta `text`; None se la richiesta è generica.
+
+    Le pagine devono sovrapporsi all'intervallo chiesto e ogni parola di
+    argomento deve comparire nell'elemento (radice grossolana, per i plurali).
+    """
+    pages, topic = parse_request(text)
+    if pages is None and not topic:
+        return None
+    stems = [w[:max(4, len(w) - 2)] for w in topic]
+
+    def keep(item):
+        if pages is not None:
+            first, last = _page_range(item)
+            if last < pages[0] or first > pages[1]:
+                return False
+        words = _item_text(item).split()
+        return all(any(word.startswith(stem) for word in words) for stem in stems)
+    return keep
+
+
+class Job:
+    __slots__ = ("doc_id", "total", "done", "failed", "state", "finished")
+
+    def __init__(self, doc_id):
+        self.doc_id = doc_id
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.state = "running"      # running | complete | error
+        self.finished = None
+
+
+class Pregenerator:
+    """Job di pre-generazione di processo: uno per documento, sezioni su un pool limitato."""
+
+    def __init__(self, store, workers=DEFAULT_WORKERS):
+        self.store = store
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pregen")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def status(self, doc_id):
+        """"complete" se il materiale è pronto, altrimenti il Job in corso (o None)."""
+        if self.store.get(doc_id) is not None:
+            return "complete"
+        with self._lock:
+            return self._jobs.get(doc_id)
+
+    def ensure(self, doc_id, filename, load_pages, llm):
+        """Avvia la generazione se il materiale manca e nessun job è già in corso.
+
+        `load_pages` è una funzione senza argomenti che restituisce le PageText
+        del documento; viene chiamata sul thread del job, non su quello della UI.
+        """
+        if self.store.get(doc_id) is not None:
+            return None
+        with self._lock:
+            job = self._jobs.get(doc_id)
+            if job is not None and (job.finished is None or
+                                    time.monotonic() - job.finished < RETRY_SECONDS):
+                return job
+            job = self._jobs[doc_id] = Job(doc_id)
+        threading.Thread(target=self._run, args=(job, filename, load_pages, llm),
+                         name=f"pregen-{doc_id[:8]}", daemon=True).start()
+        return job
+
+    def _generate(self, job, filename, section, llm):
+        first, last = section[0], section[1]
+        pages = str(first) if first == last else f"{first}-{last}"
+        prompt = PROMPT.format(pages=pages, filename=filename, quiz=QUIZ_PER_SECTION,
+                               cards=CARDS_PER_SECTION, text=section[2])
+        try:
+            with metrics.span("pregen_section"):
+                reply = llm.invoke(prompt)
+            quiz, cards = parse_items(getattr(reply, "content", reply))
+        except Exception:
+            with self._lock:
+                job.failed += 1
+            return None
+        finally:
+            # Le sezioni girano in parallelo sul pool: gli incrementi non sono atomici
+            with self._lock:
+                job.done += 1
+        for item in quiz + cards:
+            item["pages"] = pages
+        return quiz, cards
+
+    def _run(self, job, filename, load_pages, llm):
+        state = "error"
+        try:
+            sections = make_sections(load_pages() or [])
+            job.total = len(sections)
+            # Map: una chiamata LLM per sezione, al massimo `workers` in parallelo
+            results = list(self._pool.map(lambda s: self._generate(job, filename, s, llm), sections))
+
+            # Reduce: unione in ordine di sezione, senza domande o termini ripetuti
+            quiz, cards, seen = [], [], set()
+            for index, result in enumerate(results):
+                if result is None:
+                    continue
+                for item in result[0]:
+                    key = ("q", _normalize(item["question"]))
+                    if key not in seen:
+                        seen.add(key)
+                        quiz.append({**item, "section": index})
+                for item in result[1]:
+                    key = ("c", _normalize(item["term"]))
+                    if key not in seen:
+                        seen.add(key)
+                        cards.append({**item, "section": index})
+            if not quiz and not cards:
+                return
+            self.store.put(job.doc_id, {"filename": filename, "sections": len(sections),
+                                        "quiz": quiz, "flashcards": cards})
+            metrics.incr("pregen_items", len(quiz) + len(cards))
+            state = "complete"
+        except Exception:
+            state = "error"
+        finally:
+            # Sotto lock e prima dello stato: ensure() non vede mai un job finito senza `finished`
+            with self._lock:
+                job.finished = time.monotonic()
+                job.state = state
+                if self._jobs.get(job.doc_id) is job and job.state == "complete":
+                    del self._jobs[job.doc_id]
+
+
+def sample(materials, kind, n, rng=None, keep=None):
+    """Campiona `n` elementi di `kind` ("quiz" o "flashcards") distribuiti su tutte le sezioni.
+
+    `materials` è una lista di dizionari letti da MaterialStore (uno per documento);
+    `keep` (vedi request_matcher) limita il campione agli elementi che lo soddisfano.
+    """
+    rng = rng or random.Random()
+    buckets = []
+    for material in materials:
+        by_section = {}
+        for item in material.get(kind, []):
+            if keep is not None and not keep(item):
+                continue
+            by_section.setdefault(item["section"], []).append(dict(item, filename=material.get("filename")))
+        buckets.extend(by_section.values())
+    for bucket in buckets:
+        rng.shuffle(bucket)
+    rng.shuffle(buckets)
+    # Un elemento per sezione a turno: il campione copre tutto il documento
+    picked = []
+    while len(picked) < n and any(buckets):
+        for bucket in buckets:
+            if bucket and len(picked) < n:
+                picked.append(bucket.pop())
+    picked.sort(key=lambda item: (item.get("filename") or "", item["section"]))
+    return picked
+
+
+def _where(item, many):
+    # Con più documenti attivi la pagina da sola non basta
+    return f"{item['filename']}, pag. {item['pages']}" if many else f"pag. {item['pages']}"
+
+
+def format_quiz(items):
+    many = len({item.get("filename") for item in items}) > 1
+    return "\n".join(f"{i}. {item['question']} _({_where(item, many)})_" for i, item in enumerate(items, start=1))
+
+
+def format_flashcards(items):
+    return "\n".join(f"- **{item['term']}** -> _{item['definition']}_" for item in items)
@@ -0,0 +1,23 @@
+# Test della modalità batch offline (--fake-llm --fake-embeddings).
+
+import json
+
+import batch
+import benchmarks
+
+
+def test_fake_material_run_completes(tmp_path, monkeypatch):
+    pdf_dir = tmp_path / "pdf"
+    pdf_dir.mkdir()
+    (pdf_dir / "dispensa.pdf").write_bytes(benchmarks.make_pdf(pages=4))
+    report_path = tmp_path / "report.json"
+    monkeypatch.chdir(tmp_path)
+
+    batch._main(["--pdf-dir", str(pdf_dir), "--index-only", "--material", "--fake-llm", "--fake-embeddings",
+                 "--fake-ttft", "0", "--fake-token-delay", "0", "--report", str(report_path)])
+
+    report = json.loads(report_path.read_text(encoding="utf-8"))
+    assert report["ingestion"]["failed"] == []
+    assert list(report["material"].values()) == ["complete"]
+    # Le corse con embedding finti non scrivono nella cache dell'app
+    assert not (tmp_path / ".cache").exists()
@@ -0,0 +1,81 @@
+# Test di storage.FirestoreStore sul client Firestore in-process (firestore_fake).
+
+import pytest
+
+from firestore_fake import FakeClient
+from storage import FirestoreStore
+
+
+@pytest.fixture
+def store():
+    return FirestoreStore(FakeClient())
+
+
+def save_conversation(store, username, turns):
+    store.save_messages([(username, role, f"{username} {role} {i}")
+                         for i in range(turns) for role in ("user", "assistant")])
+
+
+def test_register_and_login(store):
+    assert store.register_user("anna", "h1")
+    assert not store.register_user("anna", "h2")
+    assert store.check_user("anna", "h1")
+    assert not store.check_user("anna", "h2")
+    assert not store.check_user("bruno", "h1")
+
+
+def test_history_pages_cover_history_in_order(store):
+    save_conversation(store, "anna", 13)
+    save_conversation(store, "bruno", 2)
+    full = store.load_history("anna")
+    assert len(full) == 26
+
+    pages, cursor = [], None
+    while True:
+        messages, cursor = store.load_history_page("anna", 10, before_id=cursor)
+        pages.insert(0, messages)
+        if cursor is None:
+            break
+    assert [len(p) for p in pages] == [6, 10, 10]
+    paged = [{"role": m["role"], "content": m["content"]} for page in pages for m in page]
+    assert paged == full
+
+
+def test_history_page_without_more_messages_has_no_cursor(store):
+    save_conversation(store, "anna", 2)
+    messages, cursor = store.load_history_page("anna", 10)
+    assert [m["content"] for m in messages] == ["anna user 0", "anna assistant 0",
+                                                "anna user 1", "anna assistant 1"]
+    assert cursor is None
+    assert store.load_history_page("bruno", 10) == ([], None)
+
+
+def test_save_messages_uses_batches_of_500(store):
+    store.client.round_trips = 0
+    save_conversation(store, "anna", 600)
+    assert store.client.round_trips == 3
+    assert len(store.load_history("anna")) == 1200
+
+
+def test_clear_history_removes_messages_and_summary(store):
+    save_conversation(store, "anna", 600)
+    save_conversation(store, "bruno", 3)
+    store.save_summary("anna", "riassunto", 10, "abc")
+    store.save_summary("bruno", "altro", 2, "def")
+
+    store.clear_history("anna")
+
+    assert store.load_history("anna") == []
+    assert store.load_history_page("anna", 10) == ([], None)
+    assert store.load_summary("anna") is None
+    assert len(store.load_history("bruno")) == 6
+    assert store.load_summary("bruno") == {"summary": "altro", "covered": 2, "last_hash": "def"}
+
+
+def test_document_in_use_until_last_reference_is_removed(store):
+    store.add_document("anna", "d1", "analisi.pdf")
+    store.add_document("bruno", "d1", "analisi_1.pdf")
+    store.remove_document("anna", "d1")
+    assert store.document_in_use("d1")
+    store.remove_document("bruno", "d1")
+    assert not store.document_in_use("d1")
@@ -0,0 +1,141 @@
+# warmup.py
+# Import differiti e riscaldamento in background.
+#
+# La pagina di login non deve aspettare langchain, FAISS, pypdf e
+# sentence-transformers. I moduli pesanti sono importati al primo uso
+# (lazy_module) e, dopo il login, un thread di background li importa e
+# carica il modello di embedding e i client LLM, così il primo upload o la
+# prima domanda non pagano il costo. shared() garantisce che il modello
+# venga costruito una volta sola anche se sessione e thread lo chiedono
+# insieme.
+
+import sys
+import time
+import importlib
+import threading
+from collections import OrderedDict
+
+import metrics
+
+_shared = {}
+_shared_lock = threading.Lock()
+_building = {}      # nome -> Lock: una sola costruzione per oggetto
+
+_tasks = OrderedDict()  # nome -> Task, dal meno recente
+_tasks_lock = threading.Lock()
+# Task conclusi tenuti per status(): uno per chiave API, non devono crescere senza limite
+MAX_FINISHED_TASKS = 32
+
+
+def import_module(name):
+    """importlib.import_module, con il tempo del primo import registrato nelle metriche."""
+    # Sempre tramite importlib: se un altro thread sta importando il modulo si
+    # attende la fine invece di ricevere un modulo inizializzato a metà
+    first = name not in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    if first:
+        metrics.observe("import", time.perf_counter() - start, module=name)
+    return module
+
+
+class _LazyModule:
+    """Segnaposto di un modulo: l'import avviene al primo accesso a un attributo."""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        # Dopo il primo import la ricerca in sys.modules è immediata
+        return getattr(import_module(self._name), attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name}>"
+
+
+def lazy_module(name):
+    return _LazyModule(name)
+
+
+def shared(name, factory):
+    """Oggetto di processo costruito una volta da `factory`; chiamate concorrenti aspettano la stessa."""
+    with _shared_lock:
+        if name in _shared:
+            return _shared[name]
+        build_lock = _building.setdefault(name, threading.Lock())
+    with build_lock:
+        with _shared_lock:
+            if name in _shared:
+                return _shared[name]
+        with metrics.span("warmup_build", item=name):
+            value = factory()
+        with _shared_lock:
+            _shared[name] = value
+            _building.pop(name, None)
+    return value
+
+
+class Task:
+    """Sequenza di passi eseguita su un thread daemon; tiene la durata di ciascun passo."""
+
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = steps          # lista di (nome, callable)
+        self.timings = {}
+        self.errors = {}
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"warmup-{name}", daemon=True)
+
+    def _run(self):
+        try:
+            for step, func in self.steps:
+                start = time.perf_counter()
+                try:
+                    func()
+                except Exception as e:
+                    # Il riscaldamento è un'ottimizzazione: l'errore si ripresenterà sul percorso normale
+                    self.errors[step] = repr(e)
+                    metrics.incr("errors", stage="warmup", step=step)
+                elapsed = time.perf_counter() - start
+                self.timings[step] = elapsed
+                metrics.observe("warmup", elapsed, step=step)
+        finally:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+
+def start(name, steps):
+    """Avvia il riscaldamento `name` una sola volta per processo; ritorna il Task.
+
+    Dei task conclusi si tengono solo i MAX_FINISHED_TASKS più recenti: uno
+    dimenticato viene riavviato alla chiamata successiva, ma i suoi passi
+    trovano già pronti moduli e oggetti condivisi.
+    """
+    with _tasks_lock:
+        task = _tasks.get(name)
+        if task is None:
+            task = _tasks[name] = Task(name, steps)
+            task._thread.start()
+            finished = [n for n, t in _tasks.items() if t.done()]
+            for old in finished[:max(0, len(finished) - MAX_FINISHED_TASKS)]:
+                del _tasks[old]
+        else:
+            _tasks.move_to_end(name)
+    return task
+
+
+def status():
+    """Stato dei riscaldamenti avviati: nome, completato, durata per passo, errori."""
+    with _tasks_lock:
+        tasks = list(_tasks.values())
+    return [{
+        "task": t.name,
+        "done": t.done(),
+        "seconds": {step: round(s, 3) for step, s in t.timings.items()},
+        "errors": dict(t.errors),
+    } for t in tasks]
@@ -0,0 +1,289 @@
+# write_queue.py
+# Coda write-behind per il salvataggio dei messaggi.
+#
+# enqueue() ritorna subito; un thread di background scrive i messaggi sul
+# backend (SQLiteStore o FirestoreStore) a lotti, nell'ordine di arrivo.
+# Con un solo consumatore l'ordine per utente è garantito. Se il backend
+# fallisce il lotto viene ritentato con backoff esponenziale senza farsi
+# superare dai successivi, ma al massimo MAX_ATTEMPTS volte: un lotto che
+# fallisce sempre (es. documento Firestore troppo grande) finisce nel file
+# dead-letter e la coda riparte.
+#
+# Ogni messaggio accodato viene scritto subito in un giornale su disco (lo
+# spool); i lotti scritti sul backend vi aggiungono una riga "done". Al
+# riavvio i messaggi senza "done" vengono riaccodati, anche dopo un SIGKILL
+# o un OOM. La consegna è almeno una volta: se il processo muore tra la
+# scrittura sul backend e la riga "done", quel lotto viene riscritto.
+#
+# Con più processi (vedi index_registry) ognuno ha il suo spool,
+# `<spool>.<pid>`, e lo tiene bloccato con flock finché vive: all'avvio si
+# riaccodano solo gli spool senza lock, cioè di processi terminati. Il
+# sistema rilascia il lock anche dopo un SIGKILL.
+
+import os
+import re
+import json
+import time
+import atexit
+import threading
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: un file aperto da un altro processo non si può rinominare, basta quello
+    fcntl = None
+
+import metrics
+
+DEFAULT_SPOOL_PATH = os.environ.get("STUDY_MASTER_WRITE_SPOOL", os.path.join(".cache", "pending_writes.jsonl"))
+DEFAULT_DEAD_LETTER_PATH = os.environ.get("STUDY_MASTER_WRITE_DEAD_LETTER",
+                                          os.path.join(".cache", "dead_letter_writes.jsonl"))
+DEFAULT_BATCH_SIZE = 100
+# Attesa massima per accumulare un lotto prima di scriverlo
+DEFAULT_LINGER_SECONDS = 0.05
+# Tentativi per lotto: con il backoff sono circa 30 s prima di arrendersi
+MAX_ATTEMPTS = 6
+MAX_BACKOFF_SECONDS = 30.0
+
+
+class WriteBehindQueue:
+
+    def __init__(self, store, spool_path=DEFAULT_SPOOL_PATH, batch_size=DEFAULT_BATCH_SIZE,
+                 linger_seconds=DEFAULT_LINGER_SECONDS, dead_letter_path=DEFAULT_DEAD_LETTER_PATH,
+                 max_attempts=MAX_ATTEMPTS):
+        self.store = store
+        self.spool_path = spool_path
+        self.dead_letter_path = dead_letter_path
+        self.batch_size = batch_size
+        self.linger_seconds = linger_seconds
+        self.max_attempts = max_attempts
+        self.written = 0
+        self.failures = 0
+        self.dead_lettered = 0
+
+        self._pending = deque()     # (seq, username, role, content)
+        self._cond = threading.Condition()
+        self._next_seq = 0
+        self._done_seq = -1         # tutti i seq <= _done_seq sono scritti (o nel dead-letter)
+        self._retrying = False      # il lotto in testa ha già fallito almeno una volta
+        self._closed = False
+
+        self.journal_path = f"{spool_path}.{os.getpid()}"
+        if os.path.exists(self.journal_path):
+            # Lasciato da un processo morto con lo stesso pid: lo si rilegge come gli altri
+            os.replace(self.journal_path, f"{self.journal_path}.old")
+        if fcntl is None:
+            self._journal = self._open(self.journal_path, "w")
+            self._recover()
+        else:
+            # Bloccato prima di avere il nome definitivo: nessun altro processo lo vede senza lock
+            self._journal = self._open(f"{self.journal_path}.tmp", "w")
+            self._lock_file(self._journal)
+            self._recover()
+            os.replace(self._journal.name, self.journal_path)
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # --- API ---
+
+    def enqueue(self, username, role, content):
+        with self._cond:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._pending.append((seq, username, role, content))
+            self._log({"seq": seq, "username": username, "role": role, "content": content})
+            self._cond.notify_all()
+
+    def flush(self, timeout=10.0):
+        """Attende che tutto ciò che è stato accodato finora sia scritto.
+
+        Ritorna False se il timeout scade o se il backend sta fallendo: i
+        messaggi restano in coda (e nello spool) e verranno ritentati.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            target = self._next_seq - 1
+            while self._done_seq < target:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._retrying:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def close(self, timeout=5.0):
+        """Ultimo tentativo di scrittura; quanto resta è già nello spool e verrà riaccodato al riavvio."""
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if not self._thread.is_alive():
+            # Con un lotto ancora in volo il worker deve poter segnare il "done"
+            with self._cond:
+                if not self._pending and not self._journal.closed:
+                    # Tutto scritto: lo spool di questo processo non serve più a nessuno
+                    os.remove(self.journal_path)
+                self._journal.close()
+
+    # --- WORKER ---
+
+    def _run(self):
+        backoff = 0.5
+        attempts = 0
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            # Breve attesa per raccogliere i messaggi arrivati insieme (domanda + risposta)
+            time.sleep(self.linger_seconds)
+            with self._cond:
+                batch = [self._pending[i] for i in range(min(self.batch_size, len(self._pending)))]
+            if not batch:
+                continue
+            try:
+                with metrics.span("db_write"):
+                    self.store.save_messages([(u, r, c) for _, u, r, c in batch])
+                metrics.incr("db_messages_written", len(batch))
+            except Exception as e:
+                self.failures += 1
+                attempts += 1
+                if attempts < self.max_attempts:
+                    # Il lotto resta in testa alla coda: nessun messaggio successivo lo supera
+                    with self._cond:
+                        self._retrying = True
+                        self._cond.notify_all()
+                        if not self._closed:
+                            self._cond.wait(backoff)
+                    backoff = min(backoff * 2, MAX_BACKOFF_SECONDS)
+                    continue
+                self._isolate(batch, e)
+            else:
+                with self._cond:
+                    self.written += len(batch)
+            backoff, attempts = 0.5, 0
+            with self._cond:
+                for _ in batch:
+                    self._pending.popleft()
+                self._done_seq = batch[-1][0]
+                self._retrying = False
+                if self._pending:
+                    self._log({"done": self._done_seq})
+                elif not self._journal.closed:
+                    # Niente in sospeso: lo spool riparte vuoto invece di crescere (stesso file, stesso lock)
+                    self._journal.seek(0)
+                    self._journal.truncate()
+                self._cond.notify_all()
+
+    def _isolate(self, batch, error):
+        """Tentativi esauriti: riprova i messaggi uno a uno, nel dead-letter solo quelli che falliscono ancora."""
+        failed = []
+        if len(batch) == 1:
+            failed.append((batch[0], error))
+        else:
+            for item in batch:
+                try:
+                    self.store.save_messages([item[1:]])
+                except Exception as e:
+                    failed.append((item, e))
+                else:
+                    metrics.incr("db_messages_written")
+                    with self._cond:
+                        self.written += 1
+        if failed:
+            self._dead_letter(failed)
+
+    def _dead_letter(self, failed):
+        metrics.incr("errors", stage="db_write")
+        metrics.incr("db_dead_letters", len(failed))
+        with self._cond:
+            self.dead_lettered += len(failed)
+        with self._open(self.dead_letter_path, "a") as f:
+            for (_, username, role, content), error in failed:
+                f.write(json.dumps({"username": username, "role": role, "content": content,
+                                    "error": str(error) or type(error).__name__, "time": time.time()}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    # --- SPOOL ---
+
+    @staticmethod
+    def _open(path, mode):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, mode, encoding="utf-8")
+
+    def _log(self, record):
+        # Basta arrivare al kernel per sopravvivere a SIGKILL/OOM; niente fsync a ogni messaggio
+        if self._journal.closed:
+            return
+        self._journal.write(json.dumps(record) + "\n")
+        self._journal.flush()
+
+    @staticmethod
+    def _lock_file(f):
+        """Lock esclusivo non bloccante su `f`; False se lo tiene un altro processo (o descrittore)."""
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def _recover(self):
+        """Riaccoda nel proprio spool i messaggi degli spool lasciati da processi terminati."""
+        directory = os.path.dirname(self.spool_path) or "."
+        base = os.path.basename(self.spool_path)
+        # Anche il vecchio spool unico e i .tmp/.old/.claim lasciati da processi morti
+        pattern = re.compile(re.escape(base) + r"(\.\d+(\.\w+)?)?")
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if pattern.fullmatch(name) and path != self._journal.name:
+                self._replay(path)
+
+    def _replay(self, path):
+        try:
+            if fcntl is None:
+                # Senza flock: il rename fallisce se il processo che lo scrive lo tiene aperto
+                claimed = f"{self.journal_path}.claim"
+                os.replace(path, claimed)
+                path = claimed
+            f = open(path, "r+", encoding="utf-8")
+        except OSError:
+            return
+        with f:
+            if not self._lock_file(f):
+                return      # il processo che lo scrive è vivo
+            try:
+                # Un altro processo può averlo già riaccodato e rimosso mentre aspettavamo il lock
+                if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                    return
+            except OSError:
+                return
+            items, done = [], -1
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Ultima riga troncata dal crash
+                    continue
+                if "done" in record:
+                    done = max(done, record["done"])
+                else:
+                    items.append(record)
+            for item in items:
+                if item.get("seq", done + 1) > done:
+                    self.enqueue(item["username"], item["role"], item["content"])
+            # Rimosso solo ora che i messaggi sono nel nostro spool, e ancora sotto lock
+            try:
+                os.remove(path)
+            except OSError:
+                pass